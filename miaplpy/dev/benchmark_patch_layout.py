@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+############################################################
+# Program is part of MiaplPy                                #
+# Author:   Sara Mirzaee                                   #
+############################################################
+# Micro-benchmark of the window gathers done in the phase linking loop
+# (SHP amplitude vectors and CCG sample matrix) for the image-major
+# (n_image, rows, cols) and the pixel-major (rows, cols, n_image) patch layouts.
+# The gathers are vectorized (one fancy indexing per block of pixels) so the
+# timing is the memory access of each layout and not the Python loop overhead.
+
+import time
+import argparse
+import numpy as np
+
+
+def cmd_line_parse(iargs=None):
+    parser = argparse.ArgumentParser(description='Compare per-pixel gather throughput of patch memory layouts')
+    parser.add_argument('-n', '--n_image', dest='n_image', type=int, nargs='+', default=[20, 50, 100, 200],
+                        help='Number of images in the stack (default: 20 50 100 200)')
+    parser.add_argument('-p', '--patch_size', dest='patch_size', type=int, default=200,
+                        help='Patch size (default: 200)')
+    parser.add_argument('-r', '--range_window', dest='range_window', type=int, default=19,
+                        help='Range window size (default: 19)')
+    parser.add_argument('-a', '--azimuth_window', dest='azimuth_window', type=int, default=9,
+                        help='Azimuth window size (default: 9)')
+    parser.add_argument('--num_pixels', dest='num_pixels', type=int, default=2000,
+                        help='Number of random pixels to gather the window of (default: 2000)')
+    parser.add_argument('--block', dest='block', type=int, default=64,
+                        help='Number of pixels gathered by each indexing call (default: 64)')
+    parser.add_argument('--repeat', dest='repeat', type=int, default=5,
+                        help='Number of runs, the best one is reported (default: 5)')
+    return parser.parse_args(args=iargs)
+
+
+def gather_image_major(stack, rows, cols, block):
+    """Windows of blocks of pixels from a (n_image, rows, cols) stack, out is (n_image, num_pixels, window)"""
+    out = np.empty((stack.shape[0],) + rows.shape, dtype=stack.dtype)
+    for i in range(0, rows.shape[0], block):
+        out[:, i:i + block, :] = stack[:, rows[i:i + block], cols[i:i + block]]
+    return out
+
+
+def gather_pixel_major(stack, rows, cols, block):
+    """Windows of blocks of pixels from a (rows, cols, n_image) stack, out is (num_pixels, window, n_image)"""
+    out = np.empty(rows.shape + (stack.shape[2],), dtype=stack.dtype)
+    for i in range(0, rows.shape[0], block):
+        out[i:i + block, :, :] = stack[rows[i:i + block], cols[i:i + block], :]
+    return out
+
+
+def best_time(function, repeat, *args):
+    """Best wall time of repeat runs and the output of the last run"""
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = function(*args)
+        best = min(best, time.perf_counter() - t0)
+    return best, out
+
+
+def main(iargs=None):
+    inps = cmd_line_parse(iargs)
+    half_az = inps.azimuth_window // 2
+    half_rg = inps.range_window // 2
+    length = inps.patch_size + 2 * half_az
+    width = inps.patch_size + 2 * half_rg
+
+    win_rows, win_cols = np.meshgrid(np.arange(-half_az, half_az + 1), np.arange(-half_rg, half_rg + 1),
+                                     indexing='ij')
+    rng = np.random.default_rng(0)
+    cent_rows = rng.integers(half_az, length - half_az, inps.num_pixels)
+    cent_cols = rng.integers(half_rg, width - half_rg, inps.num_pixels)
+    rows = (cent_rows[:, None] + win_rows.ravel()[None, :]).astype(np.int32)
+    cols = (cent_cols[:, None] + win_cols.ravel()[None, :]).astype(np.int32)
+    num_samples = rows.size
+
+    print('patch {}x{}, window {}x{}, {} pixels'.format(length, width, inps.azimuth_window,
+                                                       inps.range_window, inps.num_pixels))
+    print('{:>8} {:>16} {:>16} {:>8}'.format('n_image', 'image-major MB/s', 'pixel-major MB/s', 'speedup'))
+    for n_image in inps.n_image:
+        stack = (rng.standard_normal((n_image, length, width)) +
+                 1j * rng.standard_normal((n_image, length, width))).astype(np.complex64)
+        stack_t = np.ascontiguousarray(np.transpose(stack, (1, 2, 0)))
+        size_mb = num_samples * n_image * stack.itemsize / 1e6
+
+        time1, out1 = best_time(gather_image_major, inps.repeat, stack, rows, cols, inps.block)
+        time2, out2 = best_time(gather_pixel_major, inps.repeat, stack_t, rows, cols, inps.block)
+        assert np.array_equal(np.transpose(out1, (1, 2, 0)), out2)
+
+        print('{:>8d} {:>16.1f} {:>16.1f} {:>8.2f}'.format(n_image, size_mb / time1, size_mb / time2,
+                                                          time1 / time2))
+    return
+
+
+if __name__ == '__main__':
+    main()
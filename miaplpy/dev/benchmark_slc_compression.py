@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+############################################################
+# Program is part of MiaplPy                                #
+# Author:   Sara Mirzaee                                   #
+############################################################
+# Benchmark of the lossless compressions of slcStack.h5: size ratio, write speed and
+# read speed of patches (with h5py and with the threaded chunk decompression of slcStack.read)
+
+import os
+import time
+import argparse
+import h5py
+import numpy as np
+from miaplpy.objects.slcStack import slcStack, get_compression_kwargs
+
+
+def cmd_line_parse(iargs=None):
+    parser = argparse.ArgumentParser(description='Compare size and read throughput of slcStack.h5 compressions')
+    parser.add_argument('-f', '--file', dest='slc_file', default=None,
+                        help='slcStack.h5 to take the data from (default: simulated Rayleigh speckle)')
+    parser.add_argument('-c', '--compression', dest='compression', nargs='+',
+                        default=['no', 'lzf', 'gzip', 'zstd', 'blosc'],
+                        help='Compressions to test (default: no lzf gzip zstd blosc)')
+    parser.add_argument('-n', '--num_threads', dest='num_threads', type=int, nargs='+', default=[1, 4],
+                        help='Number of decompression threads to test (default: 1 4)')
+    parser.add_argument('-s', '--size', dest='size', type=int, nargs=3, default=[50, 800, 800],
+                        metavar=('N_IMAGE', 'LENGTH', 'WIDTH'),
+                        help='Size of the simulated or subset stack (default: 50 800 800)')
+    parser.add_argument('-p', '--patch_size', dest='patch_size', type=int, default=200,
+                        help='Size of the patches to read (default: 200)')
+    parser.add_argument('-o', '--out_dir', dest='out_dir', default='.',
+                        help='Directory of the temporary stack files (default: ./)')
+    return parser.parse_args(args=iargs)
+
+
+def get_data(inps):
+    n_image, length, width = inps.size
+    if inps.slc_file:
+        with h5py.File(inps.slc_file, 'r') as f:
+            return f['slc'][0:n_image, 0:length, 0:width]
+    rng = np.random.default_rng(0)
+    amplitude = rng.rayleigh(1.0, (n_image, length, width))
+    phase = rng.uniform(-np.pi, np.pi, (n_image, length, width))
+    return (amplitude * np.exp(1j * phase)).astype(np.complex64)
+
+
+def main(iargs=None):
+    inps = cmd_line_parse(iargs)
+    data = get_data(inps)
+    n_image, length, width = data.shape
+    size_mb = data.nbytes / 1e6
+    boxes = [(col, row, min(col + inps.patch_size, width), min(row + inps.patch_size, length))
+             for row in range(0, length, inps.patch_size) for col in range(0, width, inps.patch_size)]
+
+    print('stack {}x{}x{} ({:.1f} MB), {} patches'.format(n_image, length, width, size_mb, len(boxes)))
+    print('{:>8} {:>8} {:>10} {}'.format('filter', 'ratio', 'write MB/s',
+                                         ' '.join(['read MB/s ({} thr)'.format(x) for x in inps.num_threads])))
+    for compression in inps.compression:
+        out_file = os.path.join(inps.out_dir, 'slcStack_{}.h5'.format(compression))
+        t0 = time.time()
+        with h5py.File(out_file, 'w') as f:
+            f.create_dataset('slc', data=data, chunks=True, **get_compression_kwargs(compression))
+            f.create_dataset('date', data=np.array(['{:08d}'.format(20000101 + i) for i in range(n_image)],
+                                                   dtype=np.string_))
+        write_speed = size_mb / (time.time() - t0)
+        ratio = os.path.getsize(out_file) / data.nbytes
+
+        read_speed = []
+        for num_threads in inps.num_threads:
+            stack_obj = slcStack(out_file, num_threads=num_threads)
+            t0 = time.time()
+            for box in boxes:
+                stack_obj.read(datasetName='slc', box=box, print_msg=False)
+            read_speed.append(size_mb / (time.time() - t0))
+        os.remove(out_file)
+
+        print('{:>8} {:>8.3f} {:>10.1f} {}'.format(compression, ratio, write_speed,
+                                                   ' '.join(['{:>17.1f}'.format(x) for x in read_speed])))
+    return
+
+
+if __name__ == '__main__':
+    main()
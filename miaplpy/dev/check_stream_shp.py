@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+############################################################
+# Program is part of MiaplPy                                #
+# Author:   Sara Mirzaee                                   #
+############################################################
+# Consistency check of the ministack streaming mode: with a single ministack
+# process_patch_stream_c has to select the same SHPs (also with max_shp) and
+# write the same products as process_patch_c on a synthetic patch.
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import numpy as np
+from miaplpy.lib import utils as iut
+
+
+def cmd_line_parse(iargs=None):
+    parser = argparse.ArgumentParser(description='Compare SHPs and products of process_patch_c and '
+                                                 'process_patch_stream_c with a single ministack')
+    parser.add_argument('-n', '--n_image', dest='n_image', type=int, default=15,
+                        help='Number of images in the stack (default: 15)')
+    parser.add_argument('-p', '--patch_size', dest='patch_size', type=int, default=30,
+                        help='Patch size (default: 30)')
+    parser.add_argument('-r', '--range_window', dest='range_window', type=int, default=7,
+                        help='Range window size (default: 7)')
+    parser.add_argument('-a', '--azimuth_window', dest='azimuth_window', type=int, default=7,
+                        help='Azimuth window size (default: 7)')
+    parser.add_argument('--max_shp', dest='max_shp', type=int, nargs='+', default=[0, 10, 30],
+                        help='Maximum number of SHPs, 0 for the full window (default: 0 10 30)')
+    parser.add_argument('--distance_threshold', dest='distance_threshold', type=float, default=0.4,
+                        help='Critical distance of the KS test (default: 0.4)')
+    parser.add_argument('--ps_shp', dest='ps_shp', type=int, default=5,
+                        help='Number of SHPs of PS candidates (default: 5)')
+    return parser.parse_args(args=iargs)
+
+
+class SyntheticStack:
+    """ In memory stand-in of slcStack: read of all dates ('slc') or of a list of dates """
+    def __init__(self, slc):
+        self.slc = slc
+        self.date_list = ['2020{:04d}'.format(101 + i) for i in range(slc.shape[0])]
+
+    def get_date_list(self):
+        return self.date_list
+
+    def read(self, datasetName=None, box=None, print_msg=False):
+        data = self.slc[:, box[1]:box[3], box[0]:box[2]]
+        if isinstance(datasetName, list):
+            data = data[[self.date_list.index(x) for x in datasetName]]
+        return data.copy()
+
+
+def simulate_slc(n_image, length, width, seed=0):
+    """ Speckle with regions of different amplitude so the SHP regions are irregular, and a few stable points """
+    rng = np.random.default_rng(seed)
+    amp = rng.gamma(1.0, 1.0, (length, width))[None] * rng.uniform(0.3, 1.7, (n_image, length, width))
+    amp[:, ::3, :] *= 4
+    amp[:, 5:length - 5, 5:width // 2] = 3 + 0.3 * rng.standard_normal((n_image, length - 10, width // 2 - 5))
+    for r, c in zip(rng.integers(0, length, 5), rng.integers(0, width, 5)):
+        amp[:, r, c] = 20 + 0.5 * rng.standard_normal(n_image)
+    return (amp * np.exp(1j * rng.uniform(-np.pi, np.pi, amp.shape))).astype(np.complex64)
+
+
+def main(iargs=None):
+    inps = cmd_line_parse(iargs)
+    n_image = inps.n_image
+    length = width = inps.patch_size
+    stack = SyntheticStack(simulate_slc(n_image, length, width))
+    sample_rows = np.arange(-(inps.azimuth_window // 2), inps.azimuth_window // 2 + 1, dtype=np.int32)
+    sample_cols = np.arange(-(inps.range_window // 2), inps.range_window // 2 + 1, dtype=np.int32)
+    box = np.array([0, 0, width, length, 0], dtype=np.int32)
+    distance_threshold = inps.distance_threshold
+    kwargs = dict(range_window=inps.range_window, azimuth_window=inps.azimuth_window, width=width, length=length,
+                  n_image=n_image, slcStackObj=stack, def_sample_rows=sample_rows, def_sample_cols=sample_cols,
+                  reference_row=inps.azimuth_window // 2, reference_col=inps.range_window // 2,
+                  phase_linking_method=b'sequential_EMI', total_num_mini_stacks=1, default_mini_stack_size=n_image,
+                  ps_shp=inps.ps_shp, shp_test=b'ks')
+
+    failed = False
+    work_dir = tempfile.mkdtemp()
+    try:
+        for max_shp in inps.max_shp:
+            out = {}
+            for mode in ['default', 'stream']:
+                out_dir = os.path.join(work_dir, '{}_{}'.format(mode, max_shp))
+                if mode == 'default':
+                    iut.process_patch_c(box, None, distance_threshold=distance_threshold, out_dir=out_dir.encode(),
+                                        lag=0, max_shp=max_shp, **kwargs)
+                else:
+                    iut.process_patch_stream_c(box, None, out_dir=out_dir.encode(), max_shp=max_shp,
+                                               mini_stack_distance_threshold=np.array([distance_threshold],
+                                                                                      dtype=np.float32), **kwargs)
+                patch_dir = out_dir + '/PATCHES/PATCH_0000/'
+                out[mode] = {x: np.load(patch_dir + x + '.npy') for x in ['shp', 'mask_ps', 'phase_ref']}
+
+            shp_equal = np.array_equal(out['default']['shp'], out['stream']['shp'])
+            ps_equal = np.array_equal(out['default']['mask_ps'], out['stream']['mask_ps'])
+            phase_diff = np.abs(np.angle(out['default']['phase_ref'] * np.conj(out['stream']['phase_ref']))).max()
+            print('max_shp {:>3}: shp.npy equal: {}, mask_ps equal: {}, max phase difference: {:.2e}'.format(
+                max_shp, shp_equal, ps_equal, phase_diff))
+            failed = failed or not (shp_equal and ps_equal)
+    finally:
+        shutil.rmtree(work_dir)
+
+    if failed:
+        sys.exit('SHP selection of the streaming mode differs from the default mode')
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -130,6 +130,9 @@ def create_parser():
     #                  help='minimum area size to diable/ignore the threshold-based masking [for offset only]')
 
     # computing
+    parser.add_argument('--pixel-major', dest='pixelMajor', action='store_true',
+                        help='Read the observations from a copy of the stack chunked by pixel blocks of all pairs,\n' +
+                             'created once next to the stack file and reused by later inversions')
     parser = arg_utils.add_memory_argument(parser)
     parser = arg_utils.add_parallel_argument(parser)
 
@@ -375,45 +378,124 @@ def get_design_matrix4timeseries(date12_list, refDate=None, alpha=0.01):
     return A, B, Alpha
 
 ################################# Time-series Estimator ###################################
-def invert_L1_norm(R, Alpha, y, max_iter=100, smoothing_facor=0.0):
+def solve_weighted_normal(G, weight, obs, full_rank=True, rcond=1e-15):
+    """Solve the weighted normal equations G^T W G X = G^T W y of a stack of pixels at once,
+    with the diagonal weights applied as scales of the rows of G.
+
+    Parameters: G         - 2D np.ndarray in size of (num_obs, num_unknown), design matrix
+                weight    - 2D np.ndarray in size of (num_pixel, num_obs), diagonal of W of each pixel
+                obs       - 2D np.ndarray in size of (num_pixel, num_obs), observations of each pixel
+                full_rank - bool, G has full column rank, otherwise minimum norm solutions with pinv
+                rcond     - float, cut-off ratio of small eigenvalues of G^T W G for pinv
+    Returns:    X         - 2D np.ndarray in size of (num_pixel, num_unknown)
+    """
+    GW = G[None, :, :] * weight[:, :, None]
+    N = np.matmul(np.transpose(GW, (0, 2, 1)), G)
+    b = np.einsum('pki,pk->pi', GW, obs)
+    if full_rank:
+        try:
+            return np.linalg.solve(N, b[:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:
+            pass
+    return np.matmul(np.linalg.pinv(N, rcond=rcond), b[:, :, None])[:, :, 0]
+
+
+def solve_weighted_lstsq(G, y, weight_sqrt, rcond=1e-5, chunk_size=None):
+    """Weighted least squares solutions of G X = y for pixels sharing the design matrix G,
+    solved in chunks of pixels with the stacked normal equations.
+
+    Parameters: G           - 2D np.ndarray in size of (num_pair, num_unknown), design matrix
+                y           - 2D np.ndarray in size of (num_pair, num_pixel), observations without NaN
+                weight_sqrt - 2D np.ndarray in size of (num_pair, num_pixel), square root of weight
+                rcond       - float, cut-off ratio of small singular values of the weighted G
+    Returns:    X           - 2D np.ndarray in size of (num_unknown, num_pixel)
+                e2          - 1D np.ndarray in size of (num_pixel,), sum of the squared weighted residuals
+    """
+    G = np.array(G, dtype=np.float64)
+    num_obs, num_unknown = G.shape
+    num_pixel = y.shape[1]
+    full_rank = np.linalg.matrix_rank(G) == num_unknown
+    if chunk_size is None:
+        # weighted design matrices and normal matrices in ~256 MB
+        chunk_size = max(1, int(256 * 1024**2 / (8 * num_unknown * (num_obs + num_unknown))))
+
+    X = np.zeros((num_unknown, num_pixel), dtype=np.float32)
+    e2 = np.zeros(num_pixel, dtype=np.float32)
+    for c0 in range(0, num_pixel, chunk_size):
+        c1 = min(c0 + chunk_size, num_pixel)
+        weight = np.square(weight_sqrt[:, c0:c1].T, dtype=np.float64)
+        Xc = solve_weighted_normal(G, weight, y[:, c0:c1].T.astype(np.float64),
+                                   full_rank=full_rank, rcond=rcond ** 2)
+        X[:, c0:c1] = Xc.T
+        e2[c0:c1] = np.sum(weight * np.square(y[:, c0:c1].T - np.matmul(Xc, G.T)), axis=1)
+    return X, e2
+
+
+def iterate_L1_norm(G, ifg, max_iter=100, tol=1e-3):
+    """Iteratively reweighted least squares of the pixels (columns) of ifg, weights 1 / |residual|.
+    A pixel stops iterating when its residuals change by less than tol or become NaN.
+
+    Parameters: G   - 2D np.ndarray in size of (num_obs, num_unknown), design matrix
+                ifg - 2D np.ndarray in size of (num_obs, num_pixel), observations
+    Returns:    X   - 2D np.ndarray in size of (num_unknown, num_pixel)
+                e1  - 1D np.ndarray in size of (num_pixel,), sum of the absolute residuals
+    """
+    full_rank = np.linalg.matrix_rank(G) == G.shape[1]
+    obs = ifg.T.astype(np.float64)
 
-    ifg = np.zeros(y.shape, np.float32)
-    if smoothing_facor > 0:
-        ifg = np.concatenate([y, ifg], dtype=np.float32).flatten()
-        G = np.concatenate([R, Alpha], dtype=np.float32)
-    else:
-        ifg[:] = y[:]
-    W = np.eye((ifg.shape[0]), dtype=np.float32)
-    inv_Q = linalg.pinv2(np.linalg.multi_dot([G.T, W, G])).astype(np.float32)
-    Coef = np.linalg.multi_dot([G.T, W, ifg]).astype(np.float32)
-    X = np.matmul(inv_Q, Coef).astype(np.float32)
-
-    res = np.abs(ifg - np.matmul(G, X)).astype(np.float32)
-    res[res < 1e-5] = 1e-5
-    res1 = np.empty(res.shape, dtype=np.float32)
-    res2 = np.empty(res.shape, dtype=np.float32)
-    res1[:] = res[:]
-    res2[:] = 1
-    diff_res = np.max(np.abs(res1 - res2))
+    # un-weighted solution shared by all pixels
+    X = np.matmul(obs, np.matmul(G, linalg.pinv(np.matmul(G.T, G)).T))
+    res = np.maximum(np.abs(obs - np.matmul(X, G.T)), 1e-5)
+    res_prev = np.ones(res.shape, dtype=np.float64)
+    active = np.where(np.max(np.abs(res - res_prev), axis=1) > tol)[0]
 
     for ii in range(max_iter):
-        if diff_res <= 1e-3:
-            break
-        res1[:] = res2[:]
-        W = np.diag(1/res.flatten())
-        W = W / np.max(W)
-        inv_Q = linalg.pinv2(np.linalg.multi_dot([G.T, W, G])).astype(np.float32)
-        Coef = np.linalg.multi_dot([G.T, W, ifg]).astype(np.float32)
-        X = np.matmul(inv_Q, Coef).astype(np.float32)
-        res = np.abs(ifg - np.matmul(G, X)).astype(np.float32)
-        res[res < 1e-5] = 1e-5
-        res2[:] = res[:]
-        diff_res = np.max(np.abs(res1 - res2))
-        if np.any(np.isnan(res)):
+        if active.size == 0:
             break
-    e1 = np.sum(res)
+        weight = 1 / res[active]
+        weight /= np.max(weight, axis=1, keepdims=True)
+        X[active] = solve_weighted_normal(G, weight, obs[active], full_rank=full_rank)
+        res_new = np.maximum(np.abs(obs[active] - np.matmul(X[active], G.T)), 1e-5)
+        diff_res = np.max(np.abs(res_prev[active] - res_new), axis=1)
+        res[active] = res_new
+        res_prev[active] = res_new
+        # converged or NaN pixels are dropped from the active set
+        active = active[diff_res > tol]
+
+    e1 = np.sum(res, axis=1).astype(np.float32)
+    return X.T.astype(np.float32), e1
+
+
+def invert_L1_norm(R, Alpha, y, max_iter=100, smoothing_facor=0.0, chunk_size=None):
+    """L1-norm solution of R X = y (with the smoothing rows Alpha X = 0 if smoothing_facor > 0)
+    by iteratively reweighted least squares, for many pixels at once.
+
+    Parameters: R          - 2D np.ndarray in size of (num_pair, num_unknown), design matrix
+                Alpha      - 2D np.ndarray in size of (num_pair, num_unknown), smoothing design matrix
+                y          - 1D / 2D np.ndarray in size of (num_pair, num_pixel), observations without NaN
+                chunk_size - int, number of pixels iterated together, set by the memory of the normal matrices
+    Returns:    X          - 2D np.ndarray in size of (num_unknown, num_pixel)
+                e1         - 1D np.ndarray in size of (num_pixel,), sum of the absolute residuals
+    """
+    y = np.asarray(y, dtype=np.float32).reshape(R.shape[0], -1)
+    if smoothing_facor > 0:
+        ifg = np.concatenate([y, np.zeros(y.shape, dtype=np.float32)], axis=0)
+        G = np.concatenate([R, Alpha], axis=0).astype(np.float64)
+    else:
+        ifg = y
+        G = np.array(R, dtype=np.float64)
+    num_obs, num_unknown = G.shape
+    num_pixel = y.shape[1]
 
-    X = X.reshape(-1, 1)
+    if chunk_size is None:
+        # weighted design matrices and normal matrices in ~256 MB
+        chunk_size = max(1, int(256 * 1024**2 / (8 * num_unknown * (num_obs + num_unknown))))
+
+    X = np.zeros((num_unknown, num_pixel), dtype=np.float32)
+    e1 = np.zeros(num_pixel, dtype=np.float32)
+    for c0 in range(0, num_pixel, chunk_size):
+        c1 = min(c0 + chunk_size, num_pixel)
+        X[:, c0:c1], e1[c0:c1] = iterate_L1_norm(G, ifg[:, c0:c1], max_iter=max_iter)
     return X, e1
 
 
@@ -527,15 +609,12 @@ def estimate_timeseries(A, B, Alpha, y0, tbase_diff, weight_sqrt=None, min_norm_
             ##### min-norm velocity
             if residualNorm.startswith('L2'):
                 if weight_sqrt is not None:
-                    X, e2 = linalg.lstsq(np.multiply(B, weight_sqrt),
-                                         np.multiply(y, weight_sqrt),
-                                         cond=rcond)[:2]
+                    X, e2 = solve_weighted_lstsq(B, y, weight_sqrt, rcond=rcond)
                 else:
                     X, e2 = linalg.lstsq(B, y, cond=rcond)[:2]
 
             else:
-                X, e2 = invert_L1_norm(B, Alpha, y.flatten(), 100, np.max(Alpha))
-                X = np.array(X).reshape(-1, 1)
+                X, e2 = invert_L1_norm(B, Alpha, y, 100, np.max(Alpha))
 
             #if residualNorm.endswith('intLsq'):
             #    X = np.rint(X)
@@ -564,15 +643,12 @@ def estimate_timeseries(A, B, Alpha, y0, tbase_diff, weight_sqrt=None, min_norm_
             ##### min-norm displacement
             if residualNorm.startswith('L2'):
                 if weight_sqrt is not None:
-                    X, e2 = linalg.lstsq(np.multiply(A, weight_sqrt),
-                                         np.multiply(y, weight_sqrt),
-                                         cond=rcond)[:2]
+                    X, e2 = solve_weighted_lstsq(A, y, weight_sqrt, rcond=rcond)
                 else:
                     X, e2 = linalg.lstsq(A, y, cond=rcond)[:2]
 
             else:
-                X, e2 = invert_L1_norm(A, Alpha, y.flatten(), 100, np.max(Alpha))
-                X = np.array(X).reshape(-1, 1)
+                X, e2 = invert_L1_norm(A, Alpha, y, 100, np.max(Alpha))
 
             #if residualNorm.endswith('intLsq'):
             #    X = np.rint(X)
@@ -652,7 +728,7 @@ def estimate_timeseries_cov(G, y, y_std, rcond=1e-5, min_redundancy=1.0):
 
 def skip_invalid_obs(obs, mat_list):
     """Skip invalid observations in the stack of phase/offset and update corresponding matrices.
-    This applies to the pixel-wised inversion only, because the region-wised inversion has valid obs in all pairs.
+    This applies to the pixel-wised inversion, or pixels sharing the valid obs of the first one.
     Parameters: obs      - 2D np.ndarray in size of (num_pair, num_pixel),
                            observations (phase / offset) of all interferograms with no-data value: NaN.
                 mat_list - list of 2D np.ndarray in size of (num_pair, *) or None
@@ -824,6 +900,63 @@ def split2boxes(ifgram_file, max_memory=4, print_msg=True):
     return box_list, num_box
 
 
+def get_pixel_major_stack(ifgram_file, ds_names, max_memory=4, print_msg=True):
+    """Create or reuse the pixel-major copy of the datasets of an ifgramStack file
+
+    The copy (*_pixelMajor.h5 next to ifgram_file) has the same datasets and metadata, with the 3D datasets
+    chunked as (num_pair, n, n), so a box of all pairs is read from contiguous chunks instead of the chunks
+    of every interferogram. A dataset is copied again only if its MODIFICATION_TIME changed, the metadata
+    and 1D datasets (date, dropIfgram, ...) are updated on every call.
+
+    Parameters: ifgram_file - str, interferograms stack HDF5 file
+                ds_names    - list of str, 3D datasets to copy
+                max_memory  - float, max memory to use in GB for the copy
+    Returns:    cache_file  - str, pixel-major stack file
+    """
+    cache_file = os.path.splitext(ifgram_file)[0] + '_pixelMajor.h5'
+    with h5py.File(ifgram_file, 'r') as fi, h5py.File(cache_file, 'a') as fo:
+        for key, value in fi.attrs.items():
+            fo.attrs[key] = value
+        for key in [i for i in fi.keys() if fi[i].ndim < 3]:
+            if key in fo.keys():
+                del fo[key]
+            fo.create_dataset(key, data=fi[key][:])
+
+        for ds_name in ds_names:
+            ds_in = fi[ds_name]
+            num_pair, length, width = ds_in.shape
+            mod_time = ds_in.attrs.get('MODIFICATION_TIME', str(os.path.getmtime(ifgram_file)))
+            if (ds_name in fo.keys() and fo[ds_name].shape == ds_in.shape
+                    and fo[ds_name].attrs.get('MODIFICATION_TIME', None) == mod_time):
+                if print_msg:
+                    print('reuse pixel-major {} in {}'.format(ds_name, cache_file))
+                continue
+            if ds_name in fo.keys():
+                del fo[ds_name]
+
+            # ~4 MB chunks of all pairs
+            chunk_size = max(1, int(np.sqrt(4 * 1024**2 / (num_pair * ds_in.dtype.itemsize))))
+            chunks = (num_pair, min(chunk_size, length), min(chunk_size, width))
+            ds_out = fo.create_dataset(ds_name, shape=ds_in.shape, dtype=ds_in.dtype, chunks=chunks)
+
+            # blocks of rows of all pairs, aligned with the chunks of both files (if it fits in memory)
+            # so each chunk is read and written once
+            max_rows = int(max_memory * 1024**3 / (num_pair * width * ds_in.dtype.itemsize))
+            row_align = int(np.lcm(chunks[1], ds_in.chunks[1] if ds_in.chunks else 1))
+            if row_align > max_rows:
+                row_align = chunks[1]
+            row_step = max(1, max_rows // row_align) * row_align
+            if print_msg:
+                print('copy {} into {} with chunks of {} in blocks of {} lines'.format(
+                    ds_name, cache_file, chunks, row_step))
+            for y0 in range(0, length, row_step):
+                y1 = min(y0 + row_step, length)
+                ds_out[:, y0:y1, :] = ds_in[:, y0:y1, :]
+            ds_out.attrs['MODIFICATION_TIME'] = mod_time
+
+    return cache_file
+
+
 def check_design_matrix(ifgram_file, weight_func='var'):
     """
     Check Rank of Design matrix for weighted inversion
@@ -1265,94 +1398,38 @@ def ifgram_inversion_patch(box, ifgram_file=None, wrappedIfgramStack=None, ref_p
         num_inv_obs = num_inv_obs.reshape(num_row, num_col)
         return ts, ts_cov, inv_quality, num_inv_obs, box
 
-    # 2.2 un-weighted inversion (classic SBAS)
-    if weight_sqrt is None:
-
-        # a. split mask into mask_all/part_net
-        # mask for valid (~NaN) observations in ALL ifgrams (share one B in sbas inversion)
-        mask_all_net = np.all(~np.isnan(stack_obs), axis=0)
-        mask_all_net *= mask
-        mask_part_net = mask ^ mask_all_net
-        del mask
-
-        # b. invert once for all pixels with obs in all ifgrams
-        if np.sum(mask_all_net) > 0:
-            print(('estimating time-series for pixels with valid {} in all  ifgrams'
-                   ' ({:.0f} pixels; {:.1f}%) ...').format(obs_ds_name,
-                                                           np.sum(mask_all_net),
-                                                           np.sum(mask_all_net)/num_pixel2inv*100))
-            (tsi,
-             inv_quali,
-             num_obsi) = estimate_timeseries(A, B, Alpha,
-                                             y0=stack_obs[:, mask_all_net],
-                                             tbase_diff=tbase_diff,
-                                             weight_sqrt=None,
-                                             min_norm_velocity=min_norm_velocity,
-                                             min_redundancy=min_redundancy,
-                                             inv_quality_name=inv_quality_name,
-                                             refIndx=refIndx,
-                                             residualNorm=residualNorm)
-
-            # save result to output matrices
-            ts[:, mask_all_net] = tsi
-            inv_quality[mask_all_net] = inv_quali
-            num_inv_obs[mask_all_net] = num_obsi
-
-        # c. pixel-by-pixel for pixels with obs not in all ifgrams
-        if np.sum(mask_part_net) > 0:
-            print(('estimating time-series for pixels with valid {} in some ifgrams'
-                   ' ({:.0f} pixels; {:.1f}%) ...').format(obs_ds_name,
-                                                           np.sum(mask_part_net),
-                                                           np.sum(mask_all_net)/num_pixel2inv*100))
-            num_pixel2inv_part = int(np.sum(mask_part_net))
-            idx_pixel2inv_part = np.where(mask_part_net)[0]
-            prog_bar = ptime.progressBar(maxValue=num_pixel2inv_part)
-            for i in range(num_pixel2inv_part):
-                idx = idx_pixel2inv_part[i]
-                (tsi,
-                 inv_quali,
-                 num_obsi) = estimate_timeseries(A, B, Alpha,
-                                                 y0=stack_obs[:, idx],
-                                                 tbase_diff=tbase_diff,
-                                                 weight_sqrt=None,
-                                                 min_norm_velocity=min_norm_velocity,
-                                                 min_redundancy=min_redundancy,
-                                                 inv_quality_name=inv_quality_name,
-                                                 refIndx=refIndx,
-                                                 residualNorm=residualNorm)
-
-                # save result to output matrices
-                ts[:, idx] = tsi.flatten()
-                inv_quality[idx] = inv_quali
-                num_inv_obs[idx] = num_obsi
-                prog_bar.update(i+1, every=200, suffix='{}/{} pixels'.format(i+1, num_pixel2inv_part))
-            prog_bar.close()
-
-    # 2.3 weighted inversion - pixel-by-pixel
-    else:
-        print('estimating time-series via weighted norm {} pixel-by-pixel ...'.format(residualNorm))
-        prog_bar = ptime.progressBar(maxValue=num_pixel2inv)
-        for i in range(num_pixel2inv):
-            idx = idx_pixel2inv[i]
-            (tsi,
-             inv_quali,
-             num_obsi) = estimate_timeseries(A, B, Alpha,
-                                             y0=stack_obs[:, idx],
-                                             tbase_diff=tbase_diff,
-                                             weight_sqrt=weight_sqrt[:, idx],
-                                             min_norm_velocity=min_norm_velocity,
-                                             min_redundancy=min_redundancy,
-                                             inv_quality_name=inv_quality_name,
-                                             refIndx=refIndx,
-                                             residualNorm=residualNorm)
-
-            # save result to output matrices
-            ts[:, idx] = tsi.flatten()
-            inv_quality[idx] = inv_quali
-            num_inv_obs[idx] = num_obsi
-
-            prog_bar.update(i+1, every=200, suffix='{}/{} pixels'.format(i+1, num_pixel2inv))
-        prog_bar.close()
+    # 2.2 invert the pixels in groups of the same valid observations, i.e. the same design matrix,
+    # all the pixels of a group are solved at once, with weight or not (classic SBAS)
+    valid_obs = np.packbits(~np.isnan(stack_obs[:, idx_pixel2inv]), axis=0)
+    group_ids = np.unique(valid_obs, axis=1, return_inverse=True)[1].flatten()
+    del valid_obs
+    num_group = int(group_ids.max()) + 1
+    order = np.argsort(group_ids, kind='stable')
+    group_idx_list = np.split(idx_pixel2inv[order], np.cumsum(np.bincount(group_ids, minlength=num_group))[:-1])
+    print('estimating time-series via {}norm {} in {} groups of pixels with the same valid {} ...'.format(
+        'weighted ' if weight_sqrt is not None else '', residualNorm, num_group, obs_ds_name))
+
+    prog_bar = ptime.progressBar(maxValue=num_group)
+    for i, idx in enumerate(group_idx_list):
+        (tsi,
+         inv_quali,
+         num_obsi) = estimate_timeseries(A, B, Alpha,
+                                         y0=stack_obs[:, idx],
+                                         tbase_diff=tbase_diff,
+                                         weight_sqrt=weight_sqrt[:, idx] if weight_sqrt is not None else None,
+                                         min_norm_velocity=min_norm_velocity,
+                                         min_redundancy=min_redundancy,
+                                         inv_quality_name=inv_quality_name,
+                                         print_msg=False,
+                                         refIndx=refIndx,
+                                         residualNorm=residualNorm)
+
+        # save result to output matrices
+        ts[:, idx] = tsi
+        inv_quality[idx] = inv_quali
+        num_inv_obs[idx] = num_obsi
+        prog_bar.update(i+1, every=200, suffix='{}/{} groups'.format(i+1, num_group))
+    prog_bar.close()
     del weight_sqrt
 
     # 2.4 time-series std. dev. - pixel-by-pixel
@@ -1567,8 +1644,22 @@ def ifgram_inversion(inps=None):
     os.makedirs(out_dir_boxes, exist_ok=True)
 
     # 3.2 prepare the input arguments for *_patch()
+    ifgram_file = inps.ifgramStackFile
+    if inps.pixelMajor:
+        # observations, weight and mask datasets read by ifgram_inversion_patch()
+        ds_names = [inps.obsDatasetName]
+        if inps.obsDatasetName.startswith(('unwrapPhase', 'ion')):
+            if inps.weightFunc not in ['no', 'sbas'] or inps.calcCov:
+                ds_names.append('coherence')
+        elif inps.calcCov or inps.weightFunc == 'var':
+            ds_names.append(inps.obsDatasetName + 'Std')
+        if inps.maskDataset and inps.maskDataset in stack_obj.datasetNames:
+            ds_names.append(inps.maskDataset)
+        ifgram_file = get_pixel_major_stack(inps.ifgramStackFile, list(dict.fromkeys(ds_names)),
+                                            max_memory=inps.maxMemory)
+
     data_kwargs = {
-        "ifgram_file"       : inps.ifgramStackFile,
+        "ifgram_file"       : ifgram_file,
         "ref_phase"         : inps.refPhase,
         "obs_ds_name"       : inps.obsDatasetName,
         "weight_func"       : inps.weightFunc,
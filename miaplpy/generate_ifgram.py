@@ -16,11 +16,15 @@ def enablePrint():
 
 blockPrint()
 import datetime
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
 from isce.components import isceobj
+from isce.components.isceobj.Util.ImageUtil import ImageLib as IML
 import numpy as np
 from miaplpy.objects.arg_parser import MiaplPyParser
+from miaplpy.objects.utils import decode_dataset, multilook_array, multilook_stream
+from miaplpy.objects.ifgram_filter import goldstein_filter, gaussian_filter, gaussian_kernel
 import h5py
-from math import sqrt, exp
 
 enablePrint()
 
@@ -47,6 +51,13 @@ def main(iargs=None):
     print(inps.out_dir)
     os.makedirs(inps.out_dir, exist_ok=True)
 
+    if inps.pair_list:
+        run_interferogram_pairs(inps)
+        return
+
+    if inps.reference is None or inps.secondary is None:
+        raise ValueError('--reference and --secondary are required if no --pair_list is given')
+
     resampName = inps.out_dir + '/fine'
     resampInt = resampName + '.int'
     filtInt = os.path.dirname(resampInt) + '/filt_fine.int'
@@ -55,22 +66,27 @@ def main(iargs=None):
     if os.path.exists(cor_file + '.xml'):
         return
 
-    length, width = run_interferogram(inps, resampName)
+    length, width, ifg = run_interferogram(inps, resampName)
 
     filter_strength = inps.filter_strength
-    runFilter(resampInt, filtInt, filter_strength)
+    if inps.filter_method == 'isce':
+        runFilter(resampInt, filtInt, filter_strength)
+    else:
+        # filter the interferogram in memory, no file round trip
+        run_native_filter(ifg, filtInt, filter_strength, inps.filter_method, num_threads=inps.num_workers)
 
-    estCoherence(filtInt, cor_file)
-    #run_interpolation(filtInt, inps.stack_file, length, width)
+    with h5py.File(inps.stack_file, 'r') as ds:
+        full_shape = ds['phase'].shape[1:]
+    run_coherence(filtInt, cor_file, inps.coherence_file, inps.amplitude_weight, (length, width), full_shape)
+    if inps.interpolation:
+        run_interpolation(filtInt, inps.stack_file, length, width, method=inps.interpolation)
 
     return
 
 
 def run_interferogram(inps, resampName):
-    if inps.azlooks * inps.rglooks > 1:
-        extention = '.ml.slc'
-    else:
-        extention = '.slc'
+    # multilooked in the same pass, weighted by the phase linking temporal coherence
+    alks, rlks = inps.azlooks, inps.rglooks
 
     with h5py.File(inps.stack_file, 'r') as ds:
         date_list = np.array([x.decode('UTF-8') for x in ds['date'][:]])
@@ -81,45 +97,178 @@ def run_interferogram(inps, resampName):
 
         length = phase_series.shape[1]
         width = phase_series.shape[2]
+        out_length = int(np.ceil(length / alks))
+        out_width = int(np.ceil(width / rlks))
 
         resampInt = resampName + '.int'
 
         intImage = isceobj.createIntImage()
         intImage.setFilename(resampInt)
         intImage.setAccessMode('write')
-        intImage.setWidth(width)
-        intImage.setLength(length)
+        intImage.setWidth(out_width)
+        intImage.setLength(out_length)
         intImage.createImage()
 
         out_ifg = intImage.asMemMap(resampInt)
         box_size = 3000
-        num_row = int(np.ceil(length / box_size))
-        num_col = int(np.ceil(width / box_size))
+        num_row = int(np.ceil(length / (box_size // alks * alks)))
+        num_col = int(np.ceil(width / (box_size // rlks * rlks)))
         for i in range(num_row):
             for k in range(num_col):
-                row_1 = i * box_size
-                row_2 = i * box_size + box_size
-                col_1 = k * box_size
-                col_2 = k * box_size + box_size
+                row_1 = i * (box_size // alks * alks)
+                row_2 = row_1 + box_size // alks * alks
+                col_1 = k * (box_size // rlks * rlks)
+                col_2 = col_1 + box_size // rlks * rlks
                 if row_2 > length:
                     row_2 = length
                 if col_2 > width:
                     col_2 = width
 
-                ref_phase = phase_series[ref_ind, row_1:row_2, col_1:col_2].reshape(row_2 - row_1, col_2 - col_1)
-                sec_phase = phase_series[sec_ind, row_1:row_2, col_1:col_2].reshape(row_2 - row_1, col_2 - col_1)
-                ref_amplitude = amplitudes[ref_ind, row_1:row_2, col_1:col_2].reshape(row_2 - row_1, col_2 - col_1)
-                sec_amplitude = amplitudes[sec_ind, row_1:row_2, col_1:col_2].reshape(row_2 - row_1, col_2 - col_1)
+                # compact phase series are quantized, decode_dataset returns float32 phase and amplitude
+                ref_phase = decode_dataset(phase_series, phase_series[ref_ind, row_1:row_2, col_1:col_2]).reshape(
+                    row_2 - row_1, col_2 - col_1)
+                sec_phase = decode_dataset(phase_series, phase_series[sec_ind, row_1:row_2, col_1:col_2]).reshape(
+                    row_2 - row_1, col_2 - col_1)
+                ref_amplitude = decode_dataset(amplitudes, amplitudes[ref_ind, row_1:row_2, col_1:col_2]).reshape(
+                    row_2 - row_1, col_2 - col_1)
+                sec_amplitude = decode_dataset(amplitudes, amplitudes[sec_ind, row_1:row_2, col_1:col_2]).reshape(
+                    row_2 - row_1, col_2 - col_1)
 
                 ifg = (ref_amplitude * sec_amplitude) * np.exp(1j * (ref_phase - sec_phase))
 
+                if alks * rlks > 1:
+                    weight = None
+                    if 'temporalCoherence' in ds:
+                        weight = ds['temporalCoherence'][0, row_1:row_2, col_1:col_2]
+                    ifg = multilook_array(ifg, alks, rlks, weight)
+                    row_1, row_2, col_1, col_2 = row_1 // alks, row_1 // alks + ifg.shape[0], \
+                                                 col_1 // rlks, col_1 // rlks + ifg.shape[1]
+
                 out_ifg[row_1:row_2, col_1:col_2, 0] = ifg[:, :]
 
         intImage.renderHdr()
         intImage.finalizeImage()
 
-    return length, width
+    return out_length, out_width, out_ifg[:, :, 0]
+
+
 
+def read_pair_list(pair_file):
+    """ Reads the pairs (reference_secondary per line) of a pair list file """
+    pairs = []
+    with open(pair_file, 'r') as f:
+        for line in f.readlines():
+            line = line.strip()
+            if line:
+                pairs.append((line.split('_')[0], line.split('_')[1]))
+    return pairs
+
+
+def run_interferogram_pairs(inps):
+    """ Forms, filters and estimates the coherence of all the pairs of inps.pair_list in one process,
+    each pair is written to <output_dir>/<reference>_<secondary> like single pair runs """
+    pairs = []
+    for pair in read_pair_list(inps.pair_list):
+        cor_file = os.path.join(inps.out_dir, '{}_{}'.format(pair[0], pair[1]), 'filt_fine.cor')
+        if not os.path.exists(cor_file + '.xml'):
+            pairs.append(pair)
+    print('{} pairs to generate'.format(len(pairs)))
+    if len(pairs) == 0:
+        return
+
+    resamp_names = [os.path.join(inps.out_dir, '{}_{}'.format(pair[0], pair[1]), 'fine') for pair in pairs]
+    length, width = run_interferogram_multi(inps.stack_file, pairs, resamp_names, num_workers=inps.num_workers,
+                                            max_memory=inps.max_memory, alks=inps.azlooks, rlks=inps.rglooks)
+    with h5py.File(inps.stack_file, 'r') as ds:
+        full_shape = ds['phase'].shape[1:]
+
+    args = [(name + '.int', os.path.dirname(name) + '/filt_fine.int', os.path.dirname(name) + '/filt_fine.cor',
+             inps.filter_strength, inps.filter_method, (length, width), inps.coherence_file, inps.amplitude_weight,
+             None, inps.stack_file, full_shape) for name in resamp_names]
+    with Pool(processes=inps.num_workers) as pool:
+        pool.starmap(filter_and_coherence, args)
+
+    if inps.interpolation:
+        # one interpolator per box for all pairs, the boxes are done one after the other
+        run_interpolation([os.path.dirname(name) + '/filt_fine.int' for name in resamp_names], inps.stack_file,
+                          length, width, method=inps.interpolation, num_threads=inps.num_workers)
+    return
+
+
+def filter_and_coherence(resampInt, filtInt, cor_file, filter_strength, filter_method='isce', shape=None,
+                         coherence_file=None, amplitude_weight=0, interpolation=None, stack_file=None,
+                         full_shape=None):
+    if filter_method == 'isce':
+        runFilter(resampInt, filtInt, filter_strength)
+    else:
+        # one thread per pair, the pairs are filtered by the process pool
+        ifg = np.memmap(resampInt, dtype=np.complex64, mode='r', shape=shape)
+        run_native_filter(ifg, filtInt, filter_strength, filter_method, num_threads=1)
+    run_coherence(filtInt, cor_file, coherence_file, amplitude_weight, shape, full_shape)
+    if interpolation:
+        run_interpolation(filtInt, stack_file, shape[0], shape[1], method=interpolation)
+    return
+
+
+def run_interferogram_multi(stack_file, pairs, resamp_names, num_workers=4, max_memory=4, alks=1, rlks=1):
+    """ Forms the interferograms of all pairs reading each block of rows of the dates once.
+    Read volume is proportional to the number of dates, the pairs of a block are multilooked (alks x rlks,
+    weighted by the temporal coherence) and written by a pool of num_workers threads.
+    max_memory (GB) bounds the size of the block of all dates """
+
+    with h5py.File(stack_file, 'r') as ds:
+        date_list = [x.decode('UTF-8') for x in ds['date'][:]]
+        phase_series = ds['phase']
+        amplitudes = ds['amplitude']
+        length = phase_series.shape[1]
+        width = phase_series.shape[2]
+        out_length = int(np.ceil(length / alks))
+        out_width = int(np.ceil(width / rlks))
+
+        # dates used by the pairs, sorted for h5py fancy indexing
+        date_index = sorted(set([date_list.index(x) for pair in pairs for x in pair]))
+        pair_index = [(date_index.index(date_list.index(pair[0])), date_index.index(date_list.index(pair[1])))
+                      for pair in pairs]
+
+        for name in resamp_names:
+            os.makedirs(os.path.dirname(name), exist_ok=True)
+            intImage = isceobj.createIntImage()
+            intImage.setFilename(name + '.int')
+            intImage.setAccessMode('write')
+            intImage.setWidth(out_width)
+            intImage.setLength(out_length)
+            intImage.createImage()
+            out_ifg = intImage.asMemMap(name + '.int')
+            del out_ifg
+            intImage.renderHdr()
+            intImage.finalizeImage()
+
+        # phase, amplitude and complex values of all dates, 16 bytes per pixel
+        num_rows = max(1, int(max_memory * 1e9 / (16 * len(date_index) * width)) // alks) * alks
+        print('read {} dates for {} pairs in blocks of {} rows'.format(len(date_index), len(pairs), num_rows))
+
+        def write_pair(k, block, weight, row_1):
+            out_ifg = np.memmap(resamp_names[k] + '.int', dtype=np.complex64, mode='r+',
+                                shape=(out_length, out_width))
+            ifg = multilook_array(block[pair_index[k][0]] * np.conj(block[pair_index[k][1]]), alks, rlks, weight)
+            out_ifg[row_1 // alks:row_1 // alks + ifg.shape[0], :] = ifg
+            out_ifg.flush()
+            del out_ifg
+            return
+
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            for row_1 in range(0, length, num_rows):
+                row_2 = min(row_1 + num_rows, length)
+                block = decode_dataset(amplitudes, amplitudes[date_index, row_1:row_2, :]) * \
+                        np.exp(1j * decode_dataset(phase_series, phase_series[date_index, row_1:row_2, :]))
+                block = block.astype(np.complex64)
+                weight = None
+                if alks * rlks > 1 and 'temporalCoherence' in ds:
+                    weight = ds['temporalCoherence'][0, row_1:row_2, :]
+                list(executor.map(write_pair, range(len(pairs)), [block] * len(pairs),
+                                  [weight] * len(pairs), [row_1] * len(pairs)))
+
+    return out_length, out_width
 
 
 def runFilter(infile, outfile, filterStrength):
@@ -146,6 +295,30 @@ def runFilter(infile, outfile, filterStrength):
     intImage.finalizeImage()
     filtImage.finalizeImage()
 
+def run_native_filter(ifg, outfile, filterStrength, filter_method='goldstein', num_threads=4):
+    """ Filters the interferogram array with the native goldstein or gaussian (low pass as runFilterG) filter
+    and writes it as an ISCE int image """
+    if filter_method == 'gaussian':
+        filtered = gaussian_filter(ifg, 100, num_threads=num_threads)
+    else:
+        filtered = goldstein_filter(ifg, filterStrength, num_threads=num_threads)
+
+    length, width = filtered.shape
+    filtImage = isceobj.createIntImage()
+    filtImage.setFilename(outfile)
+    filtImage.setWidth(width)
+    filtImage.setLength(length)
+    filtImage.setAccessMode('write')
+    filtImage.createImage()
+
+    out_filtered = filtImage.asMemMap(outfile)
+    out_filtered[:, :, 0] = filtered[:, :]
+
+    filtImage.renderHdr()
+    filtImage.finalizeImage()
+    return
+
+
 def runFilterG(infile, outfile, filterStrength):
 
     # Initialize the flattened interferogram
@@ -178,6 +351,54 @@ def runFilterG(infile, outfile, filterStrength):
     filtImage.finalizeImage()
 
 
+def run_coherence(filtInt, cor_file, coherence_file=None, amplitude_weight=0, shape=None, full_shape=None):
+    """ ICU coherence of the pair, or the shared coherence raster of the stack if coherence_file is given """
+    if coherence_file is None:
+        estCoherence(filtInt, cor_file)
+    else:
+        write_shared_coherence(filtInt, cor_file, coherence_file, amplitude_weight, shape, full_shape)
+    return
+
+
+def write_shared_coherence(filtInt, cor_file, coherence_file, amplitude_weight, shape, full_shape=None):
+    """ Uses the phase linking temporal coherence (tempCoh_average or tempCoh_full) as the coherence of the pair
+    instead of running ICU. With amplitude_weight = 0 the pair coherence links to the shared raster, otherwise it is
+    the temporal coherence scaled by (1 - w + w * min(|ifg| / median|ifg|, 1)) so dark pixels of the pair get
+    lower weights. Multilooked pairs (shape smaller than full_shape) get the multilooked temporal coherence """
+    for ext in ['', '.xml', '.vrt']:
+        if os.path.lexists(cor_file + ext):
+            os.remove(cor_file + ext)
+
+    full_shape = shape if full_shape is None else tuple(full_shape)
+    if amplitude_weight <= 0 and full_shape == tuple(shape):
+        for ext in ['', '.xml', '.vrt']:
+            if os.path.exists(coherence_file + ext):
+                os.symlink(os.path.abspath(coherence_file + ext), cor_file + ext)
+        return
+
+    temp_coh = np.memmap(coherence_file, dtype=np.float32, mode='r', shape=full_shape)
+    alks = int(np.ceil(full_shape[0] / shape[0]))
+    rlks = int(np.ceil(full_shape[1] / shape[1]))
+    out_cor = np.memmap(cor_file, dtype=np.float32, mode='write', shape=shape)
+
+    def write_block(row_1, row_2, data):
+        out_cor[row_1:row_2, :] = data
+
+    multilook_stream(lambda row_1, row_2: temp_coh[row_1:row_2, :], write_block, full_shape[0], full_shape[1],
+                     alks, rlks, bytes_per_pixel=4)
+
+    if amplitude_weight > 0:
+        amplitude = np.abs(np.memmap(filtInt, dtype=np.complex64, mode='r', shape=shape))
+        amplitude[np.isnan(amplitude)] = 0
+        median_amp = np.median(amplitude[amplitude > 0]) if np.any(amplitude > 0) else 1
+        amp_factor = np.minimum(amplitude / median_amp, 1)
+        out_cor[:, :] *= (1 - amplitude_weight + amplitude_weight * amp_factor)
+    out_cor.flush()
+    del out_cor
+    IML.renderISCEXML(cor_file, bands=1, nyy=shape[0], nxx=shape[1], datatype='float32', scheme='BIL')
+    return
+
+
 def estCoherence(outfile, corfile):
     from mroipac.icu.Icu import Icu
 
@@ -207,13 +428,22 @@ def estCoherence(outfile, corfile):
     filtImage.finalizeImage()
     phsigImage.finalizeImage()
 
-def run_interpolation(filtifg, tcoh_file, length, width):
-    from scipy.spatial import Delaunay
-    from scipy.interpolate import LinearNDInterpolator
+def run_interpolation(filtifg, tcoh_file, length, width, method='linear', tcoh_threshold=0.5, num_threads=1):
+    """ Fills the phase of the pixels with temporal coherence < tcoh_threshold from the coherent pixels,
+    method: linear (Delaunay), nearest (distance transform), kdtree (nearest with cKDTree) or multires
+    (average phase of the coherent pixels in blocks growing by 2 until filled).
+    filtifg is one interferogram or a list of the interferograms of the stack: the mask of temporal coherence is
+    the same for all pairs, so the interpolator of each box is built once and used for all pairs (on num_threads
+    threads) before the next box """
+
+    if isinstance(filtifg, str):
+        filtifg = [filtifg]
 
-    ifg = np.memmap(filtifg, dtype=np.complex64, mode='r+', shape=(length, width))
     with h5py.File(tcoh_file, 'r') as ds:
         tcoh_ds = ds['temporalCoherence']
+        # looks of multilooked interferograms
+        alks = int(np.ceil(tcoh_ds.shape[1] / length))
+        rlks = int(np.ceil(tcoh_ds.shape[2] / width))
 
         box_size = 3000
         num_row = int(np.ceil(length / box_size))
@@ -229,46 +459,96 @@ def run_interpolation(filtifg, tcoh_file, length, width):
                 if col_2 > width:
                     col_2 = width
 
-                ifg_sub = ifg[row_1:row_2, col_1:col_2]
-                tcoh = tcoh_ds[0, row_1:row_2, col_1:col_2]
-                mask = np.zeros((tcoh.shape[0], tcoh.shape[1]))
-                mask[tcoh >= 0.5] = 1
-
-                y, x = np.where(mask == 1)
-                yi, xi = np.where(mask == 0)
-                zifg = np.angle(ifg_sub[y, x])
-                points = np.array([[r, c] for r, c in zip(y, x)])
-                tri = Delaunay(points)
-                func = LinearNDInterpolator(tri, zifg, fill_value=0)
-                interp_points = np.array([[r, c] for r, c in zip(yi.flatten(), xi.flatten())])
-                res = np.exp(1j * func(interp_points)) * (np.abs(ifg_sub[yi, xi]).flatten())
-                ifg[y + row_1, x + col_1] = ifg_sub[y, x]
-                ifg[yi + row_1, xi + col_1] = res
-
-    del ifg
+                tcoh = multilook_array(tcoh_ds[0, row_1 * alks:row_2 * alks, col_1 * rlks:col_2 * rlks], alks, rlks)
+                mask, interpolator = get_interpolator(tcoh >= tcoh_threshold, method)
+                if interpolator is None:
+                    continue
+                yi, xi = np.where(~mask)
+
+                def fill_box(ifg_file):
+                    ifg = np.memmap(ifg_file, dtype=np.complex64, mode='r+', shape=(length, width))
+                    ifg_sub = np.array(ifg[row_1:row_2, col_1:col_2])
+                    phase = interpolate_phase(ifg_sub, mask, interpolator, method)
+                    ifg[yi + row_1, xi + col_1] = np.exp(1j * phase) * np.abs(ifg_sub[yi, xi])
+                    ifg.flush()
+                    del ifg
+                    return
+
+                if num_threads > 1 and len(filtifg) > 1:
+                    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                        list(executor.map(fill_box, filtifg))
+                else:
+                    for ifg_file in filtifg:
+                        fill_box(ifg_file)
     return
 
 
-def distance(point1,point2):
-    return sqrt((point1[0]-point2[0])**2 + (point1[1]-point2[1])**2)
+def get_interpolator(mask, method='linear'):
+    """ Interpolator of the coherent pixels (mask) of a box, depends only on the mask """
+    if mask.all() or not mask.any():
+        return mask, None
+
+    if method == 'linear':
+        from scipy.spatial import Delaunay
+        interpolator = Delaunay(np.column_stack(np.where(mask)))
+    elif method == 'nearest':
+        from scipy.ndimage import distance_transform_edt
+        # indices of the nearest coherent pixel of each pixel
+        indices = distance_transform_edt(~mask, return_distances=False, return_indices=True)
+        interpolator = (indices[0][~mask], indices[1][~mask])
+    elif method == 'kdtree':
+        from scipy.spatial import cKDTree
+        tree = cKDTree(np.column_stack(np.where(mask)))
+        ind = tree.query(np.column_stack(np.where(~mask)), k=1, workers=-1)[1]
+        y, x = np.where(mask)
+        interpolator = (y[ind], x[ind])
+    else:
+        interpolator = method
+    return mask, interpolator
+
+
+def interpolate_phase(ifg_sub, mask, interpolator, method='linear'):
+    """ Phase of the incoherent pixels (in the order of np.where(~mask)) from the coherent pixels """
+    if method == 'linear':
+        from scipy.interpolate import LinearNDInterpolator
+        func = LinearNDInterpolator(interpolator, np.angle(ifg_sub[mask]), fill_value=0)
+        return func(np.column_stack(np.where(~mask)))
+    elif method in ['nearest', 'kdtree']:
+        return np.angle(ifg_sub[interpolator[0], interpolator[1]])
+    return multiresolution_fill(ifg_sub, mask)[~mask]
+
+
+def multiresolution_fill(ifg_sub, mask):
+    """ Phase of the average unit phasor of the coherent pixels in blocks of 2, 4, 8 ... pixels,
+    each pixel takes the finest block that has coherent pixels """
+    length, width = mask.shape
+    phasor = np.zeros(mask.shape, dtype=np.complex64)
+    phasor[mask] = np.exp(1j * np.angle(ifg_sub[mask]))
+    phase = np.angle(phasor)
+    filled = mask.copy()
+    factor = 2
+    while not filled.all() and factor < 2 * max(length, width):
+        pad = ((0, -length % factor), (0, -width % factor))
+        shape = ((length + pad[0][1]) // factor, factor, (width + pad[1][1]) // factor, factor)
+        block_sum = np.pad(phasor, pad).reshape(shape).sum(axis=(1, 3))
+        block_count = np.pad(mask, pad).reshape(shape).sum(axis=(1, 3))
+        block_phase = np.repeat(np.repeat(np.angle(block_sum), factor, axis=0), factor, axis=1)[:length, :width]
+        block_valid = np.repeat(np.repeat(block_count > 0, factor, axis=0), factor, axis=1)[:length, :width]
+        update = block_valid & ~filled
+        phase[update] = block_phase[update]
+        filled |= update
+        factor *= 2
+    return phase
+
 
 def gaussianLP(D0,imgShape):
-    base = np.zeros(imgShape[:2])
+    # centered response exp(-d^2 / 2 D0^2), cached kernel of a spatial gaussian with sigma = N / (2 pi D0)
     rows, cols = imgShape[:2]
-    center = (rows/2,cols/2)
-    for x in range(cols):
-        for y in range(rows):
-            base[y,x] = exp(((-distance((y,x),center)**2)/(2*(D0**2))))
-    return base
+    kernel = gaussian_kernel((rows, cols), rows / (2 * np.pi * D0), cols / (2 * np.pi * D0))
+    return np.fft.fftshift(kernel)
 
 def gaussianHP(D0,imgShape):
-    base = np.zeros(imgShape[:2])
-    rows, cols = imgShape[:2]
-    center = (rows/2,cols/2)
-    for x in range(cols):
-        for y in range(rows):
-            base[y,x] = 1 - exp(((-distance((y,x),center)**2)/(2*(D0**2))))
-    return base
+    return 1 - gaussianLP(D0, imgShape)
 
 if __name__ == '__main__':
     main()
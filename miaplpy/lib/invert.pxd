@@ -14,6 +14,7 @@ cdef class CPhaseLink:
     cdef int range_window, azimuth_window, patch_size, n_image, width, length
     cdef int shp_size, mini_stack_default_size, num_box, total_num_mini_stacks
     cdef float distance_thresh
+    cdef float[::1] mini_stack_distance_thresh
     cdef bint sequential
     cdef dict metadata
     cdef list all_date_list
@@ -21,10 +22,14 @@ cdef class CPhaseLink:
     cdef int[::1] sample_rows, sample_cols
     cdef int reference_row, reference_col
     cdef float complex[:, :, ::1] patch_slc_images
-    cdef int ps_shp
-    cdef readonly list box_list
+    cdef int ps_shp, max_shp
+    cdef readonly int y_step, x_step, out_length, out_width
+    cdef readonly list box_list, empty_box_list, method_list
+    cdef readonly dict active_pixels
     cdef readonly bytes out_dir
     cdef readonly int time_lag
-    cdef bytes mask_file
+    cdef bytes mask_file, ps_candidate_file
+    cdef float ps_disp_thresh
+    cdef bint compact_output
 
 
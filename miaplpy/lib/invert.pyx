@@ -8,6 +8,8 @@ import utils as iut
 import os
 from libc.stdio cimport printf
 from miaplpy.objects.slcStack import slcStack
+from miaplpy.objects.utils import get_compact_dataset_kwargs, encode_compact, decode_dataset
+from mintpy.utils import readfile, attribute as attr
 import h5py
 import time
 from isce.components.isceobj.Util.ImageUtil import ImageLib as IML
@@ -29,7 +31,8 @@ cdef void write_wrapped(list date_list, bytes out_dir, int width, int length, by
     if not os.path.exists(out_name.decode('UTF-8')):
         fhandle = h5py.File(RSLCfile.decode('UTF-8'), 'r')
         out_rslc = np.memmap(out_name, dtype='complex64', mode='w+', shape=(length, width))
-        out_rslc[:, :] = fhandle['slc'][d, :, :]
+        out_rslc[:, :] = decode_dataset(fhandle['amplitude'], fhandle['amplitude'][d, :, :]) * \
+                         np.exp(1j * decode_dataset(fhandle['phase'], fhandle['phase'][d, :, :]))
         fhandle.close()
         IML.renderISCEXML(out_name.decode('UTF-8'), bands=1, nyy=length, nxx=width, datatype='complex64',
                           scheme='BSQ')
@@ -54,20 +57,26 @@ cdef class CPhaseLink:
 
     def __init__(self, object inps):
         cdef float alpha
+        cdef int i, num_lines
         self.inps = inps
         self.work_dir = inps.work_dir.encode('UTF-8')
         self.mask_file = inps.mask_file.encode('UTF-8')
         self.phase_linking_method = inps.inversion_method.encode('UTF-8')
+        self.method_list = self.phase_linking_method.split(b',')
+        if len(self.method_list) > 1 and b'sequential' in self.phase_linking_method:
+            raise ValueError('Sequential methods can not be combined with other inversion methods: '
+                             '{}'.format(inps.inversion_method))
         self.shp_test = inps.shp_test.encode('UTF-8')
         self.slc_stack = inps.slc_stack.encode('UTF-8')
         self.range_window = np.int32(inps.range_window)
         self.azimuth_window = np.int32(inps.azimuth_window)
         self.patch_size = np.int32(inps.patch_size)
         self.ps_shp = np.int32(inps.ps_shp)
+        self.max_shp = np.int32(inps.max_shp)
         self.out_dir = self.work_dir + b'/inverted'
         os.makedirs(self.out_dir.decode('UTF-8'), exist_ok='True')
 
-        self.slcStackObj = slcStack(inps.slc_stack)
+        self.slcStackObj = slcStack(inps.slc_stack, num_threads=inps.read_threads)
         self.metadata = self.slcStackObj.get_metadata()
         self.all_date_list = self.slcStackObj.get_date_list()
         with h5py.File(inps.slc_stack, 'r') as f:
@@ -75,19 +84,38 @@ cdef class CPhaseLink:
         self.n_image, self.length, self.width = self.slcStackObj.get_size()
         self.time_lag = inps.time_lag
 
+        # output grid: only every y_step-th row and x_step-th col is inverted
+        self.y_step = np.int32(inps.output_step[0])
+        if len(inps.output_step) > 1:
+            self.x_step = np.int32(inps.output_step[1])
+        else:
+            self.x_step = self.y_step
+        if inps.ps_only and self.y_step * self.x_step > 1:
+            print('Output step is not used in PS only mode, phase series is written in full resolution')
+            self.y_step = 1
+            self.x_step = 1
+        self.out_length = self.length // self.y_step
+        self.out_width = self.width // self.x_step
+
 
         # total number of neighbouring pixels
         self.shp_size = self.range_window * self.azimuth_window
 
+        if 0 < self.max_shp <= self.ps_shp:
+            raise ValueError('Maximum number of SHPs ({}) must be larger than the number of SHPs for PS candidates '
+                             '({})'.format(self.max_shp, self.ps_shp))
+
         # threshold for shp test based on number of images to test
         alpha = 0.01
         if self.shp_test == b'ks':
             self.distance_thresh = iut.ks_lut_cy(self.n_image, self.n_image, alpha)
+        elif self.shp_test in [b'glrt', b'cluster']:
+            self.distance_thresh = iut.glrt_lut_cy(self.n_image, alpha)
         else:
             self.distance_thresh = alpha
 
         # split the area in to patches of size 'self.patch_size'
-        self.box_list, self.num_box = self.patch_slice()
+        self.box_list, self.num_box, self.active_pixels, self.empty_box_list = self.patch_slice()
 
         # default number of images in each ministack
         self.mini_stack_default_size = inps.ministack_size
@@ -97,9 +125,26 @@ cdef class CPhaseLink:
         else:
             self.total_num_mini_stacks = 1
 
+        # thresholds for shp test on the dates of each ministack when streaming ministacks
+        self.mini_stack_distance_thresh = np.zeros(self.total_num_mini_stacks, dtype=np.float32)
+        for i in range(self.total_num_mini_stacks):
+            if i == self.total_num_mini_stacks - 1:
+                num_lines = self.n_image - i * self.mini_stack_default_size
+            else:
+                num_lines = self.mini_stack_default_size
+            if self.shp_test == b'ks':
+                self.mini_stack_distance_thresh[i] = iut.ks_lut_cy(num_lines, num_lines, alpha)
+            elif self.shp_test in [b'glrt', b'cluster']:
+                self.mini_stack_distance_thresh[i] = iut.glrt_lut_cy(num_lines, alpha)
+            else:
+                self.mini_stack_distance_thresh[i] = alpha
+
         self.window_for_shp()
 
         self.RSLCfile = self.out_dir + b'/phase_series.h5'
+        self.ps_candidate_file = self.out_dir + b'/psCandidates.h5'
+        self.ps_disp_thresh = inps.ps_disp_thresh
+        self.compact_output = inps.compact_output
 
 
         if b'sequential' == self.phase_linking_method[0:10]:
@@ -112,7 +157,10 @@ cdef class CPhaseLink:
         """
         Slice the image into patches of size patch_size
         box = (x0 y0 x1 y1) = (col0, row0, col1, row1) for each patch with respect to the whole image
-        Returns box list, number of boxes
+        If a mask is given, it is read once (one strip of patches at a time), patches with no active pixel are
+        dropped and the (row, col) indices of active pixels inside each partially masked patch are kept
+        in a dictionary with patch index as key (patches not in the dictionary are fully active)
+        Returns box list, number of boxes, active pixels dictionary, list of empty (fully masked) boxes
         -------
 
         """
@@ -122,14 +170,20 @@ cdef class CPhaseLink:
         cdef int[::1] patch_col_2 = np.arange(0, self.width - self.range_window, self.patch_size, dtype=np.int32) + self.patch_size
         cdef int i, t, index, nr = patch_row_1.shape[0]
         cdef int num_box, nc = patch_col_1.shape[0]
-        cdef list box_list = []
+        cdef list box_list = [], empty_box_list = []
+        cdef dict active_pixels = {}
         cdef cnp.ndarray[int, ndim=1] box #= np.arange(4, dtype=np.int32)
+        cdef cnp.ndarray[int, ndim=2] mask_strip, mask_box
+        cdef bint has_mask = os.path.exists(self.mask_file.decode('UTF-8'))
         patch_row_2[nr-1] = self.length
         patch_col_2[nc-1] = self.width
 
         num_box = nr * nc
         index = 0
         for i in range(nr):
+            if has_mask:
+                mask_strip = (readfile.read(self.mask_file.decode('UTF-8'),
+                                            box=(0, patch_row_1[i], self.width, patch_row_2[i]))[0] * 1).astype(np.int32)
             for t in range(nc):
                 box = np.arange(5, dtype=np.int32)
                 box[0] = patch_col_1[t]
@@ -137,10 +191,20 @@ cdef class CPhaseLink:
                 box[2] = patch_col_2[t]
                 box[3] = patch_row_2[i]
                 box[4] = index
-                box_list.append(box)
                 index += 1
+                if has_mask:
+                    mask_box = mask_strip[:, box[0]:box[2]]
+                    if not np.any(mask_box):
+                        empty_box_list.append(box)
+                        continue
+                    if not np.all(mask_box):
+                        active_pixels[box[4]] = np.ascontiguousarray(np.argwhere(mask_box), dtype=np.int32)
+                box_list.append(box)
+
+        if len(empty_box_list) > 0:
+            print('{} out of {} patches are fully masked and skipped'.format(len(empty_box_list), num_box))
 
-        return box_list, num_box
+        return box_list, num_box, active_pixels, empty_box_list
 
     def window_for_shp(self):
         """
@@ -158,10 +222,34 @@ cdef class CPhaseLink:
         return
 
 
-    def initiate_output(self):
+    def get_output_metadata(self):
+        """
+        Metadata of the outputs, updated for the output grid (LENGTH, WIDTH, A/RLOOKS, Y/X_STEP) if decimated
+        -------
+
+        """
+        if self.y_step * self.x_step > 1:
+            return attr.update_attribute4multilook(self.metadata, self.y_step, self.x_step, print_msg=False)
+        return dict(self.metadata)
+
+    def get_method_suffix(self, int k):
+        """
+        Suffix of the output files of the k-th inversion method, empty if a single method is inverted
+        -------
+
+        """
+        if len(self.method_list) > 1:
+            return b'_' + self.method_list[k]
+        return b''
+
+    def initiate_output(self, bytes rslc_file=None):
         cdef object RSLC, psf
+        cdef dict metadata
 
-        with h5py.File(self.RSLCfile.decode('UTF-8'), 'a') as RSLC:
+        if rslc_file is None:
+            rslc_file = self.RSLCfile
+
+        with h5py.File(rslc_file.decode('UTF-8'), 'a') as RSLC:
 
             if 'phase' in RSLC.keys():
                 RSLC['phase'].resize(self.n_image, 0)
@@ -170,35 +258,36 @@ cdef class CPhaseLink:
                 self.metadata['DATA_TYPE'] = 'float32'
                 self.metadata['data_type'] = 'FLOAT'
                 self.metadata['description'] = 'Inverted wrapped phase time series'
-                self.metadata['file_name'] = self.RSLCfile.decode('UTF-8')
+                self.metadata['file_name'] = rslc_file.decode('UTF-8')
                 self.metadata['family'] = 'wrappedphase'
 
-                for key, value in self.metadata.items():
+                metadata = self.get_output_metadata()
+                for key, value in metadata.items():
                     RSLC.attrs[key] = value
 
-                RSLC.create_dataset('phase',
-                                    shape=(self.n_image, self.length, self.width),
-                                    maxshape=(None, self.length, self.width),
-                                    chunks=True,
-                                    dtype=np.float32)
-
-                RSLC.create_dataset('amplitude',
-                                    shape=(self.n_image, self.length, self.width),
-                                    maxshape=(None, self.length, self.width),
-                                    chunks=True,
-                                    dtype=np.float32)
+                for dsName in ['phase', 'amplitude']:
+                    if self.compact_output:
+                        # quantized phase and amplitude, decoded by the readers with the dataset attributes
+                        kwargs, ds_attrs = get_compact_dataset_kwargs(dsName)
+                    else:
+                        kwargs, ds_attrs = {'chunks': True, 'dtype': np.float32}, {}
+                    RSLC.create_dataset(dsName,
+                                        shape=(self.n_image, self.out_length, self.out_width),
+                                        maxshape=(None, self.out_length, self.out_width),
+                                        **kwargs)
+                    RSLC[dsName].attrs.update(ds_attrs)
 
                 RSLC.create_dataset('shp',
-                                    shape=(self.length, self.width),
-                                    maxshape=(self.length, self.width),
+                                    shape=(self.out_length, self.out_width),
+                                    maxshape=(self.out_length, self.out_width),
                                     chunks=True,
                                     dtype=np.int32)
 
                 RSLC['shp'][:, :] = 1
 
                 RSLC.create_dataset('temporalCoherence',
-                                    shape=(2, self.length, self.width),
-                                    maxshape=(2, self.length, self.width),
+                                    shape=(2, self.out_length, self.out_width),
+                                    maxshape=(2, self.out_length, self.out_width),
                                     chunks=True,
                                     dtype=np.float32)
 
@@ -223,12 +312,13 @@ cdef class CPhaseLink:
                 self.metadata['file_name'] = mask_ps_file.decode('UTF-8')
                 self.metadata['family'] = 'PS mask'
 
-                for key, value in self.metadata.items():
+                metadata = self.get_output_metadata()
+                for key, value in metadata.items():
                     psf.attrs[key] = value
 
                 psf.create_dataset('mask',
-                                    shape=(self.length, self.width),
-                                    maxshape=(self.length, self.width),
+                                    shape=(self.out_length, self.out_width),
+                                    maxshape=(self.out_length, self.out_width),
                                     chunks=True,
                                     dtype=np.int32)
                 psf['mask'][:, :] = 0
@@ -245,6 +335,7 @@ cdef class CPhaseLink:
             "n_image" : self.n_image,
             "slcStackObj" : self.slcStackObj,
             "distance_threshold" : self.distance_thresh,
+            "mini_stack_distance_threshold" : np.array(self.mini_stack_distance_thresh),
             "def_sample_rows" : np.array(self.sample_rows),
             "def_sample_cols" : np.array(self.sample_cols),
             "reference_row" : self.reference_row,
@@ -253,10 +344,12 @@ cdef class CPhaseLink:
             "total_num_mini_stacks" : self.total_num_mini_stacks,
             "default_mini_stack_size" : self.mini_stack_default_size,
             'ps_shp': self.ps_shp,
+            "max_shp": self.max_shp,
+            "y_step": self.y_step,
+            "x_step": self.x_step,
             "shp_test": self.shp_test,
             "out_dir": self.out_dir,
             "time_lag": self.time_lag,
-            "mask_file": self.mask_file,
         }
         return data_kwargs
 
@@ -270,6 +363,7 @@ cdef class CPhaseLink:
         for box in box_list:
 
             data_kwargs['box'] = box
+            data_kwargs['active_pixels'] = self.active_pixels.get(box[4])
             os.makedirs(self.out_dir.decode('UTF-8') + '/PATCHES', exist_ok=True)
             iut.process_patch_c(**data_kwargs)
 
@@ -280,14 +374,14 @@ cdef class CPhaseLink:
     def unpatch(self):
         cdef list block
         cdef object fhandle, psf
-        cdef int index, box_length, box_width
+        cdef int k, index, box_length, box_width, row0, row1, col0, col1
         cdef cnp.ndarray[int, ndim=1] box
-        cdef bytes patch_dir
+        cdef bytes patch_dir, suffix, rslc_file
         cdef float complex[:, :, ::1] rslc_ref
-        cdef cnp.ndarray[float, ndim=3] temp_coh, ps_prod, eig_values = np.zeros((3, self.length, self.width), dtype=np.float32)
-        cdef cnp.ndarray[float, ndim=2] amp_disp = np.zeros((self.length, self.width), dtype=np.float32)
+        cdef cnp.ndarray[float, ndim=3] temp_coh, ps_prod, eig_values = np.zeros((3, self.out_length, self.out_width), dtype=np.float32)
+        cdef cnp.ndarray[float, ndim=2] amp_disp = np.zeros((self.out_length, self.out_width), dtype=np.float32)
 
-        if os.path.exists(self.RSLCfile.decode('UTF-8')):
+        if os.path.lexists(self.RSLCfile.decode('UTF-8')):
             print('Deleting old phase_series.h5 ...')
             os.remove(self.RSLCfile.decode('UTF-8'))
 
@@ -295,117 +389,308 @@ cdef class CPhaseLink:
         if os.path.exists(mask_ps_file.decode('UTF-8')):
             os.remove(mask_ps_file.decode('UTF-8'))
 
-        self.initiate_output()
-        print('Concatenate and write wrapped phase time series to HDF5 file phase_series.h5 ')
-        print('open  HDF5 file phase_series.h5 in a mode')
-
-        with h5py.File(self.RSLCfile.decode('UTF-8'), 'a') as fhandle:
-            
-            for index, box in enumerate(self.box_list):
-                box_width = box[2] - box[0]
-                box_length = box[3] - box[1]
-
-                patch_dir = self.out_dir + ('/PATCHES/PATCH_{:04.0f}'.format(index)).encode('UTF-8')
-                rslc_ref = np.load(patch_dir.decode('UTF-8') + '/phase_ref.npy', allow_pickle=True)
-                temp_coh = np.load(patch_dir.decode('UTF-8') + '/tempCoh.npy', allow_pickle=True)
-                shp = np.load(patch_dir.decode('UTF-8') + '/shp.npy', allow_pickle=True)
-                mask_ps = np.load(patch_dir.decode('UTF-8') + '/mask_ps.npy', allow_pickle=True)
-                ps_prod = np.load(patch_dir.decode('UTF-8') + '/ps_products.npy', allow_pickle=True)
-
-                temp_coh[temp_coh<0] = 0
-
-                print('-' * 50)
-                print("Concatenate block {}/{} : {}".format(index, self.num_box, box[0:4]))
-
-                # wrapped interferograms 3D
-                block = [0, self.n_image, box[1], box[3], box[0], box[2]]
-                #write_hdf5_block_3D(fhandle, rslc_ref, b'slc', block)
-                write_hdf5_block_3D(fhandle, np.angle(rslc_ref), b'phase', block)
-                write_hdf5_block_3D(fhandle, np.abs(rslc_ref), b'amplitude', block)
-
-                # SHP - 2D
-                block = [box[1], box[3], box[0], box[2]]
-                write_hdf5_block_2D_int(fhandle, shp, b'shp', block)
-                amp_disp[block[0]:block[1], block[2]:block[3]] = ps_prod[0, :, :]
-
-                # temporal coherence - 3D
-                block = [0, 2, box[1], box[3], box[0], box[2]]
-                write_hdf5_block_3D(fhandle, temp_coh, b'temporalCoherence', block)
-                eig_values[0:3, block[2]:block[3], block[4]:block[5]] = ps_prod[1:4, :, :]
-
-            print('write amplitude dispersion and top eigen values')
-            amp_disp_file = self.out_dir + b'/amp_dipersion_index'
-            if not os.path.exists(amp_disp_file.decode('UTF-8')):
-                amp_disp_memmap = np.memmap(amp_disp_file.decode('UTF-8'), mode='write', dtype='float32',
-                                           shape=(self.length, self.width))
-                IML.renderISCEXML(amp_disp_file.decode('UTF-8'), bands=1, nyy=self.length, nxx=self.width,
-                                  datatype='float32', scheme='BIL')
-            else:
-                amp_disp_memmap = np.memmap(amp_disp_file.decode('UTF-8'), mode='r+', dtype='float32',
-                                           shape=(self.length, self.width))
-
-            amp_disp_memmap[:, :] = amp_disp[:, :]
-            amp_disp_memmap = None
-
-            top_eig_files = self.out_dir + b'/top_eigenvalues'
-            if not os.path.exists(top_eig_files.decode('UTF-8')):
-                top_eig_memmap = np.memmap(top_eig_files.decode('UTF-8'), mode='write', dtype='float32',
-                                           shape=(3, self.length, self.width))
-                IML.renderISCEXML(top_eig_files.decode('UTF-8'), bands=3, nyy=self.length, nxx=self.width,
-                                  datatype='float32', scheme='BSQ')
-            else:
-                top_eig_memmap = np.memmap(top_eig_files.decode('UTF-8'), mode='r+', dtype='float32',
-                                           shape=(3, self.length, self.width))
-
-            print(top_eig_memmap.shape, np.array(eig_values).shape)
-            top_eig_memmap[0:3, :, :] = eig_values[:, :, :]
-            #top_eig_memmap[2, :, :] = eig_values[1, :, :]/eig_values[0, :, :]
-            rr, cc, kk = np.where(np.isnan(top_eig_memmap))
-            top_eig_memmap[:, rr, cc] = np.nan
-            top_eig_memmap = None
-
-            print('write averaged temporal coherence file from mini stacks')
-            temp_coh_file = self.out_dir + b'/tempCoh_average'
-
-            if not os.path.exists(temp_coh_file.decode('UTF-8')):
-                temp_coh_memmap = np.memmap(temp_coh_file.decode('UTF-8'), mode='write', dtype='float32',
-                                           shape=(self.length, self.width))
-                IML.renderISCEXML(temp_coh_file.decode('UTF-8'), bands=1, nyy=self.length, nxx=self.width,
-                                  datatype='float32', scheme='BIL')
-            else:
-                temp_coh_memmap = np.memmap(temp_coh_file.decode('UTF-8'), mode='r+', dtype='float32',
-                                           shape=(self.length, self.width))
-
-            temp_coh_memmap[:, :] = fhandle['temporalCoherence'][0, :, :]
-            temp_coh_memmap = None
-
-            print('write temporal coherence file from full stack')
-            temp_coh_file = self.out_dir + b'/tempCoh_full'
-
-            if not os.path.exists(temp_coh_file.decode('UTF-8')):
-                temp_coh_memmap = np.memmap(temp_coh_file.decode('UTF-8'), mode='write', dtype='float32',
-                                           shape=(self.length, self.width))
-                IML.renderISCEXML(temp_coh_file.decode('UTF-8'), bands=1, nyy=self.length, nxx=self.width,
-                                  datatype='float32', scheme='BIL')
-            else:
-                temp_coh_memmap = np.memmap(temp_coh_file.decode('UTF-8'), mode='r+', dtype='float32',
-                                           shape=(self.length, self.width))
-
-            temp_coh_memmap[:, :] = fhandle['temporalCoherence'][1, :, :]
-            temp_coh_memmap = None
-
-            print('close HDF5 file phase_series.h5.')
+        for k in range(len(self.method_list)):
+            suffix = self.get_method_suffix(k)
+            rslc_file = self.out_dir + b'/phase_series' + suffix + b'.h5'
+            if suffix and os.path.exists(rslc_file.decode('UTF-8')):
+                os.remove(rslc_file.decode('UTF-8'))
+
+            self.initiate_output(rslc_file)
+            print('Concatenate and write wrapped phase time series to HDF5 file {}'.format(
+                os.path.basename(rslc_file.decode('UTF-8'))))
+            print('open  HDF5 file {} in a mode'.format(os.path.basename(rslc_file.decode('UTF-8'))))
+
+            with h5py.File(rslc_file.decode('UTF-8'), 'a') as fhandle:
+
+                for box in self.box_list:
+                    index = box[4]
+                    # patch position in the output grid
+                    row0, row1 = iut.get_output_range_cy(box[1], box[3], self.y_step, self.length)
+                    col0, col1 = iut.get_output_range_cy(box[0], box[2], self.x_step, self.width)
+                    box_width = col1 - col0
+                    box_length = row1 - row0
+
+                    patch_dir = self.out_dir + ('/PATCHES/PATCH_{:04.0f}'.format(index)).encode('UTF-8')
+                    rslc_ref = np.load(patch_dir.decode('UTF-8') + '/phase_ref{}.npy'.format(suffix.decode('UTF-8')),
+                                       allow_pickle=True)
+                    temp_coh = np.load(patch_dir.decode('UTF-8') + '/tempCoh{}.npy'.format(suffix.decode('UTF-8')),
+                                       allow_pickle=True)
+                    shp = np.load(patch_dir.decode('UTF-8') + '/shp.npy', allow_pickle=True)
+                    ps_prod = np.load(patch_dir.decode('UTF-8') + '/ps_products.npy', allow_pickle=True)
+
+                    temp_coh[temp_coh<0] = 0
+
+                    print('-' * 50)
+                    print("Concatenate block {}/{} : {}".format(index, self.num_box, box[0:4]))
+
+                    # wrapped interferograms 3D
+                    block = [0, self.n_image, row0, row1, col0, col1]
+                    #write_hdf5_block_3D(fhandle, rslc_ref, b'slc', block)
+                    self.write_phase_amplitude(fhandle, np.angle(rslc_ref), np.abs(rslc_ref), block)
+
+                    # SHP - 2D
+                    block = [row0, row1, col0, col1]
+                    write_hdf5_block_2D_int(fhandle, shp, b'shp', block)
+                    amp_disp[block[0]:block[1], block[2]:block[3]] = ps_prod[0, :, :]
+
+                    # temporal coherence - 3D
+                    block = [0, 2, row0, row1, col0, col1]
+                    write_hdf5_block_3D(fhandle, temp_coh, b'temporalCoherence', block)
+                    eig_values[0:3, block[2]:block[3], block[4]:block[5]] = ps_prod[1:4, :, :]
+
+                for box in self.empty_box_list:
+                    # fully masked patches were not inverted
+                    self.write_masked_box(fhandle, box)
+
+                self.write_temp_coh_files(fhandle, suffix)
+
+                if k == 0:
+                    # SHPs and PS products are shared by all methods
+                    self.write_ps_products(amp_disp, eig_values)
+                    if suffix:
+                        # the first method is the default output of the following steps
+                        self.write_temp_coh_files(fhandle)
+
+                print('close HDF5 file {}.'.format(os.path.basename(rslc_file.decode('UTF-8'))))
+
+            if k == 0 and suffix:
+                os.symlink(os.path.basename(rslc_file.decode('UTF-8')), self.RSLCfile.decode('UTF-8'))
 
         print('write PS mask file')
 
         with h5py.File(mask_ps_file.decode('UTF-8'), 'a') as psf:
-           for index, box in enumerate(self.box_list):
+           for box in self.box_list:
+               index = box[4]
                patch_dir = self.out_dir + ('/PATCHES/PATCH_{:04.0f}'.format(index)).encode('UTF-8')
                mask_ps = np.load(patch_dir.decode('UTF-8') + '/mask_ps.npy', allow_pickle=True)
-               block = [box[1], box[3], box[0], box[2]]
+               row0, row1 = iut.get_output_range_cy(box[1], box[3], self.y_step, self.length)
+               col0, col1 = iut.get_output_range_cy(box[0], box[2], self.x_step, self.width)
+               block = [row0, row1, col0, col1]
                write_hdf5_block_2D_int(psf, mask_ps, b'mask', block)
 
         return
 
+    def write_masked_box(self, object fhandle, cnp.ndarray[int, ndim=1] box, float max_memory=0.5):
+        """
+        Writes a fully masked patch like the masked pixels of the inverted patches: phase referenced to the
+        first image, SHP = 1 and temporal coherence = 0.1, reading the slc stack in strips of lines
+        -------
+
+        """
+        cdef int row0, row1, col0, col1, r0, r1, num_rows
+        cdef object slc
+
+        row0, row1 = iut.get_output_range_cy(box[1], box[3], self.y_step, self.length)
+        col0, col1 = iut.get_output_range_cy(box[0], box[2], self.x_step, self.width)
+        if row1 <= row0 or col1 <= col0:
+            return
+
+        num_rows = int(max_memory * 1024 ** 3 / (self.n_image * (box[2] - box[0]) * 8 * self.y_step))
+        num_rows = max(1, num_rows)
+        for r0 in range(row0, row1, num_rows):
+            r1 = min(r0 + num_rows, row1)
+            # pixels on the output grid, as in process_patch_c
+            slc = self.slcStackObj.read(datasetName='slc',
+                                        box=(col0 * self.x_step + self.x_step // 2, r0 * self.y_step + self.y_step // 2,
+                                             (col1 - 1) * self.x_step + self.x_step // 2 + 1,
+                                             (r1 - 1) * self.y_step + self.y_step // 2 + 1), print_msg=False)
+            slc = slc.reshape(self.n_image, (r1 - r0 - 1) * self.y_step + 1,
+                              (col1 - col0 - 1) * self.x_step + 1)[:, ::self.y_step, ::self.x_step]
+            slc = slc * np.conj(slc[0:1, :, :])
+            self.write_phase_amplitude(fhandle, np.angle(slc), np.abs(slc), [0, self.n_image, r0, r1, col0, col1])
+            fhandle['shp'][r0:r1, col0:col1] = 1
+            fhandle['temporalCoherence'][:, r0:r1, col0:col1] = 0.1
+        return
 
+    def write_phase_amplitude(self, object fhandle, object phase, object amplitude, list block):
+        """
+        Writes a 3D block of phase and amplitude, quantized if the output is compact
+        -------
 
+        """
+        if self.compact_output:
+            fhandle['phase'][block[0]:block[1], block[2]:block[3], block[4]:block[5]] = encode_compact(phase, 'phase')
+            fhandle['amplitude'][block[0]:block[1], block[2]:block[3], block[4]:block[5]] = \
+                encode_compact(amplitude, 'amplitude')
+        else:
+            write_hdf5_block_3D(fhandle, np.ascontiguousarray(phase, dtype=np.float32), b'phase', block)
+            write_hdf5_block_3D(fhandle, np.ascontiguousarray(amplitude, dtype=np.float32), b'amplitude', block)
+        return
+
+    def write_ps_products(self, cnp.ndarray[float, ndim=2] amp_disp, cnp.ndarray[float, ndim=3] eig_values):
+
+        print('write amplitude dispersion and top eigen values')
+        amp_disp_file = self.out_dir + b'/amp_dipersion_index'
+        if not os.path.exists(amp_disp_file.decode('UTF-8')):
+            amp_disp_memmap = np.memmap(amp_disp_file.decode('UTF-8'), mode='write', dtype='float32',
+                                       shape=(self.out_length, self.out_width))
+            IML.renderISCEXML(amp_disp_file.decode('UTF-8'), bands=1, nyy=self.out_length, nxx=self.out_width,
+                              datatype='float32', scheme='BIL')
+        else:
+            amp_disp_memmap = np.memmap(amp_disp_file.decode('UTF-8'), mode='r+', dtype='float32',
+                                       shape=(self.out_length, self.out_width))
+
+        amp_disp_memmap[:, :] = amp_disp[:, :]
+        amp_disp_memmap = None
+
+        top_eig_files = self.out_dir + b'/top_eigenvalues'
+        if not os.path.exists(top_eig_files.decode('UTF-8')):
+            top_eig_memmap = np.memmap(top_eig_files.decode('UTF-8'), mode='write', dtype='float32',
+                                       shape=(3, self.out_length, self.out_width))
+            IML.renderISCEXML(top_eig_files.decode('UTF-8'), bands=3, nyy=self.out_length, nxx=self.out_width,
+                              datatype='float32', scheme='BSQ')
+        else:
+            top_eig_memmap = np.memmap(top_eig_files.decode('UTF-8'), mode='r+', dtype='float32',
+                                       shape=(3, self.out_length, self.out_width))
+
+        print(top_eig_memmap.shape, np.array(eig_values).shape)
+        top_eig_memmap[0:3, :, :] = eig_values[:, :, :]
+        #top_eig_memmap[2, :, :] = eig_values[1, :, :]/eig_values[0, :, :]
+        rr, cc, kk = np.where(np.isnan(top_eig_memmap))
+        top_eig_memmap[:, rr, cc] = np.nan
+        top_eig_memmap = None
+        return
+
+
+    def write_temp_coh_files(self, object fhandle, bytes suffix=b''):
+        cdef bytes temp_coh_file
+
+        print('write averaged temporal coherence file from mini stacks')
+        temp_coh_file = self.out_dir + b'/tempCoh_average' + suffix
+
+        if not os.path.exists(temp_coh_file.decode('UTF-8')):
+            temp_coh_memmap = np.memmap(temp_coh_file.decode('UTF-8'), mode='write', dtype='float32',
+                                       shape=(self.out_length, self.out_width))
+            IML.renderISCEXML(temp_coh_file.decode('UTF-8'), bands=1, nyy=self.out_length, nxx=self.out_width,
+                              datatype='float32', scheme='BIL')
+        else:
+            temp_coh_memmap = np.memmap(temp_coh_file.decode('UTF-8'), mode='r+', dtype='float32',
+                                       shape=(self.out_length, self.out_width))
+
+        temp_coh_memmap[:, :] = fhandle['temporalCoherence'][0, :, :]
+        temp_coh_memmap = None
+
+        print('write temporal coherence file from full stack')
+        temp_coh_file = self.out_dir + b'/tempCoh_full' + suffix
+
+        if not os.path.exists(temp_coh_file.decode('UTF-8')):
+            temp_coh_memmap = np.memmap(temp_coh_file.decode('UTF-8'), mode='write', dtype='float32',
+                                       shape=(self.out_length, self.out_width))
+            IML.renderISCEXML(temp_coh_file.decode('UTF-8'), bands=1, nyy=self.out_length, nxx=self.out_width,
+                              datatype='float32', scheme='BIL')
+        else:
+            temp_coh_memmap = np.memmap(temp_coh_file.decode('UTF-8'), mode='r+', dtype='float32',
+                                       shape=(self.out_length, self.out_width))
+
+        temp_coh_memmap[:, :] = fhandle['temporalCoherence'][1, :, :]
+        temp_coh_memmap = None
+        return
+
+    def get_row_blocks(self, float max_memory=0.5):
+        """
+        Split the image into blocks of full width lines so that all dates of a block fit in max_memory (GB)
+        Returns list of (row0, row1)
+        -------
+
+        """
+        cdef int row, num_rows
+        cdef list row_blocks = []
+
+        num_rows = int(max_memory * 1024 ** 3 / (self.n_image * self.width * 8))
+        num_rows = max(1, min(num_rows, self.length))
+        for row in range(0, self.length, num_rows):
+            row_blocks.append((row, min(row + num_rows, self.length)))
+        return row_blocks
+
+    def find_ps_candidates(self):
+        """
+        Compute the amplitude dispersion index and the mean amplitude of the whole scene reading
+        the slc stack once in blocks of lines, pixels with amplitude dispersion below the threshold
+        (and inside the inversion mask) are written as PS candidates
+        Returns PS candidate file name
+        -------
+
+        """
+        cdef int row0, row1
+        cdef dict metadata
+        cdef object psf
+        cdef cnp.ndarray[float, ndim=3] amplitude
+        cdef cnp.ndarray[float, ndim=2] mean_amp, amp_disp
+        cdef cnp.ndarray[int, ndim=2] candidates
+
+        if os.path.exists(self.ps_candidate_file.decode('UTF-8')):
+            os.remove(self.ps_candidate_file.decode('UTF-8'))
+
+        metadata = dict(self.metadata)
+        metadata['FILE_TYPE'] = 'mask'
+        metadata['DATA_TYPE'] = 'int32'
+        metadata['description'] = 'PS candidates from amplitude dispersion index'
+        metadata['file_name'] = self.ps_candidate_file.decode('UTF-8')
+        metadata['ps_dispersion_threshold'] = self.ps_disp_thresh
+
+        print('Find PS candidates with amplitude dispersion < {}'.format(self.ps_disp_thresh))
+        with h5py.File(self.ps_candidate_file.decode('UTF-8'), 'w') as psf:
+            for key, value in metadata.items():
+                psf.attrs[key] = value
+            for dsname, dtype in zip(['mask', 'amplitudeDispersion', 'meanAmplitude'], [np.int32, np.float32, np.float32]):
+                psf.create_dataset(dsname, shape=(self.length, self.width), chunks=True, dtype=dtype)
+
+            for row0, row1 in self.get_row_blocks():
+                amplitude = np.abs(self.slcStackObj.read(datasetName='slc', box=(0, row0, self.width, row1),
+                                                         print_msg=False)).reshape(self.n_image, row1 - row0,
+                                                                                   self.width).astype(np.float32)
+                mean_amp = np.mean(amplitude, axis=0)
+                amp_disp = np.std(amplitude, axis=0) / mean_amp
+                amp_disp[np.isnan(amp_disp)] = 1
+                amp_disp[amp_disp > 1] = 1
+
+                candidates = (amp_disp < self.ps_disp_thresh).astype(np.int32)
+                if os.path.exists(self.mask_file.decode('UTF-8')):
+                    candidates *= (readfile.read(self.mask_file.decode('UTF-8'),
+                                                 box=(0, row0, self.width, row1))[0] * 1).astype(np.int32)
+
+                psf['mask'][row0:row1, :] = candidates
+                psf['amplitudeDispersion'][row0:row1, :] = amp_disp
+                psf['meanAmplitude'][row0:row1, :] = mean_amp
+                print('lines {}-{}/{}: {} PS candidates'.format(row0, row1, self.length, np.sum(candidates)))
+
+        return self.ps_candidate_file
+
+    def invert_ps_only(self):
+        """
+        Write phase series and PS mask for the PS candidates only, no SHP search and no DS inversion.
+        The phase of each candidate is referenced to the first image and its temporal coherence is set to 1
+        """
+        cdef int row0, row1
+        cdef object fhandle, psf, cand_f
+        cdef cnp.ndarray[float complex, ndim=3] slc
+        cdef cnp.ndarray[int, ndim=2] candidates
+        cdef bytes mask_ps_file = self.work_dir + b'/maskPS.h5'
+
+        self.find_ps_candidates()
+
+        for out_file in [self.RSLCfile, mask_ps_file]:
+            if os.path.exists(out_file.decode('UTF-8')):
+                os.remove(out_file.decode('UTF-8'))
+        self.initiate_output()
+
+        print('Write phase series of PS candidates to {}'.format(self.RSLCfile.decode('UTF-8')))
+        with h5py.File(self.RSLCfile.decode('UTF-8'), 'a') as fhandle, \
+                h5py.File(mask_ps_file.decode('UTF-8'), 'a') as psf, \
+                h5py.File(self.ps_candidate_file.decode('UTF-8'), 'r') as cand_f:
+
+            for row0, row1 in self.get_row_blocks():
+                candidates = cand_f['mask'][row0:row1, :]
+                slc = self.slcStackObj.read(datasetName='slc', box=(0, row0, self.width, row1),
+                                            print_msg=False).reshape(self.n_image, row1 - row0, self.width)
+                slc[:, candidates == 0] = 0
+
+                self.write_phase_amplitude(fhandle, np.angle(slc * np.conj(slc[0:1, :, :])), np.abs(slc),
+                                           [0, self.n_image, row0, row1, 0, self.out_width])
+                fhandle['temporalCoherence'][:, row0:row1, :] = np.repeat(candidates[None, :, :], 2,
+                                                                          axis=0).astype(np.float32)
+                psf['mask'][row0:row1, :] = candidates
+
+            self.write_temp_coh_files(fhandle)
+
+        return
@@ -3,6 +3,13 @@ cimport cython
 
 ctypedef float float
 
+# phase linking estimators
+cdef enum:
+    PL_EVD = 0
+    PL_EMI = 1
+    PL_PTA = 2
+    PL_SBW = 3
+
 cdef bint isnanc(float complex)
 cdef cnp.ndarray[int, ndim=1] get_big_box_cy(cnp.ndarray[int, ndim=1], int, int, int, int)
 cdef float cargf_r(float complex)
@@ -36,7 +43,10 @@ cdef float sum1d(float[::1])
 cdef tuple test_PS_cy(float complex[:, ::1], float[::1])
 cdef float norm_complex(float complex[::1])
 cdef float complex[::1] squeeze_images(float complex[::1], float complex[:, ::1], cnp.intp_t)
+cdef int get_method_code_cy(bytes)
+cdef float complex[::1] estimate_phase_cy(float complex[:, ::1], float[:, ::1], int, int)
 cdef tuple phase_linking_process_cy(float complex[:, ::1], int, bytes, bint, int)
+cdef tuple phase_linking_methods_cy(float complex[:, ::1], int[::1], int)
 cpdef tuple phase_linking_process_py(float complex[:, ::1], int, bytes, bint, int)
 cpdef tuple sequential_phase_linking_py(float complex[:,::1], bytes, int, int)
 cdef tuple sequential_phase_linking_cy(float complex[:,::1], bytes, int, int)
@@ -46,10 +56,25 @@ cdef float searchsorted_max(cnp.ndarray[float, ndim=1], cnp.ndarray[float, ndim=
 cdef void sorting(cnp.ndarray[float, ndim=1])
 cdef float ecdf_distance(cnp.ndarray[float, ndim=1], cnp.ndarray[float, ndim=1])
 cdef float ks_lut_cy(int, int, float)
+cdef float glrt_lut_cy(int, float)
+cdef float[:, ::1] log_mean_intensity_cy(float complex[:, :, ::1])
+cdef float[:, ::1] cluster_amplitude_cy(float complex[:, :, ::1], int, float)
+cdef float[:, ::1] get_pixel_stats_c(float complex[:, :, ::1], bytes, float)
+cdef int pixel_stat_test_cy(bytes, float, float, float)
 cdef cnp.ndarray[float, ndim=1] concat_cy(cnp.ndarray[float, ndim=1], cnp.ndarray[float, ndim=1])
 cdef int count(cnp.ndarray[long, ndim=2], long)
+cdef int shp_test_pair_cy(cnp.ndarray[float, ndim=1], cnp.ndarray[float, ndim=1], float, bytes)
+cdef int[:, ::1] get_shp_spiral_c(float complex[:, :, ::1], cnp.ndarray[float, ndim=1], int[::1], int[::1], int, int,
+                                  float, bytes, float[:, ::1], int, signed char[:, ::1] distance=*)
 cdef int[:, ::1] get_shp_row_col_c((int, int), float complex[:, :, ::1], cnp.ndarray[int, ndim=1], cnp.ndarray[int, ndim=1],
-                                   int, int, int, int, float, bytes)
+                                   int, int, int, int, float, bytes, float[:, ::1], int)
+cdef float complex[:, :, ::1] read_mini_stack_c(object, list, cnp.ndarray[int, ndim=1])
+cdef void update_shp_distance_c((int, int), float complex[:, :, ::1], cnp.ndarray[int, ndim=1], cnp.ndarray[int, ndim=1],
+                                float, bytes, float[:, ::1], signed char[:, ::1])
+cdef int[:, ::1] select_shp_c((int, int), signed char[:, ::1], cnp.ndarray[int, ndim=1], cnp.ndarray[int, ndim=1],
+                              int, int, int)
+cdef (int, int) get_output_range_cy(int, int, int, int)
+cdef int[:, ::1] get_patch_coords_c(cnp.ndarray[int, ndim=1], cnp.ndarray[int, ndim=1], int[:, ::1], int, int, int, int)
 cdef float[::1] mean_along_axis_x(float[:, ::1])
 cdef float gam_pta_c(float[:, ::1], float complex[::1])
 cdef int ks2smapletest_cy(cnp.ndarray[float, ndim=1], cnp.ndarray[float, ndim=1], float)
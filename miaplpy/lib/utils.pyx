@@ -6,13 +6,16 @@ import numpy as np
 cimport numpy as cnp
 from scipy import linalg as LA
 from scipy.linalg import lapack as lap
-from libc.math cimport sqrt, exp, isnan
+from libc.math cimport sqrt, exp, log, fabs, isnan
 from scipy.optimize import minimize
 from skimage.measure._ccomp import label_cython as clabel
-from scipy.stats import anderson_ksamp, ttest_ind
+from scipy.stats import anderson_ksamp, ttest_ind, f as f_dist
 from mintpy.utils import ptime
-from mintpy.utils import readfile
 import time
+import heapq
+
+# number of amplitude clusters of each patch for the cluster SHP test
+cdef int NUM_SHP_CLUSTERS = 8
 
 
 cdef extern from "complex.h":
@@ -520,35 +523,48 @@ cdef inline tuple regularize_matrix_cy(float[:, ::1] M):
             t += 1
     return status, N
 
+cdef inline int get_method_code_cy(bytes method):
+    """ Returns the code of the phase linking estimator, sequential methods use the same estimator """
+    if method == b'EMI' or method == b'sequential_EMI':
+        return PL_EMI
+    elif method == b'PTA' or method == b'sequential_PTA':
+        return PL_PTA
+    elif method == b'SBW':
+        return PL_SBW
+    else:
+        return PL_EVD
+
+
+cdef inline float complex[::1] estimate_phase_cy(float complex[:, ::1] coh_mat, float[:, ::1] abscoh, int status,
+                                                 int method_code):
+    """ Runs the estimator of method_code, abscoh is the regularized absolute coherence (status 0 if it succeeded) """
+    if status == 0 and method_code == PL_EMI:
+        return EMI_phase_estimation_cy(coh_mat, abscoh)
+    elif status == 0 and (method_code == PL_PTA or method_code == PL_SBW):
+        return PTA_L_BFGS_cy(coh_mat, abscoh)
+    else:
+        return EVD_phase_estimation_cy(coh_mat)
+
+
 cdef inline tuple phase_linking_process_cy(float complex[:, ::1] ccg_sample, int stepp, bytes method, bint squeez, int lag):
     """Inversion of phase based on a selected method among PTA, EVD and EMI """
 
     cdef float complex[:, ::1] coh_mat
-    cdef float[:, ::1] abscoh
+    cdef float[:, ::1] abscoh = None
     cdef float complex[::1] res
     cdef cnp.intp_t n1 = ccg_sample.shape[1]
     cdef float complex[::1] squeezed
     cdef float quality
-    cdef int status
+    cdef int status = 1
+    cdef int method_code = get_method_code_cy(method)
 
     coh_mat = est_corr_cy(ccg_sample)
-    if method.decode('utf-8') == 'SBW':
+    if method_code == PL_SBW:
         coh_mat = mask_diag(coh_mat, lag)
 
-    if method.decode('utf-8') == 'PTA' or method.decode('utf-8') == 'sequential_PTA' or method.decode('utf-8')=='SBW':
-        status, abscoh = regularize_matrix_cy(absmat2(coh_mat))
-        if status == 0:
-            res = PTA_L_BFGS_cy(coh_mat, abscoh)
-        else:
-            res = EVD_phase_estimation_cy(coh_mat)
-    elif method.decode('utf-8') == 'EMI' or method.decode('utf-8') == 'sequential_EMI':
+    if method_code != PL_EVD:
         status, abscoh = regularize_matrix_cy(absmat2(coh_mat))
-        if status == 0:
-            res = EMI_phase_estimation_cy(coh_mat, abscoh)
-        else:
-            res = EVD_phase_estimation_cy(coh_mat)
-    else:
-        res = EVD_phase_estimation_cy(coh_mat)
+    res = estimate_phase_cy(coh_mat, abscoh, status, method_code)
 
     quality = gam_pta_c(angmat2(coh_mat), res)
 
@@ -560,6 +576,40 @@ cdef inline tuple phase_linking_process_cy(float complex[:, ::1] ccg_sample, int
         return res, 0, quality
 
 
+cdef tuple phase_linking_methods_cy(float complex[:, ::1] coh_mat, int[::1] method_codes, int lag):
+    """ Runs several estimators on the same coherence matrix, its regularization is computed once and shared
+    (SBW uses its own time lag masked matrix).
+    Returns list of phase vectors, temporal coherence and full stack temporal coherence of each method """
+
+    cdef float complex[:, ::1] coh_sbw = None
+    cdef float[:, ::1] ph_full, abscoh = None, abscoh_sbw = None
+    cdef float complex[::1] res
+    cdef int k, status = 1, status_sbw = 1
+    cdef int num_methods = method_codes.shape[0]
+    cdef list vectors = []
+    cdef float[::1] quality = np.zeros(num_methods, dtype=np.float32)
+    cdef float[::1] quality_full = np.zeros(num_methods, dtype=np.float32)
+
+    ph_full = angmat2(coh_mat)
+
+    for k in range(num_methods):
+        if method_codes[k] == PL_SBW:
+            if coh_sbw is None:
+                coh_sbw = mask_diag(coh_mat, lag)
+                status_sbw, abscoh_sbw = regularize_matrix_cy(absmat2(coh_sbw))
+            res = estimate_phase_cy(coh_sbw, abscoh_sbw, status_sbw, PL_SBW)
+            quality[k] = gam_pta_c(angmat2(coh_sbw), res)
+        else:
+            if method_codes[k] != PL_EVD and abscoh is None:
+                status, abscoh = regularize_matrix_cy(absmat2(coh_mat))
+            res = estimate_phase_cy(coh_mat, abscoh, status, method_codes[k])
+            quality[k] = gam_pta_c(ph_full, res)
+        quality_full[k] = gam_pta_c(ph_full, res)
+        vectors.append(res)
+
+    return vectors, quality, quality_full
+
+
 cpdef tuple phase_linking_process_py(float complex[:, ::1] ccg_sample, int stepp, bytes method, bint squeez, int lag):
     """Inversion of phase based on a selected method among PTA, EVD and EMI """
 
@@ -877,6 +927,101 @@ cdef inline float ks_lut_cy(int N1, int N2, float alpha):
     return critical_distance
 
 
+cdef inline float glrt_lut_cy(int N, float alpha):
+    """ Critical log ratio of the mean intensities of two pixels with N images each: under the null hypothesis
+    (same exponential intensity distribution) the ratio follows F(2N, 2N), two sided test at level alpha """
+    return log(f_dist.ppf(1 - alpha / 2, 2 * N, 2 * N))
+
+
+cdef float[:, ::1] log_mean_intensity_cy(float complex[:, :, ::1] input_slc):
+    """ Per pixel sufficient statistic of the GLRT, log of the mean intensity over the images of the
+    pixel-major patch (rows, cols, n_image), computed once per patch """
+    cdef cnp.intp_t length = input_slc.shape[0]
+    cdef cnp.intp_t width = input_slc.shape[1]
+    cdef cnp.intp_t n_image = input_slc.shape[2]
+    cdef float[:, ::1] out = np.zeros((length, width), dtype=np.float32)
+    cdef int i, t, m
+    cdef float value
+    for i in range(length):
+        for t in range(width):
+            value = 0
+            for m in range(n_image):
+                value += crealf(input_slc[i, t, m] * conjf(input_slc[i, t, m]))
+            value /= n_image
+            if value < 1e-30:
+                value = 1e-30
+            out[i, t] = log(value)
+    return out
+
+
+cdef float[:, ::1] cluster_amplitude_cy(float complex[:, :, ::1] input_slc, int num_clusters, float merge_threshold):
+    """ One k-means clustering of the pixels of the patch (rows, cols, n_image) on the quantiles of their sorted
+    log amplitude time series, returns the cluster label of each pixel.
+    Clusters whose mean log amplitudes differ by less than merge_threshold are merged """
+    cdef cnp.intp_t length = input_slc.shape[0]
+    cdef cnp.intp_t width = input_slc.shape[1]
+    cdef cnp.intp_t n_image = input_slc.shape[2]
+    cdef int it, k, num_pixels = length * width
+    cdef int num_quantiles = min(n_image, 9)
+    cdef cnp.ndarray[float, ndim=2] features, centers
+    cdef cnp.ndarray[long, ndim=1] labels, new_labels, counts, group
+    cdef cnp.ndarray[float, ndim=1] center_mean
+    cdef object quantile_index, order
+
+    num_clusters = min(num_clusters, num_pixels)
+    quantile_index = np.round(np.linspace(0, n_image - 1, num_quantiles)).astype(int)
+    features = np.sort(np.log(np.abs(np.asarray(input_slc)) + 1e-15), axis=2)[:, :, quantile_index].reshape(
+        num_pixels, num_quantiles).astype(np.float32)
+
+    # initial centers spread over the median of the features
+    order = np.argsort(features[:, num_quantiles // 2], kind='stable')
+    centers = features[order[np.round(np.linspace(0, num_pixels - 1, num_clusters)).astype(int)], :]
+    labels = np.zeros(num_pixels, dtype='long')
+
+    for it in range(20):
+        new_labels = np.argmin(np.sum((features[:, None, :] - centers[None, :, :]) ** 2, axis=2), axis=1).astype('long')
+        if it > 0 and np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+        counts = np.bincount(labels, minlength=num_clusters).astype('long')
+        for k in range(num_clusters):
+            if counts[k] > 0:
+                centers[k, :] = np.mean(features[labels == k, :], axis=0)
+
+    # k-means also splits homogeneous areas, clusters of statistically equal scale get the same label
+    center_mean = np.mean(centers, axis=1).astype(np.float32)
+    order = np.argsort(center_mean, kind='stable')
+    group = np.zeros(num_clusters, dtype='long')
+    for k in range(1, num_clusters):
+        if center_mean[order[k]] - center_mean[order[k - 1]] > merge_threshold:
+            group[order[k]] = group[order[k - 1]] + 1
+        else:
+            group[order[k]] = group[order[k - 1]]
+
+    return group[labels].reshape(length, width).astype(np.float32)
+
+
+cdef float[:, ::1] get_pixel_stats_c(float complex[:, :, ::1] input_slc, bytes shp_test, float distance_threshold):
+    """ Per pixel statistic computed once per patch for the SHP tests that compare pixels in O(1):
+    log mean intensity for glrt, cluster label for cluster. None for the two sample tests """
+    if shp_test == b'glrt':
+        return log_mean_intensity_cy(input_slc)
+    elif shp_test == b'cluster':
+        # distance_threshold is the critical log intensity ratio, half of it for log amplitudes
+        return cluster_amplitude_cy(input_slc, NUM_SHP_CLUSTERS, distance_threshold / 2)
+    return None
+
+
+cdef inline int pixel_stat_test_cy(bytes shp_test, float ref_stat, float test_stat, float threshold):
+    """ Compares the per pixel statistics of two pixels: generalized likelihood ratio test on the scale
+    of the intensities (glrt) or same cluster (cluster) """
+    if shp_test == b'cluster':
+        return ref_stat == test_stat
+    if fabs(ref_stat - test_stat) <= threshold:
+        return 1
+    return 0
+
+
 cdef cnp.ndarray[float, ndim=1] concat_cy(cnp.ndarray[float, ndim=1] x, cnp.ndarray[float, ndim=1] y):
     cdef int n1 = x.shape[0]
     cdef int n2 = y.shape[0]
@@ -900,14 +1045,111 @@ cdef int count(cnp.ndarray[long, ndim=2]  x, long value):
     return out
 
 
+cdef int shp_test_pair_cy(cnp.ndarray[float, ndim=1] ref, cnp.ndarray[float, ndim=1] test, float distance_threshold,
+                         bytes shp_test):
+    """ Runs the selected two sample test on sorted amplitudes, returns 1 if the samples are statistically homogeneous """
+    cdef int res
+    if shp_test == b'ad':
+        res = ADtest_cy(ref, test, distance_threshold)
+    elif shp_test == b'ttest':
+        res = ttest_indtest_cy(ref, test, distance_threshold)
+    else:
+        res = ks2smapletest_cy(ref, test, distance_threshold)
+    return res
+
+
+cdef int[:, ::1] get_shp_spiral_c(float complex[:, :, ::1] input_slc, cnp.ndarray[float, ndim=1] ref,
+                                  int[::1] sample_rows, int[::1] sample_cols, int ref_row, int ref_col,
+                                  float distance_threshold, bytes shp_test, float[:, ::1] pixel_stats,
+                                  int max_shp, signed char[:, ::1] distance=None):
+    """ Grows the SHP region from the reference pixel: neighbours (8-connectivity) of accepted pixels are queued
+    and tested once, the closest to the reference pixel first, until max_shp pixels are accepted.
+    Without the max_shp limit the region is the connected SHP region of the full window search.
+    distance holds the test results of the window if they are known (1 homogeneous, 0 not, -1 to be tested),
+    all neighbours are tested on input_slc if it is None """
+
+    cdef int i, k, t1, t2, r, c, num_shp
+    cdef int s_rows = sample_rows.shape[0]
+    cdef int s_cols = sample_cols.shape[0]
+    cdef cnp.intp_t n_image = 0
+    cdef cnp.ndarray[long, ndim=1] order
+    cdef long[::1] rank
+    cdef int[:, ::1] accepted = np.zeros((s_rows, s_cols), dtype=np.int32)
+    cdef signed char[:, ::1] queued = np.zeros((s_rows, s_cols), dtype=np.int8)
+    cdef list frontier = []
+    cdef int[:, ::1] shps
+    cdef signed char[:, ::1] tested = distance
+    cdef cnp.ndarray[float, ndim=1] test
+    cdef cnp.ndarray[long, ndim=2] dist2 = (np.arange(s_rows, dtype='long')[:, None] - ref_row) ** 2 + \
+                                           (np.arange(s_cols, dtype='long')[None, :] - ref_col) ** 2
+
+    # rank of each window position in order of distance, the frontier is a heap of (rank, position)
+    if tested is None:
+        tested = np.full((s_rows, s_cols), -1, dtype=np.int8)
+        n_image = input_slc.shape[2]
+
+    order = np.argsort(dist2.ravel(), kind='stable').astype('long')
+    rank = np.empty(order.shape[0], dtype='long')
+    for k in range(order.shape[0]):
+        rank[order[k]] = k
+
+    t1, t2 = ref_row, ref_col
+    accepted[t1, t2] = 1
+    queued[t1, t2] = 1
+    num_shp = 1
+
+    while True:
+        # queue the neighbours of the last accepted pixel
+        for r in range(max(t1 - 1, 0), min(t1 + 2, s_rows)):
+            for c in range(max(t2 - 1, 0), min(t2 + 2, s_cols)):
+                if queued[r, c] == 0:
+                    queued[r, c] = 1
+                    heapq.heappush(frontier, rank[r * s_cols + c])
+
+        while len(frontier) > 0 and num_shp < max_shp:
+            k = heapq.heappop(frontier)
+            t1 = order[k] // s_cols
+            t2 = order[k] % s_cols
+            if tested[t1, t2] == -1:
+                if pixel_stats is not None:
+                    i = pixel_stat_test_cy(shp_test, pixel_stats[sample_rows[ref_row], sample_cols[ref_col]],
+                                           pixel_stats[sample_rows[t1], sample_cols[t2]], distance_threshold)
+                else:
+                    test = np.zeros(n_image, dtype=np.float32)
+                    for i in range(n_image):
+                        test[i] = cabsf(input_slc[sample_rows[t1], sample_cols[t2], i])
+                    sorting(test)
+                    i = shp_test_pair_cy(ref, test, distance_threshold, shp_test)
+                tested[t1, t2] = i
+            if tested[t1, t2] == 1:
+                accepted[t1, t2] = 1
+                num_shp += 1
+                break
+        else:
+            break
+
+    shps = np.zeros((num_shp, 2), dtype=np.int32)
+    k = 0
+    for t1 in range(s_rows):
+        for t2 in range(s_cols):
+            if accepted[t1, t2] == 1:
+                shps[k, 0] = sample_rows[t1]
+                shps[k, 1] = sample_cols[t2]
+                k += 1
+    return shps
+
+
 cdef int[:, ::1] get_shp_row_col_c((int, int) data, float complex[:, :, ::1] input_slc,
                         cnp.ndarray[int, ndim=1] def_sample_rows, cnp.ndarray[int, ndim=1] def_sample_cols,
                         int azimuth_window, int range_window, int reference_row,
-                        int reference_col, float distance_threshold, bytes shp_test):
+                        int reference_col, float distance_threshold, bytes shp_test, float[:, ::1] pixel_stats,
+                        int max_shp):
+    """ Finds the SHPs of a pixel, input_slc is the pixel-major patch (rows, cols, n_image),
+    pixel_stats is the per pixel statistic of the glrt and cluster tests (None for the other tests) """
 
     cdef int row_0, col_0, i, temp, ref_row, ref_col, t1, t2, s_rows, s_cols
     cdef long ref_label
-    cdef cnp.intp_t width, length, n_image = input_slc.shape[0]
+    cdef cnp.intp_t width, length, n_image = input_slc.shape[2]
     cdef int[::1] sample_rows, sample_cols
     cdef cnp.ndarray[long, ndim=2] ks_label, distance
     cdef int[:, ::1] shps
@@ -916,8 +1158,8 @@ cdef int[:, ::1] get_shp_row_col_c((int, int) data, float complex[:, :, ::1] inp
 
     row_0 = data[0]
     col_0 = data[1]
-    length = input_slc.shape[1]
-    width = input_slc.shape[2]
+    length = input_slc.shape[0]
+    width = input_slc.shape[1]
     t1 = 0
     t2 = def_sample_rows.shape[0]
     for i in range(def_sample_rows.shape[0]):
@@ -950,17 +1192,30 @@ cdef int[:, ::1] get_shp_row_col_c((int, int) data, float complex[:, :, ::1] inp
     for i in range(s_cols):
         sample_cols[i] = col_0 + def_sample_cols[i + t1]
 
-    for i in range(n_image):
-        ref[i] = cabsf(input_slc[i, row_0, col_0])
-    sorting(ref)
+    if pixel_stats is None:
+        for i in range(n_image):
+            ref[i] = cabsf(input_slc[row_0, col_0, i])
+        sorting(ref)
+
+    if 0 < max_shp < s_rows * s_cols:
+        return get_shp_spiral_c(input_slc, ref, sample_rows, sample_cols, ref_row, ref_col,
+                                distance_threshold, shp_test, pixel_stats, max_shp)
+
     distance = np.zeros((s_rows, s_cols), dtype='long')
 
-    if shp_test == b'ad':
+    if pixel_stats is not None:
+        for t1 in range(s_rows):
+            for t2 in range(s_cols):
+                distance[t1, t2] = pixel_stat_test_cy(shp_test, pixel_stats[row_0, col_0],
+                                                      pixel_stats[sample_rows[t1], sample_cols[t2]],
+                                                      distance_threshold)
+
+    elif shp_test == b'ad':
         for t1 in range(s_rows):
             for t2 in range(s_cols):
                 test = np.zeros(n_image, dtype=np.float32)
                 for temp in range(n_image):
-                    test[temp] = cabsf(input_slc[temp, sample_rows[t1], sample_cols[t2]])
+                    test[temp] = cabsf(input_slc[sample_rows[t1], sample_cols[t2], temp])
                 sorting(test)
                 distance[t1, t2] = ADtest_cy(ref, test, distance_threshold)
 
@@ -969,7 +1224,7 @@ cdef int[:, ::1] get_shp_row_col_c((int, int) data, float complex[:, :, ::1] inp
             for t2 in range(s_cols):
                 test = np.zeros(n_image, dtype=np.float32)
                 for temp in range(n_image):
-                    test[temp] = cabsf(input_slc[temp, sample_rows[t1], sample_cols[t2]])
+                    test[temp] = cabsf(input_slc[sample_rows[t1], sample_cols[t2], temp])
                 sorting(test)
                 distance[t1, t2] = ttest_indtest_cy(ref, test, distance_threshold)
     else:
@@ -977,7 +1232,7 @@ cdef int[:, ::1] get_shp_row_col_c((int, int) data, float complex[:, :, ::1] inp
             for t2 in range(s_cols):
                 test = np.zeros(n_image, dtype=np.float32)
                 for temp in range(n_image):
-                    test[temp] = cabsf(input_slc[temp, sample_rows[t1], sample_cols[t2]])
+                    test[temp] = cabsf(input_slc[sample_rows[t1], sample_cols[t2], temp])
                 sorting(test)
                 distance[t1, t2] = ks2smapletest_cy(ref, test, distance_threshold)
 
@@ -1048,17 +1303,71 @@ cdef float complex[:, ::1] normalize_samples(float complex[:, ::1] X):
     return y
 
 
-def process_patch_c(cnp.ndarray[int, ndim=1] box, int range_window, int azimuth_window, int width, int length, int n_image,
+cdef inline (int, int) get_output_range_cy(int first, int last, int step, int size):
+    """ Returns the range of output grid indices covering the full resolution pixels [first, last),
+    output pixel i is the full resolution pixel i * step + step // 2 (center of the step x step block) """
+    cdef int i0 = (first - step // 2 + step - 1) // step
+    cdef int i1 = (last - step // 2 + step - 1) // step
+    if i1 > size // step:
+        i1 = size // step
+    if i1 < i0:
+        i1 = i0
+    return i0, i1
+
+
+cdef int[:, ::1] get_patch_coords_c(cnp.ndarray[int, ndim=1] box, cnp.ndarray[int, ndim=1] big_box,
+                                    int[:, ::1] active_pixels, int length, int width, int y_step, int x_step):
+    """ Returns (row, col) with respect to big box of the pixels to invert: the active pixels of box
+    lying on the output grid (all pixels of box when active_pixels is None and the steps are 1) """
+    cdef int row0, row1, col0, col1, i, t, r, c, m = 0
+    cdef int[:, ::1] coords
+
+    row0, row1 = get_output_range_cy(box[1], box[3], y_step, length)
+    col0, col1 = get_output_range_cy(box[0], box[2], x_step, width)
+
+    if active_pixels is None:
+        coords = np.zeros(((row1 - row0) * (col1 - col0), 2), dtype=np.int32)
+        for i in range(row0, row1):
+            for t in range(col0, col1):
+                coords[m, 0] = i * y_step + y_step // 2 - big_box[1]
+                coords[m, 1] = t * x_step + x_step // 2 - big_box[0]
+                m += 1
+    else:
+        coords = np.zeros((active_pixels.shape[0], 2), dtype=np.int32)
+        for i in range(active_pixels.shape[0]):
+            r = active_pixels[i, 0] + box[1] - y_step // 2
+            c = active_pixels[i, 1] + box[0] - x_step // 2
+            if r % y_step == 0 and c % x_step == 0 and row0 <= r // y_step < row1 and col0 <= c // x_step < col1:
+                coords[m, 0] = active_pixels[i, 0] + box[1] - big_box[1]
+                coords[m, 1] = active_pixels[i, 1] + box[0] - big_box[0]
+                m += 1
+
+    return coords[0:m, :]
+
+
+def process_patch_c(cnp.ndarray[int, ndim=1] box, int[:, ::1] active_pixels, int range_window, int azimuth_window,
+                    int width, int length, int n_image,
                     object slcStackObj, float distance_threshold, cnp.ndarray[int, ndim=1] def_sample_rows,
                     cnp.ndarray[int, ndim=1] def_sample_cols, int reference_row, int reference_col,
                     bytes phase_linking_method, int total_num_mini_stacks, int default_mini_stack_size,
-                    int ps_shp, bytes shp_test, bytes out_dir, int lag, bytes mask_file):
+                    int ps_shp, bytes shp_test, bytes out_dir, int lag, int max_shp=0, int y_step=1, int x_step=1):
 
     cdef cnp.ndarray[int, ndim=1] big_box = get_big_box_cy(box, range_window, azimuth_window, width, length)
-    cdef int box_width = box[2] - box[0]
-    cdef int box_length = box[3] - box[1]
-    cdef cnp.ndarray[float complex, ndim=3] rslc_ref = np.zeros((n_image, box_length, box_width), dtype=np.complex64)
-    cdef cnp.ndarray[float, ndim=3] tempCoh = np.zeros((2, box_length, box_width), dtype=np.float32)
+    cdef int out_row0, out_row1, out_col0, out_col1
+    out_row0, out_row1 = get_output_range_cy(box[1], box[3], y_step, length)
+    out_col0, out_col1 = get_output_range_cy(box[0], box[2], x_step, width)
+    cdef int box_width = out_col1 - out_col0
+    cdef int box_length = out_row1 - out_row0
+    # several comma separated methods share the SHPs and the coherence matrix of each pixel
+    cdef list method_list = phase_linking_method.split(b',')
+    cdef int k, num_methods = len(method_list)
+    cdef int[::1] method_codes = np.array([get_method_code_cy(x) for x in method_list], dtype=np.int32)
+    cdef list vectors
+    cdef float[::1] qualities, qualities_full
+    cdef bytes suffix
+    cdef cnp.ndarray[float complex, ndim=4] rslc_ref = np.zeros((num_methods, n_image, box_length, box_width),
+                                                                dtype=np.complex64)
+    cdef cnp.ndarray[float, ndim=4] tempCoh = np.zeros((num_methods, 2, box_length, box_width), dtype=np.float32)
     cdef cnp.ndarray[float, ndim=3] PSprod = np.zeros((4, box_length, box_width), dtype=np.float32)
     cdef cnp.ndarray[int, ndim=2] mask_ps = np.zeros((box_length, box_width), dtype=np.int32)
     cdef cnp.ndarray[int, ndim=2] SHP = np.zeros((box_length, box_width), dtype=np.int32)
@@ -1070,12 +1379,13 @@ def process_patch_c(cnp.ndarray[int, ndim=1] box, int range_window, int azimuth_
     cdef int overlap_length = row2 - row1
     cdef int[::1] sam = np.arange(col1, col2, dtype=np.int32)
     cdef int overlap_width = col2 - col1
-    cdef int[:, ::1] coords = np.zeros((overlap_length*overlap_width, 2), dtype=np.int32)
-    cdef int noval, num_points, num_shp, i, t, p, m = 0
+    cdef int[:, ::1] coords
+    cdef int noval, num_points, num_shp, i, t, p, oi, oj, m = 0
     cdef (int, int) data
     cdef int[:, ::1] shp
-    cdef cnp.ndarray[float complex, ndim=3] patch_slc_images = slcStackObj.read(datasetName='slc', box=big_box, print_msg=False)
+    cdef cnp.ndarray[float complex, ndim=3] patch_slc_images, slc_grid
     cdef float complex[:, ::1] CCG, coh_mat, squeezed_images
+    cdef float[:, ::1] pixel_stats = None
     cdef float complex[::1] vec, vec_refined = np.empty(n_image, dtype=np.complex64)
     cdef float[::1] amp_refined =  np.zeros(n_image, dtype=np.float32)
     cdef bint noise = False
@@ -1086,11 +1396,6 @@ def process_patch_c(cnp.ndarray[int, ndim=1] box, int range_window, int azimuth_
     cdef float time0 = time.time()
     cdef float complex x0
     cdef float mi, se, amp_disp, eigv1, eigv2
-    cdef int[:, ::1] mask = np.ones((box_length, box_width), dtype=np.int32)
-
-    if os.path.exists(mask_file.decode('UTF-8')):
-        mask = (readfile.read(mask_file.decode('UTF-8'),
-                              box=(box[0], box[1], box[2], box[3]))[0]*1).astype(np.int32)
 
     out_folder = out_dir + ('/PATCHES/PATCH_{:04.0f}'.format(index)).encode('UTF-8')
 
@@ -1098,96 +1403,442 @@ def process_patch_c(cnp.ndarray[int, ndim=1] box, int range_window, int azimuth_
     if os.path.exists(out_folder.decode('UTF-8') + '/flag.npy'):
         return
 
-    for i in range(overlap_length):
-        for t in range(overlap_width):
-            coords[m, 0] = i + row1
-            coords[m, 1] = t + col1
-            m += 1
-
-    num_points = m
+    # pixel-major layout (rows, cols, n_image): the time series of each pixel is contiguous in memory
+    patch_slc_images = np.ascontiguousarray(np.transpose(
+        slcStackObj.read(datasetName='slc', box=big_box, print_msg=False), (1, 2, 0)))
+    pixel_stats = get_pixel_stats_c(patch_slc_images, shp_test, distance_threshold)
+
+    if not active_pixels is None:
+        # masked pixels keep the phase referenced to the first image, only active pixels are inverted
+        slc_grid = patch_slc_images[np.ix_(np.arange(out_row0, out_row1) * y_step + y_step // 2 - big_box[1],
+                                           np.arange(out_col0, out_col1) * x_step + x_step // 2 - big_box[0])]
+        rslc_ref[:, :, :, :] = np.transpose(slc_grid * np.conj(slc_grid[:, :, 0:1]), (2, 0, 1))[None, :, :, :]
+        tempCoh[:, :, :, :] = 0.1
+        SHP[:, :] = 1
+
+    # only pixels on the output grid are inverted, SHPs and covariance use the full resolution
+    coords = get_patch_coords_c(box, big_box, active_pixels, length, width, y_step, x_step)
+    num_points = coords.shape[0]
     prog_bar = ptime.progressBar(maxValue=num_points)
     p = 0
     for i in range(num_points):
         ps = 0
         data = (coords[i,0], coords[i,1])
-        if mask[data[0] - row1, data[1] - col1]:
+        oi = (data[0] + big_box[1] - y_step // 2) // y_step - out_row0
+        oj = (data[1] + big_box[0] - x_step // 2) // x_step - out_col0
+
+        #num_shp = SHP[data[0] - row1, data[1] - col1]
+        #if num_shp == 0:
+        shp = get_shp_row_col_c(data, patch_slc_images, def_sample_rows, def_sample_cols, azimuth_window,
+                                range_window, reference_row, reference_col, distance_threshold, shp_test,
+                                pixel_stats, max_shp)
+        num_shp = shp.shape[0]
+        SHP[oi, oj] = num_shp
+        CCG = np.zeros((n_image, num_shp), dtype=np.complex64)
+        for t in range(num_shp):
+            for m in range(n_image):
+                CCG[m, t] = patch_slc_images[shp[t,0], shp[t,1], m]
 
-            #num_shp = SHP[data[0] - row1, data[1] - col1]
-            #if num_shp == 0:
-            shp = get_shp_row_col_c(data, patch_slc_images, def_sample_rows, def_sample_cols, azimuth_window,
-                                    range_window, reference_row, reference_col, distance_threshold, shp_test)
-            num_shp = shp.shape[0]
-            SHP[data[0] - row1, data[1] - col1] = num_shp
-            CCG = np.zeros((n_image, num_shp), dtype=np.complex64)
-            for t in range(num_shp):
-                for m in range(n_image):
-                    CCG[m, t] = patch_slc_images[m, shp[t,0], shp[t,1]]
-
-            coh_mat = est_corr_cy(CCG)
-            #temp_quality = 0
-            if num_shp <= ps_shp:
-                x0 = conjf(patch_slc_images[0, data[0], data[1]])
-
-                for m in range(n_image):
-                    vec_refined[m] = patch_slc_images[m, data[0], data[1]]  * x0
-                    amp_refined[m] = cabsf(patch_slc_images[m, data[0], data[1]])
-
-                temp_quality, vec, amp_disp, eigv1, eigv2, top_percent = test_PS_cy(coh_mat, amp_refined)
-                PSprod[0, data[0] - row1, data[1] - col1] = amp_disp
-                PSprod[1, data[0] - row1, data[1] - col1] = eigv1
-                PSprod[2, data[0] - row1, data[1] - col1] = eigv2
-                PSprod[3, data[0] - row1, data[1] - col1] = top_percent
-
-                if temp_quality == 1:
-                    mask_ps[data[0] - row1, data[1] - col1] = 1
-                else:
-                    vec_refined = vec
-                temp_quality_full = temp_quality
+        coh_mat = est_corr_cy(CCG)
+        #temp_quality = 0
+        if num_shp <= ps_shp:
+            x0 = conjf(patch_slc_images[data[0], data[1], 0])
+
+            for m in range(n_image):
+                vec_refined[m] = patch_slc_images[data[0], data[1], m]  * x0
+                amp_refined[m] = cabsf(patch_slc_images[data[0], data[1], m])
+
+            temp_quality, vec, amp_disp, eigv1, eigv2, top_percent = test_PS_cy(coh_mat, amp_refined)
+            PSprod[0, oi, oj] = amp_disp
+            PSprod[1, oi, oj] = eigv1
+            PSprod[2, oi, oj] = eigv2
+            PSprod[3, oi, oj] = top_percent
 
+            if temp_quality == 1:
+                mask_ps[oi, oj] = 1
             else:
+                vec_refined = vec
+            temp_quality_full = temp_quality
 
-                if len(phase_linking_method) > 10 and phase_linking_method[0:10] == b'sequential':
-                    vec_refined, squeezed_images, temp_quality = sequential_phase_linking_cy(CCG, phase_linking_method,
-                                                                               default_mini_stack_size,
-                                                                               total_num_mini_stacks)
+        else:
 
-                    vec_refined = datum_connect_cy(squeezed_images, vec_refined, default_mini_stack_size)
+            if len(phase_linking_method) > 10 and phase_linking_method[0:10] == b'sequential':
+                vec_refined, squeezed_images, temp_quality = sequential_phase_linking_cy(CCG, phase_linking_method,
+                                                                           default_mini_stack_size,
+                                                                           total_num_mini_stacks)
 
-                else:
-                    vec_refined, noval, temp_quality = phase_linking_process_cy(CCG, 0, phase_linking_method, False, lag)
+                vec_refined = datum_connect_cy(squeezed_images, vec_refined, default_mini_stack_size)
+
+            elif num_methods > 1:
+                vectors, qualities, qualities_full = phase_linking_methods_cy(coh_mat, method_codes, lag)
+                vec_refined = vectors[0]
+                temp_quality = qualities[0]
 
-                amp_refined = mean_along_axis_x(absmat2(CCG))
-                temp_quality_full = gam_pta_c(angmat2(coh_mat), vec_refined)
+            else:
+                vec_refined, noval, temp_quality = phase_linking_process_cy(CCG, 0, phase_linking_method, False, lag)
+
+            amp_refined = mean_along_axis_x(absmat2(CCG))
+            temp_quality_full = gam_pta_c(angmat2(coh_mat), vec_refined)
 
+        for k in range(num_methods):
+            if k > 0:
+                if num_shp > ps_shp:
+                    vec_refined = vectors[k]
+                    temp_quality = qualities[k]
+                    temp_quality_full = qualities_full[k]
 
             for m in range(n_image):
 
                 if m == 0:
-                    vec_refined[m] = amp_refined[m] + 0j
+                    rslc_ref[k, m, oi, oj] = amp_refined[m] + 0j
                 else:
-                    vec_refined[m] = amp_refined[m] * cexpf(1j * cargf(vec_refined[m]))
-
-                rslc_ref[m, data[0] - row1, data[1] - col1] = vec_refined[m]
+                    rslc_ref[k, m, oi, oj] = amp_refined[m] * cexpf(1j * cargf(vec_refined[m]))
 
             if temp_quality < 0:
                 temp_quality = 0
             if temp_quality_full < 0:
                 temp_quality_full = 0
-            tempCoh[0, data[0] - row1, data[1] - col1] = temp_quality         # Average temporal coherence from mini stacks
-            tempCoh[1, data[0] - row1, data[1] - col1] = temp_quality_full    # Full stack temporal coherence
-        else:
-            x0 = conjf(patch_slc_images[0, data[0], data[1]])
-            tempCoh[0, data[0] - row1, data[1] - col1] = 0.1    # Average temporal coherence from mini stacks
-            tempCoh[1, data[0] - row1, data[1] - col1] = 0.1    # Full stack temporal coherence
-            SHP[data[0] - row1, data[1] - col1] = 1
-            for m in range(n_image):
-                    rslc_ref[m, data[0] - row1, data[1] - col1] = patch_slc_images[m, data[0], data[1]]  * x0
-
+            tempCoh[k, 0, oi, oj] = temp_quality         # Average temporal coherence from mini stacks
+            tempCoh[k, 1, oi, oj] = temp_quality_full    # Full stack temporal coherence
 
         prog_bar.update(p + 1, every=500, suffix='{}/{} pixels, patch {}'.format(p + 1, num_points, index))
         p += 1
 
-    np.save(out_folder.decode('UTF-8') + '/phase_ref.npy', rslc_ref)
+    for k in range(num_methods):
+        if num_methods > 1:
+            suffix = b'_' + method_list[k]
+        else:
+            suffix = b''
+        np.save(out_folder.decode('UTF-8') + '/phase_ref{}.npy'.format(suffix.decode('UTF-8')), rslc_ref[k])
+        np.save(out_folder.decode('UTF-8') + '/tempCoh{}.npy'.format(suffix.decode('UTF-8')), tempCoh[k])
+    np.save(out_folder.decode('UTF-8') + '/shp.npy', SHP)
+    np.save(out_folder.decode('UTF-8') + '/mask_ps.npy', mask_ps)
+    np.save(out_folder.decode('UTF-8') + '/ps_products.npy', PSprod)
+    np.save(out_folder.decode('UTF-8') + '/flag.npy', [1])
+
+    mi, se = divmod(time.time()-time0, 60)
+    print('    Phase inversion of PATCH_{:04.0f} is Completed in {:02.0f} mins {:02.0f} secs\n'.format(index, mi, se))
+
+    return
+
+cdef float complex[:, :, ::1] read_mini_stack_c(object slcStackObj, list date_list, cnp.ndarray[int, ndim=1] big_box):
+    """ Reads the dates of one ministack inside big_box in pixel-major layout (rows, cols, n_image) """
+    cdef object data = slcStackObj.read(datasetName=date_list, box=big_box, print_msg=False)
+    data = data.reshape(len(date_list), big_box[3] - big_box[1], big_box[2] - big_box[0])
+    return np.ascontiguousarray(np.transpose(data, (1, 2, 0)))
+
+
+cdef void update_shp_distance_c((int, int) data, float complex[:, :, ::1] input_slc,
+                                cnp.ndarray[int, ndim=1] def_sample_rows, cnp.ndarray[int, ndim=1] def_sample_cols,
+                                float distance_threshold, bytes shp_test, float[:, ::1] pixel_stats,
+                                signed char[:, ::1] distance):
+    """ Tests the neighbours of a pixel on the dates of input_slc and keeps only those that are still homogeneous,
+    distance has the shape of the full window and is 0 for neighbours rejected before or outside of the patch """
+
+    cdef int i, t1, t2, r, c
+    cdef cnp.intp_t n_image = input_slc.shape[2]
+    cdef cnp.ndarray[float, ndim=1] ref = np.zeros(n_image, dtype=np.float32)
+    cdef cnp.ndarray[float, ndim=1] test
+
+    if pixel_stats is None:
+        for i in range(n_image):
+            ref[i] = cabsf(input_slc[data[0], data[1], i])
+        sorting(ref)
+
+    for t1 in range(def_sample_rows.shape[0]):
+        r = data[0] + def_sample_rows[t1]
+        for t2 in range(def_sample_cols.shape[0]):
+            if distance[t1, t2] == 0:
+                continue
+            c = data[1] + def_sample_cols[t2]
+            if pixel_stats is not None:
+                distance[t1, t2] = pixel_stat_test_cy(shp_test, pixel_stats[data[0], data[1]], pixel_stats[r, c],
+                                                      distance_threshold)
+                continue
+            test = np.zeros(n_image, dtype=np.float32)
+            for i in range(n_image):
+                test[i] = cabsf(input_slc[r, c, i])
+            sorting(test)
+            distance[t1, t2] = shp_test_pair_cy(ref, test, distance_threshold, shp_test)
+    return
+
+
+cdef int[:, ::1] select_shp_c((int, int) data, signed char[:, ::1] distance, cnp.ndarray[int, ndim=1] def_sample_rows,
+                              cnp.ndarray[int, ndim=1] def_sample_cols, int reference_row, int reference_col,
+                              int max_shp):
+    """ Returns the homogeneous neighbours connected to the reference pixel, if max_shp > 0 the region is grown
+    over distance from the reference pixel like get_shp_spiral_c until max_shp pixels are selected """
+
+    cdef cnp.ndarray[long, ndim=2] ks_label
+    cdef object rows, cols
+    cdef int[:, ::1] shps
+
+    if max_shp > 0:
+        return get_shp_spiral_c(None, None, (data[0] + def_sample_rows).astype(np.int32),
+                                (data[1] + def_sample_cols).astype(np.int32), reference_row, reference_col,
+                                0, b'', None, max_shp, distance)
+
+    ks_label = clabel(np.asarray(distance, dtype='long'), connectivity=2)
+    rows, cols = np.nonzero(ks_label == ks_label[reference_row, reference_col])
+    shps = np.ascontiguousarray(np.stack((data[0] + def_sample_rows[rows], data[1] + def_sample_cols[cols]), axis=1),
+                                dtype=np.int32)
+    return shps
+
+
+def process_patch_stream_c(cnp.ndarray[int, ndim=1] box, int[:, ::1] active_pixels, int range_window,
+                           int azimuth_window, int width, int length, int n_image, object slcStackObj,
+                           cnp.ndarray[float, ndim=1] mini_stack_distance_threshold,
+                           cnp.ndarray[int, ndim=1] def_sample_rows, cnp.ndarray[int, ndim=1] def_sample_cols,
+                           int reference_row, int reference_col, bytes phase_linking_method,
+                           int total_num_mini_stacks, int default_mini_stack_size, int ps_shp, bytes shp_test,
+                           bytes out_dir, int max_shp=0, int y_step=1, int x_step=1):
+    """ Sequential phase linking of a patch reading one ministack of dates at a time.
+    First pass: neighbours have to pass the SHP test on every ministack.
+    Second pass: each ministack is linked together with the squeezed images of the previous ones, the phase series
+    is written to disk ministack by ministack and only the squeezed images are kept in memory. The samples of PS
+    candidates (num_shp <= ps_shp) are kept for all dates instead.
+    The datum connection is applied at the end, PS candidates are tested and inverted as in process_patch_c. """
+
+    cdef cnp.ndarray[int, ndim=1] big_box = get_big_box_cy(box, range_window, azimuth_window, width, length)
+    cdef int out_row0, out_row1, out_col0, out_col1
+    out_row0, out_row1 = get_output_range_cy(box[1], box[3], y_step, length)
+    out_col0, out_col1 = get_output_range_cy(box[0], box[2], x_step, width)
+    cdef int box_width = out_col1 - out_col0
+    cdef int box_length = out_row1 - out_row0
+    cdef object grid_rows = np.arange(out_row0, out_row1) * y_step + y_step // 2 - big_box[1]
+    cdef object grid_cols = np.arange(out_col0, out_col1) * x_step + x_step // 2 - big_box[0]
+    cdef int big_length = big_box[3] - big_box[1]
+    cdef int big_width = big_box[2] - big_box[0]
+    cdef cnp.ndarray[float, ndim=3] tempCoh = np.zeros((2, box_length, box_width), dtype=np.float32)
+    cdef cnp.ndarray[float, ndim=3] PSprod = np.zeros((4, box_length, box_width), dtype=np.float32)
+    cdef cnp.ndarray[int, ndim=2] mask_ps = np.zeros((box_length, box_width), dtype=np.int32)
+    cdef cnp.ndarray[int, ndim=2] SHP = np.zeros((box_length, box_width), dtype=np.int32)
+    cdef int[:, ::1] coords
+    cdef int num_points, num_shp, i, t, p, r, c, sstep, first_line, last_line, num_lines
+    cdef (int, int) data
+    cdef int[:, ::1] shp
+    cdef int[::1] linked
+    cdef signed char[:, :, ::1] distance
+    cdef float complex[:, :, ::1] patch_slc_images
+    cdef float[:, ::1] pixel_stats = None
+    cdef float complex[:, ::1] CCG, squeezed_images
+    cdef float complex[::1] res, squeezed_0, shift
+    cdef float complex[::1] ones = np.ones(total_num_mini_stacks, dtype=np.complex64)
+    cdef float[::1] amp, quality
+    cdef int[::1] candidate
+    cdef float complex[::1] vec, pixel
+    cdef float complex x0
+    cdef float temp_quality, amp_disp, eigv1, eigv2, top_percent
+    cdef cnp.ndarray[float complex, ndim=2] slc_ref_conj
+    cdef cnp.ndarray[int, ndim=2] linked_map = np.zeros((box_length, box_width), dtype=np.int32)
+    cdef cnp.ndarray[float complex, ndim=3] block
+    cdef cnp.ndarray[float complex, ndim=3] ministack_shift
+    cdef list date_list = slcStackObj.get_date_list()
+    cdef list shp_list = []
+    cdef list squeezed_list = []
+    cdef list ps_ccg_list = []
+    cdef list ps_pixel_list = []
+    cdef object rslc_ref, prog_bar
+    cdef bytes out_folder
+    cdef int index = box[4]
+    cdef float time0 = time.time()
+    cdef float mi, se
+
+    out_folder = out_dir + ('/PATCHES/PATCH_{:04.0f}'.format(index)).encode('UTF-8')
+
+    os.makedirs(out_folder.decode('UTF-8'), exist_ok=True)
+    if os.path.exists(out_folder.decode('UTF-8') + '/flag.npy'):
+        return
+
+    if not active_pixels is None:
+        tempCoh[:, :, :] = 0.1
+        SHP[:, :] = 1
+    coords = get_patch_coords_c(box, big_box, active_pixels, length, width, y_step, x_step)
+    num_points = coords.shape[0]
+
+    distance = np.zeros((num_points, def_sample_rows.shape[0], def_sample_cols.shape[0]), dtype=np.int8)
+    for p in range(num_points):
+        for i in range(def_sample_rows.shape[0]):
+            r = coords[p, 0] + def_sample_rows[i]
+            for t in range(def_sample_cols.shape[0]):
+                c = coords[p, 1] + def_sample_cols[t]
+                if 0 <= r < big_length and 0 <= c < big_width:
+                    distance[p, i, t] = 1
+
+    candidate = np.zeros(num_points, dtype=np.int32)
+    quality = np.zeros(num_points, dtype=np.float32)
+    linked = np.zeros(num_points, dtype=np.int32)
+
+    # first pass: SHPs
+    prog_bar = ptime.progressBar(maxValue=total_num_mini_stacks)
+    for sstep in range(total_num_mini_stacks):
+        first_line = sstep * default_mini_stack_size
+        if sstep == total_num_mini_stacks - 1:
+            last_line = n_image
+        else:
+            last_line = first_line + default_mini_stack_size
+        num_lines = last_line - first_line
+
+        patch_slc_images = read_mini_stack_c(slcStackObj, date_list[first_line:last_line], big_box)
+        pixel_stats = get_pixel_stats_c(patch_slc_images, shp_test, mini_stack_distance_threshold[sstep])
+        if sstep == 0:
+            slc_ref_conj = np.conj(np.asarray(patch_slc_images)[np.ix_(grid_rows, grid_cols, [0])][:, :, 0])
+
+        for p in range(num_points):
+            data = (coords[p, 0], coords[p, 1])
+            update_shp_distance_c(data, patch_slc_images, def_sample_rows, def_sample_cols,
+                                  mini_stack_distance_threshold[sstep], shp_test, pixel_stats, distance[p])
+
+        prog_bar.update(sstep + 1, every=1, suffix='SHP ministack {}/{}, patch {}'.format(sstep + 1,
+                                                                                     total_num_mini_stacks, index))
+
+    for p in range(num_points):
+        data = (coords[p, 0], coords[p, 1])
+        r = (data[0] + big_box[1] - y_step // 2) // y_step - out_row0
+        c = (data[1] + big_box[0] - x_step // 2) // x_step - out_col0
+        shp = select_shp_c(data, distance[p], def_sample_rows, def_sample_cols, reference_row, reference_col,
+                           max_shp)
+        num_shp = shp.shape[0]
+        SHP[r, c] = num_shp
+        shp_list.append(shp)
+        squeezed_list.append(None)
+
+        if num_shp <= ps_shp:
+            # PS candidates need the coherence matrix of all dates for the test of process_patch_c
+            candidate[p] = 1
+            ps_ccg_list.append(np.zeros((n_image, num_shp), dtype=np.complex64))
+            ps_pixel_list.append(np.zeros(n_image, dtype=np.complex64))
+            continue
+        ps_ccg_list.append(None)
+        ps_pixel_list.append(None)
+
+        linked[p] = 1
+        linked_map[r, c] = 1
+        squeezed_list[p] = np.zeros((total_num_mini_stacks, num_shp), dtype=np.complex64)
+    distance = None
+
+    # second pass: sequential phase linking, one ministack at a time
+    rslc_ref = np.lib.format.open_memmap(out_folder.decode('UTF-8') + '/phase_ref.npy', mode='w+',
+                                         dtype=np.complex64, shape=(n_image, box_length, box_width))
+    prog_bar = ptime.progressBar(maxValue=total_num_mini_stacks)
+    for sstep in range(total_num_mini_stacks):
+        first_line = sstep * default_mini_stack_size
+        if sstep == total_num_mini_stacks - 1:
+            last_line = n_image
+        else:
+            last_line = first_line + default_mini_stack_size
+        num_lines = last_line - first_line
+
+        patch_slc_images = read_mini_stack_c(slcStackObj, date_list[first_line:last_line], big_box)
+
+        # masked pixels keep the phase referenced to the first image
+        block = np.ascontiguousarray(np.transpose(np.asarray(patch_slc_images)[np.ix_(grid_rows, grid_cols)] *
+                                                  slc_ref_conj[:, :, None], (2, 0, 1)))
+
+        for p in range(num_points):
+            data = (coords[p, 0], coords[p, 1])
+            if candidate[p] == 1:
+                shp = shp_list[p]
+                CCG = ps_ccg_list[p]
+                pixel = ps_pixel_list[p]
+                for i in range(num_lines):
+                    pixel[first_line + i] = patch_slc_images[data[0], data[1], i]
+                    for t in range(shp.shape[0]):
+                        CCG[first_line + i, t] = patch_slc_images[shp[t, 0], shp[t, 1], i]
+                continue
+            if linked[p] == 0:
+                continue
+            r = (data[0] + big_box[1] - y_step // 2) // y_step - out_row0
+            c = (data[1] + big_box[0] - x_step // 2) // x_step - out_col0
+            shp = shp_list[p]
+            num_shp = shp.shape[0]
+            squeezed_images = squeezed_list[p]
+
+            CCG = np.zeros((sstep + num_lines, num_shp), dtype=np.complex64)
+            for t in range(num_shp):
+                for i in range(sstep):
+                    CCG[i, t] = squeezed_images[i, t]
+                for i in range(num_lines):
+                    CCG[sstep + i, t] = patch_slc_images[shp[t, 0], shp[t, 1], i]
+
+            res, squeezed_0, temp_quality = phase_linking_process_cy(CCG, sstep, phase_linking_method, True, 0)
+            quality[p] += temp_quality
+
+            for t in range(num_shp):
+                squeezed_images[sstep, t] = squeezed_0[t]
+
+            amp = mean_along_axis_x(absmat2(CCG[sstep:, :]))
+            for i in range(num_lines):
+                block[i, r, c] = amp[i] * cexpf(1j * cargf(res[sstep + i]))
+
+        rslc_ref[first_line:last_line, :, :] = block
+        prog_bar.update(sstep + 1, every=1, suffix='phase linking ministack {}/{}, patch {}'.format(
+            sstep + 1, total_num_mini_stacks, index))
+
+    # datum connection of the ministacks
+    ministack_shift = np.ones((total_num_mini_stacks, box_length, box_width), dtype=np.complex64)
+    for p in range(num_points):
+        if linked[p] == 0:
+            continue
+        r = (coords[p, 0] + big_box[1] - y_step // 2) // y_step - out_row0
+        c = (coords[p, 1] + big_box[0] - x_step // 2) // x_step - out_col0
+        shift = datum_connect_cy(squeezed_list[p], ones, 1)
+        for sstep in range(total_num_mini_stacks):
+            ministack_shift[sstep, r, c] = shift[sstep]
+
+        temp_quality = quality[p] / total_num_mini_stacks
+        if temp_quality < 0:
+            temp_quality = 0
+        # the full stack coherence needs all dates at once, the average of the ministacks is used instead
+        tempCoh[0, r, c] = temp_quality
+        tempCoh[1, r, c] = temp_quality
+
+    for sstep in range(total_num_mini_stacks):
+        first_line = sstep * default_mini_stack_size
+        if sstep == total_num_mini_stacks - 1:
+            last_line = n_image
+        else:
+            last_line = first_line + default_mini_stack_size
+        block = np.asarray(rslc_ref[first_line:last_line, :, :]) * ministack_shift[sstep:sstep + 1, :, :]
+        if sstep == 0:
+            # the first image is the reference of the linked phase
+            block[0, :, :] = np.where(linked_map == 1, np.abs(block[0, :, :]), block[0, :, :])
+        rslc_ref[first_line:last_line, :, :] = block
+
+    # PS test on the coherence matrix of all dates, PS keep the phase referenced to the first image
+    # and the other candidates take the EVD phase, as in process_patch_c
+    amp = np.zeros(n_image, dtype=np.float32)
+    for p in range(num_points):
+        if candidate[p] == 0:
+            continue
+        r = (coords[p, 0] + big_box[1] - y_step // 2) // y_step - out_row0
+        c = (coords[p, 1] + big_box[0] - x_step // 2) // x_step - out_col0
+        pixel = ps_pixel_list[p]
+        for i in range(n_image):
+            amp[i] = cabsf(pixel[i])
+        temp_quality, vec, amp_disp, eigv1, eigv2, top_percent = test_PS_cy(est_corr_cy(ps_ccg_list[p]), amp)
+        PSprod[0, r, c] = amp_disp
+        PSprod[1, r, c] = eigv1
+        PSprod[2, r, c] = eigv2
+        PSprod[3, r, c] = top_percent
+
+        if temp_quality == 1:
+            mask_ps[r, c] = 1
+            x0 = conjf(pixel[0])
+            for i in range(n_image):
+                vec[i] = pixel[i] * x0
+        if temp_quality < 0:
+            temp_quality = 0
+        tempCoh[0, r, c] = temp_quality
+        tempCoh[1, r, c] = temp_quality
+
+        rslc_ref[0, r, c] = amp[0] + 0j
+        for i in range(1, n_image):
+            rslc_ref[i, r, c] = amp[i] * cexpf(1j * cargf(vec[i]))
+        ps_ccg_list[p] = None
+    rslc_ref.flush()
+    rslc_ref = None
+
     np.save(out_folder.decode('UTF-8') + '/shp.npy', SHP)
     np.save(out_folder.decode('UTF-8') + '/tempCoh.npy', tempCoh)
     np.save(out_folder.decode('UTF-8') + '/mask_ps.npy', mask_ps)
@@ -1199,6 +1850,7 @@ def process_patch_c(cnp.ndarray[int, ndim=1] box, int range_window, int azimuth_
 
     return
 
+
 cdef int ks2smapletest_cy(cnp.ndarray[float, ndim=1] S1, cnp.ndarray[float, ndim=1] S2, float threshold):
     cdef int res
     cdef float distance = ecdf_distance(S1, S2)
@@ -335,6 +335,29 @@ def get_extra_metadata(inpsDict):
     return extraDict
 
 
+def check_unwrapped_stack(stack_file, stackObj, inpsDict):
+    """Check if the ifgramStack file written by the unwrap step (miaplpy.unwrap.writeStack with
+    miaplpy.unwrap.pool) holds the unwrapped pairs on disk in full resolution, so loading can be skipped"""
+    if not (inpsDict.get('miaplpy.unwrap.writeStack', False) and inpsDict.get('miaplpy.unwrap.pool', False)):
+        return False
+    if not os.path.isfile(stack_file):
+        return False
+
+    stack_obj = ifgramStack(stack_file)
+    stack_obj.open(print_msg=False)
+    msg = None
+    if inpsDict['xstep'] != 1 or inpsDict['ystep'] != 1:
+        msg = 'multilook by xstep/ystep is not applied to the stack written by the unwrap step'
+    elif (stack_obj.length, stack_obj.width) != tuple(stackObj.get_size()[1:]):
+        msg = 'size of {} is different from the interferograms'.format(stack_file)
+    elif sorted(stack_obj.get_date12_list(dropIfgram=True)) != sorted(stackObj.get_date12_list()):
+        msg = 'pairs of {} are different from the unwrapped interferograms'.format(stack_file)
+    if msg:
+        print('WARNING: {}, load the interferograms again'.format(msg))
+        return False
+    return True
+
+
 #################################################################
 def main(iargs=None):
     inps = cmd_line_parse(iargs)
@@ -383,9 +406,14 @@ def main(iargs=None):
         print('create directory: {}'.format(inps.outdir))
     # write
 
-    if stackObj and mld.run_or_skip(inps.outfile[0], stackObj, box,
-                                     updateMode=updateMode, xstep=inpsDict['xstep'],
-                                     ystep=inpsDict['ystep']):
+    if stackObj and check_unwrapped_stack(inps.outfile[0], stackObj, inpsDict):
+        # interferograms are written to the stack by the unwrap step, only the metadata and geometry are loaded
+        print('-' * 50)
+        print('{} written by the unwrap step, skip loading the interferograms'.format(inps.outfile[0]))
+
+    elif stackObj and mld.run_or_skip(inps.outfile[0], stackObj, box,
+                                       updateMode=updateMode, xstep=inpsDict['xstep'],
+                                       ystep=inpsDict['ystep']):
         print('-'*50)
         stackObj.write2hdf5(outputFile=inps.outfile[0],
                             access_mode='w',
@@ -319,6 +319,23 @@ class miaplpyTimeSeriesAnalysis(TimeSeriesAnalysis):
             a0=self.workDir, a1=self.template['miaplpy.inversion.rangeWindow'],
             a2=self.template['miaplpy.inversion.azimuthWindow'], a3=self.template['miaplpy.inversion.patchSize'])
 
+        output_step = str(self.template['miaplpy.inversion.outputStep']).replace(',', ' ').split()
+        if max([int(x) for x in output_step]) > 1:
+            scp_args += ' --output_step {}'.format(' '.join(output_step))
+
+        if int(self.template['miaplpy.inversion.maxNumShp']) > 0:
+            scp_args += ' --max_shp {}'.format(self.template['miaplpy.inversion.maxNumShp'])
+
+        if int(self.template['miaplpy.inversion.readThreads']) > 1:
+            scp_args += ' --read_threads {}'.format(self.template['miaplpy.inversion.readThreads'])
+
+        if self.template['miaplpy.inversion.compactOutput']:
+            scp_args += ' --compact_output'
+
+        if self.template['miaplpy.inversion.psOnly']:
+            scp_args += ' --ps_only --ps_dispersion {}'.format(self.template['miaplpy.inversion.psDispersion'])
+            number_of_nodes = 1
+
         if sname == 'concatenate_patches':
             command_line = '{a} phase_linking.py {b} --slc_stack {c} --concatenate\n'.format(
                 a=self.text_cmd.strip("'"), b=scp_args, c=slc_stack)
@@ -339,6 +356,13 @@ class miaplpyTimeSeriesAnalysis(TimeSeriesAnalysis):
             if not self.template['miaplpy.inversion.mask'] in [None, 'None']:
                 scp_args += ' --mask {}'.format(os.path.abspath(self.template['miaplpy.inversion.mask']))
 
+            if self.template['miaplpy.inversion.streamMinistacks']:
+                scp_args += ' --stream_ministacks'
+                if self.template['miaplpy.interferograms.sharedCoherence'] == 'full' or \
+                        self.template['miaplpy.timeseries.tempCohType'] in ['full', 'auto']:
+                    print('WARNING: miaplpy.inversion.streamMinistacks writes the average temporal coherence of the '
+                          'ministacks as tempCoh_full, it is used for sharedCoherence/tempCohType = full')
+
             if number_of_nodes > 1:
                 for i in range(number_of_nodes):
                     scp_args1 = scp_args + ' --index {}'.format(i)
@@ -482,7 +506,39 @@ class miaplpyTimeSeriesAnalysis(TimeSeriesAnalysis):
             tmp_phase_series = phase_series
         num_cpu = os.cpu_count()
         num_lin = 0
-        for pair in self.pairs:
+
+        # shared phase linking temporal coherence instead of ICU coherence of each pair
+        coherence_args = ''
+        if self.template['miaplpy.interferograms.sharedCoherence'] in ['average', 'full']:
+            coherence_args = ' --coherence_file {} --amplitude_weight {}'.format(
+                os.path.join(self.workDir, 'inverted/tempCoh_{}'.format(
+                    self.template['miaplpy.interferograms.sharedCoherence'])),
+                self.template['miaplpy.interferograms.coherenceAmplitudeWeight'])
+        if self.template['miaplpy.interferograms.interpolation'] in ['linear', 'nearest', 'kdtree', 'multires']:
+            coherence_args += ' --interpolate {}'.format(self.template['miaplpy.interferograms.interpolation'])
+
+        single_pairs = self.pairs
+        if self.template['miaplpy.interferograms.batchPairs']:
+            single_pairs = []
+            # one process forming all pairs, reading each block of the phase series once
+            os.makedirs(self.ifgram_dir, exist_ok=True)
+            pair_file = os.path.join(self.ifgram_dir, 'pairs_list.txt')
+            with open(pair_file, 'w') as f:
+                for pair in self.pairs:
+                    f.write(pair[0] + '_' + pair[1] + '\n')
+
+            scp_args = '--pair_list {a1} --output_dir {a2} --azimuth_looks {a3} --range_looks {a4} ' \
+                       '--filter_strength {a5} --stack_prefix {a6} --stack {a7} --num_workers {a8}'.format(
+                a1=pair_file, a2=self.ifgram_dir, a3=self.azimuth_look, a4=self.range_look,
+                a5=self.template['miaplpy.interferograms.filterStrength'], a6=self.sensor_type,
+                a7=tmp_phase_series, a8=num_cpu)
+            if self.template['miaplpy.interferograms.filterMethod'] != 'isce':
+                scp_args += ' --filter_method {}'.format(self.template['miaplpy.interferograms.filterMethod'])
+            scp_args += coherence_args
+            cmd = '{} generate_ifgram.py {}'.format(self.text_cmd.strip("'"), scp_args)
+            run_commands.append(cmd.lstrip() + '\n')
+
+        for pair in single_pairs:
             out_dir = os.path.join(self.ifgram_dir, pair[0] + '_' + pair[1])
             #os.makedirs(out_dir, exist_ok='True')
 
@@ -495,6 +551,10 @@ class miaplpyTimeSeriesAnalysis(TimeSeriesAnalysis):
                                                            a6=self.template['miaplpy.interferograms.filterStrength'],
                                                            a7=self.sensor_type,
                                                            a8=tmp_phase_series)
+            if self.template['miaplpy.interferograms.filterMethod'] != 'isce':
+                scp_args += ' --filter_method {} --num_workers 1'.format(
+                    self.template['miaplpy.interferograms.filterMethod'])
+            scp_args += coherence_args
 
             cmd = '{} generate_ifgram.py {}'.format(self.text_cmd.strip("'"), scp_args)
             cmd = cmd.lstrip()
@@ -549,13 +609,60 @@ class miaplpyTimeSeriesAnalysis(TimeSeriesAnalysis):
 
         #corr_file = os.path.join(self.workDir, 'inverted/tempCoh_{}'.format(self.template['miaplpy.timeseries.tempCohType']))
         corr_file = os.path.join(self.workDir, 'inverted/tempCoh_average')
+        shared_coherence = self.template['miaplpy.interferograms.sharedCoherence']
+        if shared_coherence in ['average', 'full']:
+            corr_file = os.path.join(self.workDir, 'inverted/tempCoh_{}'.format(shared_coherence))
         unwrap_mask = os.path.join(self.workDir, 'inverted/mask_unwrap')
         #unwrap_mask = os.path.abspath(self.template['miaplpy.unwrap.mask'])
 
-        for pair in self.pairs:
+        single_pairs = self.pairs
+        if self.template['miaplpy.unwrap.pool']:
+            # one driver scheduling the snaphu runs of all pairs within the cores of the node
+            single_pairs = []
+            pair_file = os.path.join(self.ifgram_dir, 'pairs_list.txt')
+            with open(pair_file, 'w') as f:
+                for pair in self.pairs:
+                    f.write(pair[0] + '_' + pair[1] + '\n')
+            if shared_coherence in ['average', 'full'] and \
+                    float(self.template['miaplpy.interferograms.coherenceAmplitudeWeight']) > 0:
+                # coherence file of each pair directory
+                corr_file = 'filt_fine.cor'
+
+            scp_args = '--pair_list {a1} --ifgram_dir {a2} --coherence {a3} --max_discontinuity {a4} ' \
+                       '--init_method {a5} --length {a6} --width {a7} --height {a8} --earth_radius {a9} ' \
+                       '--wavelength {a10} --num_cpu {a11} --tile_num_pixels {a12} --timeout {a13}'.format(
+                a1=pair_file, a2=self.ifgram_dir, a3=corr_file,
+                a4=self.template['miaplpy.unwrap.snaphu.maxDiscontinuity'],
+                a5=self.template['miaplpy.unwrap.snaphu.initMethod'], a6=length, a7=width, a8=height,
+                a9=earth_radius, a10=wavelength, a11=os.cpu_count(),
+                a12=self.template['miaplpy.unwrap.snaphu.tileNumPixels'], a13=self.template['miaplpy.unwrap.timeout'])
+            if self.template['miaplpy.unwrap.warmStart']:
+                scp_args += ' --warm_start'
+            if self.template['miaplpy.unwrap.writeStack']:
+                scp_args += ' --stack_file {} --slc_stack {}'.format(
+                    os.path.join(self.out_dir_network, 'inputs/ifgramStack.h5'),
+                    os.path.join(self.workDir, 'inputs/slcStack.h5'))
+            if self.template['miaplpy.unwrap.mask']:
+                scp_args += ' -m {a12}'.format(a12=unwrap_mask)
+            if float(self.template['miaplpy.interferograms.filterStrength']) > 0 and self.template['miaplpy.unwrap.removeFilter']:
+                scp_args += ' --rmfilter'
+            if self.copy_to_tmp:
+                scp_args += ' --tmp'
+            if self.template['miaplpy.unwrap.two-stage']:
+                scp_args += ' --two-stage --two-stage-method {}'.format(self.template['miaplpy.unwrap.twoStageMethod'])
+            if int(self.template['miaplpy.unwrap.coarseLooks']) > 1:
+                scp_args += ' --coarse_looks {}'.format(self.template['miaplpy.unwrap.coarseLooks'])
+            cmd = '{} unwrap_ifgram.py {}'.format(self.text_cmd.strip("'"), scp_args)
+            run_commands.append(cmd.lstrip() + '\n')
+
+        for pair in single_pairs:
             out_dir = os.path.join(self.ifgram_dir, pair[0] + '_' + pair[1])
             #if float(self.template['miaplpy.interferograms.filterStrength']) > 0:
             #    corr_file = os.path.join(out_dir, 'filt_fine.cor')
+            if shared_coherence in ['average', 'full'] and \
+                    float(self.template['miaplpy.interferograms.coherenceAmplitudeWeight']) > 0:
+                # temporal coherence blended with the amplitude of the pair
+                corr_file = os.path.join(out_dir, 'filt_fine.cor')
             #os.makedirs(out_dir, exist_ok='True')
 
             scp_args = '--ifg {a1} --coherence {a2} --unwrapped_ifg {a3} '\
@@ -574,8 +681,10 @@ class miaplpyTimeSeriesAnalysis(TimeSeriesAnalysis):
                 scp_args += ' --rmfilter'
             if self.copy_to_tmp:
                 scp_args += ' --tmp'
-            if self.template['miaplpy.unwrap.two-stage'] == 'yes':
-                scp_args += ' --two-stage'
+            if self.template['miaplpy.unwrap.two-stage']:
+                scp_args += ' --two-stage --two-stage-method {}'.format(self.template['miaplpy.unwrap.twoStageMethod'])
+            if int(self.template['miaplpy.unwrap.coarseLooks']) > 1:
+                scp_args += ' --coarse_looks {}'.format(self.template['miaplpy.unwrap.coarseLooks'])
             cmd = '{} unwrap_ifgram.py {}'.format(self.text_cmd.strip("'"), scp_args)
             cmd = cmd.lstrip()
 
@@ -683,6 +792,9 @@ class miaplpyTimeSeriesAnalysis(TimeSeriesAnalysis):
         if not self.template['miaplpy.timeseries.minNormVelocity']:
             cmd += ' --min-norm-phase '
 
+        if self.template['miaplpy.timeseries.pixelMajor']:
+            cmd += ' --pixel-major'
+
         if self.template['miaplpy.timeseries.shadowMask']:
             cmd += ' --shadow_mask'
 
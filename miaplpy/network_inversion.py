@@ -55,6 +55,8 @@ def main(iargs=None):
 
     if not inps.minNormVelocity:
         iargs += ['--min-norm-phase']
+    if inps.pixelMajor:
+        iargs += ['--pixel-major']
 
     print('\nifgram_inversion_L1L2.py', ' '.join(iargs))
     ifgram_inversion_L1L2.main(iargs)
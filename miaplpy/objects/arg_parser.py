@@ -212,10 +212,11 @@ class MiaplPyParser:
         ## no   - save   0% disk usage, fast [default]
         ## lzf  - save ~57% disk usage, relative slow
         ## gzip - save ~62% disk usage, very slow [not recommend]
+        ## zstd/blosc - lossless compression of hdf5plugin (if installed), fast to decompress
         
         miaplpy.load.processor      = auto  #[isce,snap,gamma,roipac], auto for isceTops
         miaplpy.load.updateMode     = auto  #[yes / no], auto for yes, skip re-loading if HDF5 files are complete
-        miaplpy.load.compression    = auto  #[gzip / lzf / no], auto for no.
+        miaplpy.load.compression    = auto  #[gzip / lzf / zstd / blosc / no], auto for no.
         miaplpy.load.autoPath       = auto    # [yes, no] auto for no
         
         miaplpy.load.slcFile        = auto  #[path2slc_file]
@@ -265,8 +266,9 @@ class MiaplPyParser:
                             default='isce')
         parser.add_argument('--enforce', '-f', dest='updateMode', action='store_false',
                             help='Disable the update mode, or skip checking dataset already loaded.')
-        parser.add_argument('--compression', choices={'gzip', 'lzf', None}, default=None,
-                            help='Compress loaded geometry while writing HDF5 file, default: None.')
+        parser.add_argument('--compression', choices={'gzip', 'lzf', 'zstd', 'blosc', None}, default=None,
+                            help='Lossless compression (with byte shuffle) of the slc stack while writing HDF5 file, '
+                                 'zstd and blosc need hdf5plugin, default: None.')
         parser.add_argument('--no_metadata_check', dest='no_metadata_check', action='store_true',
                           help='Do not check for rsc files, when running via miaplpyApp.py')
 
@@ -286,17 +288,40 @@ class MiaplPyParser:
         patch.add_argument('-a', '--azimuth_window', type=int, dest='azimuth_window', default=15,
                            help='Azimuth window size for shp finding')
         patch.add_argument('-m', '--method', type=str, dest='inversion_method', default='EMI',
-                           help='Inversion method (EMI, EVD, PTA, sequential_EMI, ...)')
+                           help='Inversion method (EMI, EVD, PTA, sequential_EMI, ...), a comma separated list of '
+                                'non-sequential methods (e.g. EMI,EVD,PTA) is inverted in a single pass')
         patch.add_argument('-l', '--time_lag', type=int, dest='time_lag', default=10,
                            help='Time lag in case StBAS is used')
         patch.add_argument('-t', '--test', type=str, dest='shp_test', default='ks',
-                           help='Shp statistical test (ks, ad, ttest)')
+                           help='Shp statistical test (ks, ad, ttest, glrt: likelihood ratio on the mean intensity, '
+                                'independent of the number of images, cluster: same amplitude cluster of the patch)')
         patch.add_argument('-psn', '--ps_num_shp', type=int, dest='ps_shp', default=10,
                            help='Number of SHPs for PS candidates')
+        patch.add_argument('-psd', '--ps_dispersion', type=float, dest='ps_disp_thresh', default=0.42,
+                           help='Amplitude dispersion threshold for PS candidates (default: 0.42)')
+        patch.add_argument('--ps_only', dest='ps_only', action='store_true',
+                           help='Only write the phase series of PS candidates selected by amplitude dispersion, '
+                                'skips SHP search and DS inversion')
+        patch.add_argument('-mxs', '--max_shp', type=int, dest='max_shp', default=0,
+                           help='Maximum number of SHPs, neighbours are tested in order of distance and the search '
+                                'stops when reached (default: 0, test the full window)')
+        patch.add_argument('-os', '--output_step', type=int, nargs='+', dest='output_step', default=[1],
+                           metavar=('Y_STEP', 'X_STEP'),
+                           help='Row and column step of the output grid, SHPs and coherence matrices use the full '
+                                'resolution but only the center pixel of each step block is inverted (default: 1)')
         patch.add_argument('-p', '--patch_size', type=int, dest='patch_size', default=200,
                            help='Azimuth window size for shp finding')
         patch.add_argument('-mss', '--mini_stack_size', type=int, dest='ministack_size', default=10,
                            help='Number of images in each mini stack')
+        patch.add_argument('--stream_ministacks', dest='stream_ministacks', action='store_true',
+                           help='Read one mini stack of dates at a time for sequential methods, memory of each '
+                                'patch is bounded by the mini stack size')
+        patch.add_argument('--compact_output', dest='compact_output', action='store_true',
+                           help='Write phase_series.h5 with phase quantized to int16 and log-scaled uint16 '
+                                'amplitude (lzf compressed), decoded transparently by the readers')
+        patch.add_argument('--read_threads', type=int, dest='read_threads', default=1,
+                           help='Number of threads decompressing the chunks of a compressed SLC stack in each '
+                                'worker (default: 1, read with h5py)')
         patch.add_argument('-s', '--slc_stack', type=str, dest='slc_stack', help='SLC stack file')
         patch.add_argument('-ms', '--mask', type=str, dest='mask_file', default='None', help='mask file for inversion')
         patch.add_argument('-n', '--num_worker', dest='num_worker', type=int, default=1,
@@ -329,10 +354,18 @@ class MiaplPyParser:
     def generate_interferograms_parser():
 
         parser = argparse.ArgumentParser(description='Generate interferogram')
-        parser.add_argument('-m', '--reference', type=str, dest='reference', required=True,
+        parser.add_argument('-m', '--reference', type=str, dest='reference', default=None,
                             help='Reference image')
-        parser.add_argument('-s', '--secondary', type=str, dest='secondary', required=True,
+        parser.add_argument('-s', '--secondary', type=str, dest='secondary', default=None,
                             help='Secondary image')
+        parser.add_argument('-l', '--pair_list', type=str, dest='pair_list', default=None,
+                            help='Text file of pairs (reference_secondary per line) to generate in one process, '
+                                 'each pair is written to output_dir/reference_secondary')
+        parser.add_argument('-n', '--num_workers', type=int, dest='num_workers', default=4,
+                            help='Number of writer threads and filtering processes with --pair_list, '
+                                 'filtering threads of a single pair (default: 4)')
+        parser.add_argument('--max_memory', type=float, dest='max_memory', default=4,
+                            help='Memory (GB) of the block of all dates read at once with --pair_list (default: 4)')
         parser.add_argument('-t', '--stack', type=str, dest='stack_file', required=True,
                             help='Phase series stack file to read from')
         parser.add_argument('-o', '--output_dir', type=str, dest='out_dir', default='interferograms',
@@ -343,6 +376,21 @@ class MiaplPyParser:
                             help='Range looks')
         parser.add_argument('-f', '--filter_strength', type=float, dest='filter_strength', default=0.5,
                             help='filtering strength')
+        parser.add_argument('--filter_method', type=str, dest='filter_method', default='isce',
+                            choices=['isce', 'goldstein', 'gaussian'],
+                            help='isce: ISCE goldstein filter, goldstein/gaussian: native filters of the '
+                                 'interferogram in memory (default: isce)')
+        parser.add_argument('--coherence_file', type=str, dest='coherence_file', default=None,
+                            help='Shared coherence raster of the stack (inverted/tempCoh_average or tempCoh_full) '
+                                 'used as coherence of the pairs instead of running ICU for each pair')
+        parser.add_argument('--amplitude_weight', type=float, dest='amplitude_weight', default=0,
+                            help='[0-1] weight of the pair amplitude blended with --coherence_file, '
+                                 '0 links the shared raster (default: 0)')
+        parser.add_argument('--interpolate', type=str, dest='interpolation', default=None,
+                            choices=['linear', 'nearest', 'kdtree', 'multires'],
+                            help='Fill the phase of the pixels with temporal coherence < 0.5 after filtering: '
+                                 'linear (Delaunay), nearest (distance transform), kdtree (nearest by cKDTree) '
+                                 'or multires (average phase of growing blocks) (default: no interpolation)')
         parser.add_argument('-p', '--stack_prefix', dest='prefix', type=str, default='tops'
                             , help='ISCE stack processor: options= tops, stripmap -- default = tops')
 
@@ -352,12 +400,38 @@ class MiaplPyParser:
     @staticmethod
     def unwrap_parser():
         parser = argparse.ArgumentParser(description='Unwrap using snaphu')
-        parser.add_argument('-f', '--ifg', dest='input_ifg', type=str, required=True,
+        parser.add_argument('-f', '--ifg', dest='input_ifg', type=str, default=None,
                             help='Input wrapped interferogram')
         parser.add_argument('-c', '--coherence', dest='input_cor', type=str, required=True,
-                            help='Input coherence file')
-        parser.add_argument('-u', '--unwrapped_ifg', dest='unwrapped_ifg', type=str, required=True,
+                            help='Input coherence file, a file name without directory is taken from each pair '
+                                 'directory with --pair_list')
+        parser.add_argument('-u', '--unwrapped_ifg', dest='unwrapped_ifg', type=str, default=None,
                             help='Output unwrapped interferogram')
+        parser.add_argument('-l', '--pair_list', dest='pair_list', type=str, default=None,
+                            help='Text file of pairs (reference_secondary per line) to unwrap with a pool of snaphu '
+                                 'processes, ifgram_dir/pair/filt_fine.int is unwrapped to filt_fine.unw')
+        parser.add_argument('--ifgram_dir', dest='ifgram_dir', type=str, default=None,
+                            help='Directory of the pairs of --pair_list')
+        parser.add_argument('--num_cpu', dest='num_cpu', type=int, default=os.cpu_count(),
+                            help='Number of cores shared by the snaphu processes of --pair_list (default: all)')
+        parser.add_argument('--tile_num_pixels', dest='tile_num_pixels', type=int, default=10000000,
+                            help='Number of pixels of a snaphu tile, sets the tiles of a pair with --pair_list '
+                                 '(default: 10000000)')
+        parser.add_argument('--stack_file', dest='stack_file', type=str, default=None,
+                            help='With --pair_list, write each unwrapped pair into this ifgramStack HDF5 file')
+        parser.add_argument('--slc_stack', dest='slc_stack', type=str, default=None,
+                            help='SLC stack file with the metadata and baselines of the ifgramStack file')
+        parser.add_argument('--coarse_looks', dest='coarse_looks', type=int, default=1,
+                            help='Unwrap the interferogram multilooked by this factor and resolve the 2pi ambiguity '
+                                 'of the full resolution pixels from the upsampled solution (default: 1, off)')
+        parser.add_argument('--warm_start', dest='warm_start', action='store_true',
+                            help='With --pair_list, unwrap the short pairs first and start snaphu of a pair from the '
+                                 'sum of two unwrapped pairs connecting its dates when they exist')
+        parser.add_argument('--init_unwrapped', dest='init_unwrapped', type=str, default=None,
+                            help='Unwrapped initial solution (amplitude and phase by line) reoptimized by snaphu')
+        parser.add_argument('--timeout', dest='timeout', type=float, default=0,
+                            help='Time limit (seconds) of a snaphu run before falling back to the ISCE snaphu, '
+                                 'a pair of --pair_list is killed after twice this time (default: 0, no limit)')
         parser.add_argument('-m', '--mask', dest='unwrap_mask', type=str, default=None,
                             help='Output unwrapped interferogram')
         parser.add_argument('-sw', '--width', dest='ref_width', type=int, default=None,
@@ -378,8 +452,15 @@ class MiaplPyParser:
                             help='Number of tiles for Unwrapping in parallel')
         parser.add_argument('--two-stage', dest='unwrap_2stage', action='store_true',
                             help='Use 2 stage unwrapping (from ISCE)')
+        parser.add_argument('--two-stage-method', dest='unwrapper_2stage', type=str, default='REDARC0',
+                            choices=['REDARC0', 'REDARC1', 'MCF', 'MST'],
+                            help='Second stage of the 2 stage unwrapping: ISCE UnwrapComponents (REDARC0, REDARC1, MCF) '
+                                 'or MST, offsets of the components on their maximum spanning tree without ISCE '
+                                 '(default: REDARC0)')
         parser.add_argument('--rmfilter', dest='remove_filter_flag', action='store_true',
                             help='Remove filtering after unwrap')
+        parser.add_argument('--block_rows', dest='block_rows', type=int, default=2000,
+                            help='Number of rows read and written at once when removing the filter (default: 2000)')
         parser.add_argument('--tmp', dest='copy_to_tmp', action='store_true', help='Copy and process on tmp')
 
         return parser
@@ -415,6 +496,8 @@ class MiaplPyParser:
                             help='Optimization mehtod, L1 or L2 norm. (default: %(default)s).')
         parser.add_argument('--smooth_factor', dest='L1_alpha', default=0.001,
                             help='Smoothing factor for L1 inversion [0-1] default: 0.01.')
+        parser.add_argument('--pixel-major', dest='pixelMajor', action='store_true',
+                            help='Invert from a pixel-major copy of the stack, created once and reused')
         parser.add_argument('-w', '--weight-func', dest='weightFunc', default='var',
                             choices={'var', 'fim', 'coh', 'no'},
                             help='function used to convert coherence to weight for inversion:\n' +
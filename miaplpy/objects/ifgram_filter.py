@@ -0,0 +1,166 @@
+############################################################
+# Program is part of MiaplPy                                #
+# Author:  Sara Mirzaee                                    #
+############################################################
+# Goldstein and Gaussian filters of interferograms in memory
+# Recommend import:
+#     from miaplpy.objects.ifgram_filter import goldstein_filter, gaussian_filter
+
+import functools
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+@functools.lru_cache(maxsize=16)
+def triangle_window(window_size):
+    """2D triangular window, the weights of the overlapping windows sum to a constant with step = size / 2"""
+    w = 1 - np.abs(np.arange(window_size) - (window_size - 1) / 2) / (window_size / 2)
+    return np.outer(w, w).astype(np.float32)
+
+
+@functools.lru_cache(maxsize=16)
+def gaussian_kernel(shape, sigma_y, sigma_x, high_pass=False):
+    """Frequency response (not shifted) of a spatial gaussian with sigma_y, sigma_x in pixels
+    for a FFT of size shape"""
+    fy = np.fft.fftfreq(shape[0])[:, None]
+    fx = np.fft.fftfreq(shape[1])[None, :]
+    kernel = np.exp(-2 * np.pi ** 2 * ((sigma_y * fy) ** 2 + (sigma_x * fx) ** 2)).astype(np.float32)
+    if high_pass:
+        kernel = 1 - kernel
+    return kernel
+
+
+def smooth_spectrum(spectrum):
+    """3x3 boxcar of the amplitude spectrum of a stack of windows (circular like the FFT)"""
+    out = np.zeros(spectrum.shape, dtype=np.float32)
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            out += np.roll(spectrum, (dy, dx), axis=(-2, -1))
+    return out / 9
+
+
+def run_tiles(function, length, tile_size, num_threads):
+    """Run function(row_1, row_2) on blocks of rows, on a thread pool (the numpy FFT releases the GIL)"""
+    rows = [(r, min(r + tile_size, length)) for r in range(0, length, tile_size)]
+    if num_threads > 1 and len(rows) > 1:
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            list(executor.map(lambda x: function(*x), rows))
+    else:
+        for row_1, row_2 in rows:
+            function(row_1, row_2)
+    return
+
+
+def goldstein_filter(ifg, alpha, window_size=32, tile_size=512, num_threads=4):
+    """Goldstein-Werner filter: the spectrum of overlapping windows (step of window_size / 2) is weighted by
+    its smoothed amplitude to the power alpha and the filtered windows are overlap-added with triangular weights.
+    Windows are on a fixed grid of the image, so the result does not depend on tile_size.
+    Parameters: ifg : 2D complex array, interferogram
+                alpha : float, filter strength [0-1]
+                window_size : int, even size of the FFT windows
+                tile_size : int, number of rows filtered by each task
+                num_threads : int, number of threads
+    Returns:    out : 2D complex64 array of the filtered interferogram
+    """
+    length, width = ifg.shape
+    out = np.zeros((length, width), dtype=np.complex64)
+    if alpha <= 0:
+        out[:, :] = ifg
+        return out
+
+    step = window_size // 2
+    weight = triangle_window(window_size)
+    # window starts on a grid from -step so every pixel is covered by 4 windows
+    col_starts = np.arange(-step, width, step)
+    pad_width = col_starts[-1] + window_size - width + step
+
+    def filter_rows(row_1, row_2):
+        win_1 = (row_1 + step) // step * step - step - step
+        win_2 = row_2
+        row_starts = np.arange(win_1, win_2, step)
+        t0, t1 = row_starts[0], row_starts[-1] + window_size
+        block = np.zeros((t1 - t0, width + step + pad_width), dtype=np.complex64)
+        r0, r1 = max(t0, 0), min(t1, length)
+        block[r0 - t0:r1 - t0, step:step + width] = ifg[r0:r1, :]
+        block[np.isnan(block)] = 0
+
+        windows = np.lib.stride_tricks.sliding_window_view(block, (window_size, window_size))
+        windows = windows[::step, ::step][:len(row_starts), :len(col_starts)]
+        spectrum = np.fft.fft2(windows)
+        response = smooth_spectrum(np.abs(spectrum)) ** alpha
+        response /= np.maximum(response.max(axis=(-2, -1), keepdims=True), np.finfo(np.float32).tiny)
+        filtered = np.fft.ifft2(spectrum * response) * weight
+
+        acc = np.zeros(block.shape, dtype=np.complex64)
+        for i in range(window_size // step):
+            for k in range(window_size // step):
+                # windows of the same phase in the grid do not overlap
+                part = filtered[i::2, k::2]
+                num_r, num_c = part.shape[:2]
+                tiles = part.transpose(0, 2, 1, 3).reshape(num_r * window_size, num_c * window_size)
+                y0, x0 = i * step, k * step
+                acc[y0:y0 + tiles.shape[0], x0:x0 + tiles.shape[1]] += tiles
+        out[row_1:row_2, :] = acc[row_1 - t0:row_2 - t0, step:step + width]
+        return
+
+    run_tiles(filter_rows, length, tile_size, num_threads)
+    return out
+
+
+@functools.lru_cache(maxsize=16)
+def wrapped_row_kernel(length, sigma_y, tolerance=1e-7):
+    """Rows of the circular spatial kernel of the whole image gaussian response (length rows),
+    cut where the remaining weight is below tolerance. Returns the kernel of rows -margin..margin"""
+    kernel = np.real(np.fft.ifft(np.exp(-2 * np.pi ** 2 * (sigma_y * np.fft.fftfreq(length)) ** 2)))
+    kernel = np.fft.fftshift(kernel)
+    center = length // 2
+    cumulative = np.abs(kernel[center:]) + np.abs(kernel[center::-1])[:len(kernel[center:])]
+    tail = np.cumsum(cumulative[::-1])[::-1]
+    margin = int(np.argmax(tail < tolerance)) if np.any(tail < tolerance) else center
+    return kernel[center - margin:center + margin + 1]
+
+
+def gaussian_filter(ifg, D0, high_pass=False, tile_size=1024, num_threads=4):
+    """Gaussian low (high) pass filter with the frequency response exp(-d^2 / 2 D0^2) of the whole image
+    (d in frequency bins), circular like the whole-image FFT of runFilterG. Blocks of rows are filtered with
+    full width and row margins wrapped around the image, with the rows of the circular kernel of the whole image
+    (overlap-save of the circular convolution).
+    Parameters: ifg : 2D complex array, interferogram
+                D0 : float, cut-off of the frequency response of the whole image in bins
+                high_pass : bool, 1 - the low pass response
+                tile_size : int, number of rows filtered by each task
+                num_threads : int, number of threads
+    Returns:    out : 2D complex64 array of the filtered interferogram
+    """
+    length, width = ifg.shape
+    out = np.zeros((length, width), dtype=np.complex64)
+    # spatial sigma of the gaussian of the whole image response
+    sigma_y = length / (2 * np.pi * D0)
+    sigma_x = width / (2 * np.pi * D0)
+    kernel_y = wrapped_row_kernel(length, sigma_y)
+    margin_y = len(kernel_y) // 2
+    if length <= tile_size or 2 * margin_y >= length:
+        # one block is the whole image, same response as runFilterG
+        tile_size = length
+        margin_y = 0
+    response_x = gaussian_kernel((1, width), sigma_y, sigma_x)[0]
+
+    def filter_rows(row_1, row_2):
+        rows = np.arange(row_1 - margin_y, row_2 + margin_y) % length
+        block = ifg[rows, :].astype(np.complex64)
+        block[np.isnan(block)] = 0
+        if margin_y:
+            response_y = np.zeros(block.shape[0], dtype=np.float64)
+            response_y[np.arange(-margin_y, margin_y + 1) % block.shape[0]] = kernel_y
+            response_y = np.real(np.fft.fft(response_y))
+        else:
+            response_y = gaussian_kernel((length, 1), sigma_y, sigma_x)[:, 0]
+        response = response_y[:, None] * response_x[None, :]
+        if high_pass:
+            response = 1 - response
+        filtered = np.fft.ifft2(np.fft.fft2(block) * response)
+        out[row_1:row_2, :] = filtered[margin_y:margin_y + row_2 - row_1, :]
+        return
+
+    run_tiles(filter_rows, length, tile_size, num_threads)
+    return out
@@ -6,6 +6,7 @@
 import os
 import numpy as np
 from miaplpy.objects.slcStack import slcStack
+from miaplpy.objects.utils import decode_dataset
 #from mintpy.objects.stack import timeseries
 import miaplpy.lib.utils as iut
 from scipy import linalg as LA
@@ -241,8 +242,8 @@ def process_pixel(coord, stackfile, range_window=19, azimuth_window=9, phase_lin
     else:
 
         with h5py.File(stackfile, 'r') as f:
-            patch_phase = f['phase'][:, box[1]:box[3], box[0]:box[2]]
-            patch_amplitude = f['amplitude'][:, box[1]:box[3], box[0]:box[2]]
+            patch_phase = decode_dataset(f['phase'], f['phase'][:, box[1]:box[3], box[0]:box[2]])
+            patch_amplitude = decode_dataset(f['amplitude'], f['amplitude'][:, box[1]:box[3], box[0]:box[2]])
         patch_slc_images = patch_amplitude * np.exp(1j * patch_phase)
 
     vec_refined = np.empty(n_image, dtype=np.complex64)
@@ -9,8 +9,10 @@
 
 import os
 import time
+import zlib
 import h5py
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from osgeo import gdal
 try:
@@ -36,9 +38,133 @@ dataType = np.complex64
 slcDatasetNames = ['slc']
 DSET_UNIT_DICT['slc'] = 'i'
 gdal.SetCacheMax(2**30)
+
+# HDF5 filter ids of the lossless compressions supported for the slc stack
+FILTER_DEFLATE = 1
+FILTER_SHUFFLE = 2
+FILTER_BLOSC = 32001
+FILTER_ZSTD = 32015
 ########################################################################################
 
 
+def get_compression_kwargs(compression):
+    """Dataset creation keywords of a lossless compression for complex data.
+    lzf and gzip are shipped with h5py, zstd and blosc need hdf5plugin and fall back to gzip without it.
+    The byte shuffle filter is added in front of the compression, it groups the exponent bytes of the
+    float32 real/imaginary parts together which compresses much better.
+    Parameters: compression : str, lzf / gzip / zstd / blosc / None
+    Returns:    dict, keywords for h5py create_dataset
+    """
+    if compression in [None, False, 'no', 'None']:
+        return {'compression': None}
+
+    if compression in ['zstd', 'blosc']:
+        try:
+            import hdf5plugin
+            if compression == 'zstd':
+                return dict(shuffle=True, **hdf5plugin.Zstd())
+            return dict(**hdf5plugin.Blosc(cname='lz4', clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+        except ImportError:
+            print('hdf5plugin is not installed, use gzip instead of {}'.format(compression))
+            compression = 'gzip'
+
+    if compression == 'gzip':
+        return {'compression': 'gzip', 'compression_opts': 4, 'shuffle': True}
+    return {'compression': compression, 'shuffle': True}
+
+
+def unshuffle(buffer, itemsize):
+    """Inverse of the HDF5 byte shuffle filter, byte k of every element is stored in the k-th block"""
+    shuffled = np.frombuffer(buffer, dtype=np.uint8).reshape(itemsize, -1)
+    out = np.empty((shuffled.shape[1], itemsize), dtype=np.uint8)
+    for k in range(itemsize):
+        out[:, k] = shuffled[k]
+    return out
+
+
+def get_chunk_decoders(ds):
+    """Decoders of the filter pipeline of a chunked dataset in the order they are applied when reading,
+    None if the dataset is not filtered or one of the filters can not be decoded in python (e.g. lzf)
+    """
+    if ds.chunks is None:
+        return None
+
+    dcpl = ds.id.get_create_plist()
+    if dcpl.get_nfilters() == 0:
+        return None
+    decoders = []
+    for i in range(dcpl.get_nfilters()):
+        code = dcpl.get_filter(i)[0]
+        if code == FILTER_DEFLATE:
+            decoder = zlib.decompress
+        elif code == FILTER_SHUFFLE:
+            decoder = lambda x, n=ds.dtype.itemsize: unshuffle(x, n)
+        elif code == FILTER_ZSTD:
+            try:
+                import zstandard
+            except ImportError:
+                return None
+            decoder = lambda x: zstandard.ZstdDecompressor().decompressobj().decompress(x)
+        elif code == FILTER_BLOSC:
+            try:
+                import blosc
+            except ImportError:
+                return None
+            decoder = blosc.decompress
+        else:
+            return None
+        decoders.append((i, decoder))
+    return decoders[::-1]
+
+
+def read_direct_chunks(ds, date_index, box, num_threads=4):
+    """Read a block of a chunked 3D dataset with read_direct_chunk and decode the chunks on a thread pool
+    (zlib, zstd and blosc release the GIL), so the decompression of compressed stacks runs in parallel.
+    Parameters: ds : h5py.Dataset, 3D chunked dataset
+                date_index : 1D array of int, indices of the dates to read
+                box : list of 4 int, x0, y0, x1, y1
+                num_threads : int, number of decoding threads
+    Returns:    data : 3D array in size of (len(date_index), y1-y0, x1-x0), None if the filters can not be decoded
+    """
+    decoders = get_chunk_decoders(ds)
+    if decoders is None:
+        return None
+
+    chunks = ds.chunks
+    t0, t1 = int(np.min(date_index)), int(np.max(date_index)) + 1
+    block = [t0, t1, box[1], box[3], box[0], box[2]]
+    data = np.zeros((t1 - t0, box[3] - box[1], box[2] - box[0]), dtype=ds.dtype)
+    offsets = [(t, r, c) for t in range(t0 // chunks[0] * chunks[0], t1, chunks[0])
+                         for r in range(box[1] // chunks[1] * chunks[1], box[3], chunks[1])
+                         for c in range(box[0] // chunks[2] * chunks[2], box[2], chunks[2])]
+
+    def read_chunk(offset):
+        try:
+            filter_mask, raw = ds.id.read_direct_chunk(offset)
+        except (KeyError, OSError, RuntimeError):
+            # chunk not allocated, keep the fill value
+            return
+        for i, decoder in decoders:
+            if not (filter_mask >> i) & 1:
+                raw = decoder(raw)
+        chunk = np.frombuffer(raw, dtype=ds.dtype).reshape(chunks)
+        src = []
+        dst = []
+        for k in range(3):
+            first = max(block[2 * k], offset[k])
+            last = min(block[2 * k + 1], offset[k] + chunks[k])
+            src.append(slice(first - offset[k], last - offset[k]))
+            dst.append(slice(first - block[2 * k], last - block[2 * k]))
+        data[tuple(dst)] = chunk[tuple(src)]
+        return
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        list(executor.map(read_chunk, offsets))
+
+    return data[np.asarray(date_index) - t0]
+
+
+
 class slcStackDict:
     '''
     slcStack object for a set of coregistered SLCs from the same platform and track.
@@ -109,6 +235,7 @@ class slcStackDict:
         Parameters: outputFile : str, Name of the HDF5 file for the SLC stack
                     access_mode : str, access mode of output File, e.g. w, r+
                     box : tuple, subset range in (x0, y0, x1, y1)
+                    compression : str, lossless compression of the slc dataset, lzf / gzip / zstd / blosc
                     extra_metadata : dict, extra metadata to be added into output file
         Returns:    outputFile
         '''
@@ -152,7 +279,7 @@ class slcStackDict:
                                       maxshape=(None, dsShape[1], dsShape[2]),
                                       dtype=dsDataType,
                                       chunks=True,
-                                      compression=dsCompression)
+                                      **get_compression_kwargs(dsCompression))
 
                 prog_bar = ptime.progressBar(maxValue=self.numSlc)
 
@@ -236,10 +363,12 @@ class slcStack:
     It contains three datasets in root level: date, bperp and SLCs.
     """
 
-    def __init__(self, file=None):
+    def __init__(self, file=None, num_threads=1):
         self.file = file
         self.name = 'slc'
         self.file_structure = FILE_STRUCTURE_SLCs
+        # number of threads decoding the chunks of a compressed stack in read
+        self.num_threads = num_threads
 
     def close(self, print_msg=True):
         try:
@@ -352,7 +481,11 @@ class slcStack:
             if box is None:
                 box = [0, 0, self.width, self.length]
 
-            data = ds[np.where(dateFlag==True)[0], box[1]:box[3], box[0]:box[2]]
+            data = None
+            if self.num_threads > 1:
+                data = read_direct_chunks(ds, np.where(dateFlag==True)[0], box, num_threads=self.num_threads)
+            if data is None:
+                data = ds[np.where(dateFlag==True)[0], box[1]:box[3], box[0]:box[2]]
             data = np.squeeze(data)
         return data
 
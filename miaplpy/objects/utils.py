@@ -46,6 +46,11 @@ datasetName2templateKey = {'slc': 'miaplpy.load.slcFile',
                                'bperp': 'miaplpy.load.bperpFile'
                                }
 
+# compact phase_series.h5: phase quantized to int16 (2*pi/65536 step) and amplitude as log-scaled uint16
+# (0 for no data, relative step of ~5.3e-4 between 1e-6 and 1e9, maximum relative rounding error ~2.6e-4)
+PHASE_INT16_SCALE = 2 * np.pi / 65536
+AMPLITUDE_UINT16_OFFSET = np.log(1e-6)
+AMPLITUDE_UINT16_SCALE = (np.log(1e9) - np.log(1e-6)) / 65534
 
 
 class OutControl:
@@ -574,6 +579,60 @@ def read(fname, box=None, datasetName=None, print_msg=True):
     return data, atr
 
 
+#########################################################################
+def get_compact_dataset_kwargs(dsName):
+    """Dataset creation keywords of the compact phase_series.h5 datasets and their decoding attributes
+    Parameters: dsName : str, phase or amplitude
+    Returns:    kwargs : dict, keywords for h5py create_dataset
+                attrs : dict, ENCODING, scale_factor and add_offset of the dataset
+    """
+    kwargs = {'chunks': True, 'compression': 'lzf', 'shuffle': True}
+    if dsName == 'phase':
+        kwargs['dtype'] = np.int16
+        attrs = {'ENCODING': 'int16', 'scale_factor': PHASE_INT16_SCALE, 'add_offset': 0.}
+    else:
+        kwargs['dtype'] = np.uint16
+        attrs = {'ENCODING': 'log_uint16', 'scale_factor': AMPLITUDE_UINT16_SCALE,
+                 'add_offset': AMPLITUDE_UINT16_OFFSET}
+    return kwargs, attrs
+
+
+def encode_compact(data, dsName):
+    """Quantize phase (radians) to int16 or amplitude to log-scaled uint16 for the compact phase_series.h5"""
+    data = np.asarray(data, dtype=np.float64)
+    if dsName == 'phase':
+        out = np.round(data / PHASE_INT16_SCALE)
+        out[~np.isfinite(out)] = 0
+        # wrap, +pi and -pi are the same phase
+        return ((out.astype(np.int64) + 32768) % 65536 - 32768).astype(np.int16)
+
+    out = np.zeros(data.shape, dtype=np.uint16)
+    valid = np.isfinite(data) * (data > 0)
+    out[valid] = np.clip(np.round((np.log(data[valid]) - AMPLITUDE_UINT16_OFFSET) / AMPLITUDE_UINT16_SCALE) + 1,
+                         1, 65535)
+    return out
+
+
+def decode_dataset(ds, data):
+    """Decode data read from the dataset ds of a compact phase_series.h5, returned as is for float datasets
+    Parameters: ds : h5py.Dataset the data is read from
+                data : np.ndarray, raw data
+    Returns:    data : np.ndarray in float32
+    """
+    encoding = ds.attrs.get('ENCODING', None)
+    if isinstance(encoding, bytes):
+        encoding = encoding.decode('utf8')
+    if encoding == 'int16':
+        return np.asarray(data, dtype=np.float32) * np.float32(ds.attrs['scale_factor'])
+    if encoding == 'log_uint16':
+        data = np.asarray(data)
+        out = np.exp((data.astype(np.float32) - 1) * np.float32(ds.attrs['scale_factor']) +
+                     np.float32(ds.attrs['add_offset']))
+        out[data == 0] = 0
+        return out
+    return data
+
+
 #########################################################################
 def read_hdf5_file(fname, datasetName=None, box=None):
     """
@@ -646,6 +705,8 @@ def read_hdf5_file(fname, datasetName=None, box=None):
             # read data
             data = ds[slice_flag, box[1]:box[3], box[0]:box[2]]
             data = np.squeeze(data)
+
+        data = decode_dataset(ds, data)
     return data
 
 
@@ -1337,11 +1398,80 @@ def prepare_metadata(inpsDict):
     return
 
 
+def multilook_array(data, alks, rlks, weight=None):
+    """Multilook a real or complex array by averaging blocks of alks x rlks pixels in the last two axes.
+    NaN pixels are ignored, weight (e.g. temporal coherence, in size of the last two axes) weights the average
+    and the partial blocks at the edges are averaged over their pixels.
+    Parameters: data : 2D or 3D array
+                alks, rlks : int, number of looks in azimuth and range
+                weight : 2D array of the weights or None
+    Returns:    out : array in size of (..., ceil(length / alks), ceil(width / rlks)), NaN if no valid pixel
+    """
+    length, width = data.shape[-2:]
+    if alks == 1 and rlks == 1 and weight is None:
+        return data
+    out_length = int(np.ceil(length / alks))
+    out_width = int(np.ceil(width / rlks))
+    pad = [(0, 0)] * (data.ndim - 2) + [(0, out_length * alks - length), (0, out_width * rlks - width)]
+
+    valid = ~np.isnan(data)
+    if weight is None:
+        weight = valid.astype(np.float32)
+    else:
+        weight = np.where(valid & ~np.isnan(weight), weight, 0).astype(np.float32)
+    shape = data.shape[:-2] + (out_length, alks, out_width, rlks)
+    numerator = np.pad(np.where(valid, data, 0) * weight, pad).reshape(shape).sum(axis=(-3, -1))
+    denominator = np.pad(weight, pad).reshape(shape).sum(axis=(-3, -1))
+
+    out_dtype = data.dtype if np.issubdtype(data.dtype, np.inexact) else np.float32
+    out = np.full(numerator.shape, np.nan, dtype=out_dtype)
+    out[denominator > 0] = numerator[denominator > 0] / denominator[denominator > 0]
+    return out
+
+
+def multilook_stream(read_block, write_block, length, width, alks, rlks, read_weight=None,
+                     bytes_per_pixel=8, max_memory=0.5):
+    """Multilook a raster in strips of full rows so the memory is bounded by max_memory (GB).
+    Parameters: read_block : function(row_1, row_2) returning the 2D block of rows
+                write_block : function(out_row_1, out_row_2, data) writing the multilooked block
+                read_weight : function(row_1, row_2) returning the weights of the block of rows or None
+    Returns:    out_length, out_width : int, size of the multilooked raster
+    """
+    num_rows = max(1, int(max_memory * 1e9 / (bytes_per_pixel * width * 4)) // alks) * alks
+    for row_1 in range(0, length, num_rows):
+        row_2 = min(row_1 + num_rows, length)
+        weight = None if read_weight is None else read_weight(row_1, row_2)
+        data = multilook_array(read_block(row_1, row_2), alks, rlks, weight)
+        write_block(row_1 // alks, row_1 // alks + data.shape[0], data)
+    return int(np.ceil(length / alks)), int(np.ceil(width / rlks))
+
+
 def multilook(infile, outfile, rlks, alks, multilook_tool='gdal'):
-    from mroipac.looks.Looks import Looks
-    import isceobj
 
-    if multilook_tool == "gdal":
+    if multilook_tool == "stream":
+        from isce.components.isceobj.Util.ImageUtil import ImageLib as IML
+
+        print('Multilooking {0} ...'.format(infile))
+        ds = gdal.Open(infile + ".vrt", gdal.GA_ReadOnly)
+        band = ds.GetRasterBand(1)
+        xSize = ds.RasterXSize
+        ySize = ds.RasterYSize
+        dtype = band.ReadAsArray(0, 0, 1, 1).dtype
+        out_shape = (int(np.ceil(ySize / int(alks))), int(np.ceil(xSize / int(rlks))))
+        out_data = np.memmap(outfile, dtype=dtype, mode='write', shape=out_shape)
+
+        def write_block(row_1, row_2, data):
+            out_data[row_1:row_2, :] = data
+
+        multilook_stream(lambda row_1, row_2: band.ReadAsArray(0, row_1, xSize, row_2 - row_1),
+                         write_block, ySize, xSize, int(alks), int(rlks), bytes_per_pixel=dtype.itemsize)
+        out_data.flush()
+        out_data = None
+        ds = None
+        IML.renderISCEXML(outfile, bands=1, nyy=out_shape[0], nxx=out_shape[1],
+                          datatype=dtype.name, scheme='BIL')
+
+    elif multilook_tool == "gdal":
 
         print(infile)
         ds = gdal.Open(infile + ".vrt", gdal.GA_ReadOnly)
@@ -1362,6 +1492,8 @@ def multilook(infile, outfile, rlks, alks, multilook_tool='gdal'):
         ds = None
 
     else:
+        from mroipac.looks.Looks import Looks
+        import isceobj
 
         print('Multilooking {0} ...'.format(infile))
 
@@ -1375,7 +1507,7 @@ def multilook(infile, outfile, rlks, alks, multilook_tool='gdal'):
         lkObj.setOutputFilename(outfile)
         lkObj.looks()
 
-    return outfilie
+    return outfile
 
 def ks_lut(N1, N2, alpha=0.05):
     N = (N1 * N2) / float(N1 + N2)
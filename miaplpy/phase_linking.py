@@ -48,6 +48,13 @@ def main(iargs=None):
 
     inversionObj = iv.CPhaseLink(inps)
 
+    if inps.ps_only:
+        if inps.do_concatenate:
+            inversionObj.invert_ps_only()
+        else:
+            print('PS only mode: phase_series.h5 is written in phase linking step, nothing to concatenate')
+        return None
+
     if inps.do_concatenate:
         phase_invert(inps, inversionObj)
     else:
@@ -78,7 +85,7 @@ def phase_invert(inps, inversionObj):
         os.makedirs(out_folder, exist_ok=True)
 
         if not os.path.exists(out_folder + '/flag.npy'):
-            box_list.append(box)
+            box_list.append((box, inversionObj.active_pixels.get(index)))
 
     #print('Total number of PATCHES: {}'.format(len(inversionObj.box_list)))
     print('Remaining number of PATCHES/tasks: {}'.format(len(box_list)))
@@ -103,26 +110,53 @@ def phase_invert(inps, inversionObj):
         print('Number of images less than 10, phase linking method switched to "{}"'.format(new_plmethod))
         data_kwargs['phase_linking_method'] = new_plmethod
 
-    func = partial(iut.process_patch_c, range_window=data_kwargs['range_window'],
-                   azimuth_window=data_kwargs['azimuth_window'], width=data_kwargs['width'],
-                   length=data_kwargs['length'], n_image=data_kwargs['n_image'],
-                   slcStackObj=data_kwargs['slcStackObj'], distance_threshold=data_kwargs['distance_threshold'],
-                   reference_row=data_kwargs['reference_row'], reference_col=data_kwargs['reference_col'],
-                   phase_linking_method=data_kwargs['phase_linking_method'],
-                   total_num_mini_stacks=data_kwargs['total_num_mini_stacks'],
-                   default_mini_stack_size=data_kwargs['default_mini_stack_size'],
-                   ps_shp=data_kwargs['ps_shp'],
-                   shp_test=data_kwargs['shp_test'],
-                   def_sample_rows=data_kwargs['def_sample_rows'],
-                   def_sample_cols=data_kwargs['def_sample_cols'],
-                   out_dir=data_kwargs['out_dir'],
-                   lag=data_kwargs['time_lag'],
-                   mask_file=data_kwargs['mask_file'])
+    if inps.stream_ministacks and 'sequential' in data_kwargs['phase_linking_method'].decode('UTF-8'):
+        print('Streaming mini stacks: each patch is read one mini stack of {} dates at a time'.format(
+            data_kwargs['default_mini_stack_size']))
+        print('WARNING: the full stack temporal coherence needs all dates at once, tempCoh_full is the average '
+              'temporal coherence of the mini stacks')
+        func = partial(iut.process_patch_stream_c, range_window=data_kwargs['range_window'],
+                       azimuth_window=data_kwargs['azimuth_window'], width=data_kwargs['width'],
+                       length=data_kwargs['length'], n_image=data_kwargs['n_image'],
+                       slcStackObj=data_kwargs['slcStackObj'],
+                       mini_stack_distance_threshold=data_kwargs['mini_stack_distance_threshold'],
+                       reference_row=data_kwargs['reference_row'], reference_col=data_kwargs['reference_col'],
+                       phase_linking_method=data_kwargs['phase_linking_method'],
+                       total_num_mini_stacks=data_kwargs['total_num_mini_stacks'],
+                       default_mini_stack_size=data_kwargs['default_mini_stack_size'],
+                       ps_shp=data_kwargs['ps_shp'],
+                       max_shp=data_kwargs['max_shp'],
+                       y_step=data_kwargs['y_step'],
+                       x_step=data_kwargs['x_step'],
+                       shp_test=data_kwargs['shp_test'],
+                       def_sample_rows=data_kwargs['def_sample_rows'],
+                       def_sample_cols=data_kwargs['def_sample_cols'],
+                       out_dir=data_kwargs['out_dir'])
+    else:
+        if inps.stream_ministacks:
+            print('Streaming mini stacks is only available for sequential methods, all dates are read at once')
+        func = partial(iut.process_patch_c, range_window=data_kwargs['range_window'],
+                       azimuth_window=data_kwargs['azimuth_window'], width=data_kwargs['width'],
+                       length=data_kwargs['length'], n_image=data_kwargs['n_image'],
+                       slcStackObj=data_kwargs['slcStackObj'], distance_threshold=data_kwargs['distance_threshold'],
+                       reference_row=data_kwargs['reference_row'], reference_col=data_kwargs['reference_col'],
+                       phase_linking_method=data_kwargs['phase_linking_method'],
+                       total_num_mini_stacks=data_kwargs['total_num_mini_stacks'],
+                       default_mini_stack_size=data_kwargs['default_mini_stack_size'],
+                       ps_shp=data_kwargs['ps_shp'],
+                       max_shp=data_kwargs['max_shp'],
+                       y_step=data_kwargs['y_step'],
+                       x_step=data_kwargs['x_step'],
+                       shp_test=data_kwargs['shp_test'],
+                       def_sample_rows=data_kwargs['def_sample_rows'],
+                       def_sample_cols=data_kwargs['def_sample_cols'],
+                       out_dir=data_kwargs['out_dir'],
+                       lag=data_kwargs['time_lag'])
 
     print('Reading SLC data from {} and inverting patches in parallel ...'.format(inps.slc_stack))
 
     try:
-        pool.map(func, box_list)
+        pool.starmap(func, box_list)
         pool.close()
         pool.join()
     except KeyboardInterrupt:
@@ -24,9 +24,14 @@ from isce.components import isceobj
 from isce.components.isceobj.Util.ImageUtil import ImageLib as IML
 from contrib.UnwrapComp.unwrapComponents import UnwrapComponents
 from miaplpy.objects.arg_parser import MiaplPyParser
+from miaplpy.objects.utils import multilook_array, write_layout_hdf5
+from mintpy.utils import attribute as attr
 import numpy as np
+import h5py
 from osgeo import gdal
 import subprocess
+import signal
+import argparse
 import glob
 import time
 import datetime
@@ -54,9 +59,23 @@ def main(iargs=None):
 
     time0 = time.time()
 
+    # the pool of pairs stops a pair with SIGTERM, snaphu runs in its own session and is killed with it
+    signal.signal(signal.SIGTERM, stop_snaphu)
+
+    if inps.pair_list:
+        run_unwrap_pairs(inps)
+        print('Time spent: {} m'.format((time.time() - time0) / 60))
+        return
+
+    if inps.input_ifg is None or inps.unwrapped_ifg is None:
+        raise ValueError('--ifg and --unwrapped_ifg are required if no --pair_list is given')
+
     inps.work_dir = os.path.dirname(inps.input_ifg)
 
-    if not os.path.exists(inps.work_dir + '/filt_fine.unw.conncomp.vrt'):
+    if inps.coarse_looks > 1 and not os.path.exists(inps.work_dir + '/filt_fine.unw.conncomp.vrt'):
+        unwrap_coarse_to_fine(inps)
+
+    elif not os.path.exists(inps.work_dir + '/filt_fine.unw.conncomp.vrt'):
        
         unwObj = Snaphu(inps)
         do_tiles, metadata = unwObj.need_to_split_tiles()
@@ -78,25 +97,297 @@ def main(iargs=None):
         inpFile = temp_unwrap
         ccFile = glob.glob(os.path.dirname(inps.unwrapped_ifg) + '/*conncomp')[0]
         outFile = inps.unwrapped_ifg
-        unwrap_2stage(inpFile, ccFile, outFile, unwrapper_2stage_name=None, solver_2stage=None)
+        unwrap_2stage(inpFile, ccFile, outFile, unwrapper_2stage_name=inps.unwrapper_2stage, solver_2stage=None)
 
     if inps.remove_filter_flag and not os.path.exists(inps.unwrapped_ifg + '.old'):
         input_ifg_nofilter = os.path.join(os.path.dirname(inps.input_ifg), 'fine.int')
-        remove_filter(input_ifg_nofilter, inps.input_ifg, inps.unwrapped_ifg)
+        remove_filter(input_ifg_nofilter, inps.input_ifg, inps.unwrapped_ifg, block_rows=inps.block_rows)
 
     print('Time spent: {} m'.format((time.time() - time0)/60))
 
     return
 
 
+def kill_process_group(proc):
+    """ Kills a process started with start_new_session=True and the processes it forked (snaphu --nproc tiles) """
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    return
+
+
+def stop_snaphu(signum, frame):
+    """ SIGTERM handler: kills the running snaphu process group before exiting """
+    if Snaphu.running is not None:
+        kill_process_group(Snaphu.running)
+    sys.exit(128 + signum)
+
+
+def get_pool_size(num_pixels, num_pairs, num_cpu, tile_num_pixels):
+    """ Tiles (snaphu --nproc) of each pair and number of pairs unwrapped at the same time within num_cpu cores.
+    The raster size sets the minimum tiles, rasters that need tiles get more tiles if there are fewer pairs than
+    cores, otherwise the cores go to more pairs in flight """
+    num_tiles = max(1, num_pixels // tile_num_pixels)
+    if num_tiles > 1:
+        num_tiles = max(num_tiles, num_cpu // max(num_pairs, 1))
+    num_tiles = max(1, min(num_tiles, num_cpu))
+    num_jobs = max(1, num_cpu // num_tiles)
+    return num_tiles, num_jobs
+
+
+def get_pair_command(inps, out_dir, num_tiles):
+    """ unwrap_ifgram.py command of one pair of the pool """
+    input_cor = inps.input_cor
+    if os.path.dirname(input_cor) == '':
+        input_cor = os.path.join(out_dir, input_cor)
+    cmd = [sys.executable, os.path.abspath(__file__),
+           '--ifg', os.path.join(out_dir, 'filt_fine.int'),
+           '--coherence', input_cor,
+           '--unwrapped_ifg', os.path.join(out_dir, 'filt_fine.unw'),
+           '--init_method', str(inps.init_method),
+           '--max_discontinuity', str(inps.defo_max),
+           '--num_tiles', str(num_tiles),
+           '--timeout', str(inps.timeout),
+           '--block_rows', str(inps.block_rows)]
+    if inps.coarse_looks > 1:
+        cmd += ['--coarse_looks', str(inps.coarse_looks)]
+    if os.path.exists(os.path.join(out_dir, 'filt_fine.init.unw')):
+        cmd += ['--init_unwrapped', os.path.join(out_dir, 'filt_fine.init.unw')]
+    for flag, value in [('--mask', inps.unwrap_mask), ('--width', inps.ref_width), ('--length', inps.ref_length),
+                        ('--wavelength', inps.wavelength), ('--height', inps.height),
+                        ('--earth_radius', inps.earth_radius)]:
+        if value is not None:
+            cmd += [flag, str(value)]
+    if inps.unwrap_2stage:
+        cmd += ['--two-stage-method', inps.unwrapper_2stage]
+    for flag, value in [('--two-stage', inps.unwrap_2stage), ('--rmfilter', inps.remove_filter_flag),
+                        ('--tmp', inps.copy_to_tmp)]:
+        if value:
+            cmd.append(flag)
+    return cmd
+
+
+def run_unwrap_pairs(inps):
+    """ Unwraps the pairs of inps.pair_list with a pool of unwrap_ifgram.py processes sharing inps.num_cpu cores
+    instead of a fixed fan-out of background jobs. Each pair writes its log to <pair>/unwrap.log.
+    With inps.warm_start the pairs are unwrapped from the shortest and a pair connected by two unwrapped pairs
+    starts from their sum """
+    jobs = []
+    done = []
+    with open(inps.pair_list, 'r') as f:
+        pairs = [line.strip() for line in f.readlines() if line.strip()]
+    for pair in pairs:
+        out_dir = os.path.join(inps.ifgram_dir, pair)
+        if os.path.exists(out_dir + '/filt_fine.unw.conncomp.vrt'):
+            done.append(pair)
+        else:
+            jobs.append(out_dir)
+    if inps.warm_start:
+        jobs = sorted(jobs, key=lambda x: get_pair_span(os.path.basename(x)))
+    print('{} pairs to unwrap'.format(len(jobs)))
+
+    dg = gdal.Open(os.path.join(inps.ifgram_dir, pairs[0], 'filt_fine.int'), gdal.GA_ReadOnly)
+    length, width = dg.RasterYSize, dg.RasterXSize
+    num_pixels = length * width
+    del dg
+
+    if inps.stack_file:
+        # pairs are written to the stack as soon as they are unwrapped
+        create_ifgram_stack(inps.stack_file, pairs, inps.slc_stack, length, width)
+        for pair in done:
+            write_pair_to_stack(inps.stack_file, pairs.index(pair), os.path.join(inps.ifgram_dir, pair))
+
+    if len(jobs) == 0:
+        return
+
+    num_tiles, num_jobs = get_pool_size(num_pixels, len(jobs), inps.num_cpu, inps.tile_num_pixels)
+    print('unwrap {} pairs at a time with {} tiles each on {} cores'.format(num_jobs, num_tiles, inps.num_cpu))
+
+    running = []
+    failed = []
+    while len(jobs) > 0 or len(running) > 0:
+        while len(jobs) > 0 and len(running) < num_jobs:
+            out_dir = jobs.pop(0)
+            if inps.warm_start:
+                # the shortest pair with a path through unwrapped pairs goes first
+                for k, job_dir in enumerate([out_dir] + jobs):
+                    path = get_network_path(os.path.basename(job_dir), done)
+                    if path is not None:
+                        jobs.insert(0, out_dir)
+                        out_dir = jobs.pop(k)
+                        write_initial_unwrapped(out_dir, path)
+                        break
+            log = open(os.path.join(out_dir, 'unwrap.log'), 'w')
+            proc = subprocess.Popen(get_pair_command(inps, out_dir, num_tiles), stdout=log,
+                                    stderr=subprocess.STDOUT, start_new_session=True)
+            running.append((proc, log, out_dir, time.time()))
+
+        time.sleep(1)
+        for job in list(running):
+            proc, log, out_dir, start_time = job
+            if proc.poll() is None:
+                # snaphu is given inps.timeout before the fall back, the pair gets twice as much in total
+                if inps.timeout > 0 and time.time() - start_time > 2 * inps.timeout:
+                    # the pair kills its snaphu session on SIGTERM, SIGKILL if it does not stop (ISCE snaphu)
+                    os.killpg(proc.pid, signal.SIGTERM)
+                    try:
+                        proc.wait(timeout=10)
+                    except subprocess.TimeoutExpired:
+                        pass
+                    kill_process_group(proc)
+                    proc.wait()
+                    print('{} killed after {} s'.format(os.path.basename(out_dir), 2 * inps.timeout))
+                    failed.append(out_dir)
+                else:
+                    continue
+            elif proc.returncode != 0:
+                failed.append(out_dir)
+            elif os.path.exists(out_dir + '/filt_fine.unw.conncomp.vrt'):
+                done.append(os.path.basename(out_dir))
+                if inps.stack_file:
+                    write_pair_to_stack(inps.stack_file, pairs.index(os.path.basename(out_dir)), out_dir)
+            if os.path.exists(out_dir + '/filt_fine.init.unw'):
+                os.remove(out_dir + '/filt_fine.init.unw')
+            log.close()
+            running.remove(job)
+
+    if len(failed) > 0:
+        print('unwrapping failed for: {}'.format(' '.join([os.path.basename(x) for x in failed])))
+    return
+
+
+def create_ifgram_stack(stack_file, pairs, slc_stack, length, width):
+    """ Creates the ifgramStack HDF5 file of MintPy (unwrapPhase, coherence, connectComponent) for the pairs,
+    with the metadata and the perpendicular baselines of slc_stack. dropIfgram is False until a pair is written,
+    so the pairs failing to unwrap are dropped. An existing stack of the same pairs and size is kept """
+    if os.path.exists(stack_file):
+        with h5py.File(stack_file, 'r') as f:
+            if 'unwrapPhase' in f.keys() and f['unwrapPhase'].shape == (len(pairs), length, width) and \
+                    ['_'.join(x.decode('utf-8') for x in date12) for date12 in f['date'][:]] == pairs:
+                return
+
+    with h5py.File(slc_stack, 'r') as f:
+        metadata = dict(f.attrs)
+        slc_dates = [x.decode('utf-8') for x in f['date'][:]]
+        slc_bperp = f['bperp'][:] if 'bperp' in f.keys() else np.zeros(len(slc_dates), dtype=np.float32)
+
+    # interferograms multilooked while formed
+    lks_y = int(np.ceil(int(metadata['LENGTH']) / length))
+    lks_x = int(np.ceil(int(metadata['WIDTH']) / width))
+    if lks_y > 1 or lks_x > 1:
+        metadata = attr.update_attribute4multilook(metadata, lks_y, lks_x)
+    metadata['FILE_TYPE'] = 'ifgramStack'
+    metadata['LENGTH'] = length
+    metadata['WIDTH'] = width
+    metadata['UNIT'] = 'radian'
+    metadata.pop('DATA_TYPE', None)
+
+    date12 = [pair.split('_') for pair in pairs]
+    bperp = [slc_bperp[slc_dates.index(d2)] - slc_bperp[slc_dates.index(d1)] for d1, d2 in date12]
+    num_pair = len(pairs)
+    ds_name_dict = {
+        'date': [np.dtype('S8'), (num_pair, 2), np.array(date12, dtype=np.string_)],
+        'bperp': [np.float32, (num_pair,), np.array(bperp, dtype=np.float32)],
+        'dropIfgram': [np.bool_, (num_pair,), np.zeros(num_pair, dtype=np.bool_)],
+        'unwrapPhase': [np.float32, (num_pair, length, width)],
+        'coherence': [np.float32, (num_pair, length, width)],
+        'connectComponent': [np.int16, (num_pair, length, width)],
+    }
+    ds_unit_dict = {'unwrapPhase': 'radian', 'coherence': '1', 'connectComponent': '1'}
+    if os.path.exists(stack_file):
+        os.remove(stack_file)
+    write_layout_hdf5(stack_file, ds_name_dict, metadata=metadata, ds_unit_dict=ds_unit_dict)
+    return
+
+
+def write_pair_to_stack(stack_file, index, out_dir):
+    """ Writes the unwrapped phase, coherence and connected components of the pair of out_dir
+    into slice index of the ifgramStack file """
+    ds_unw = gdal.Open(os.path.join(out_dir, 'filt_fine.unw.vrt'), gdal.GA_ReadOnly)
+    unwrap_phase = ds_unw.GetRasterBand(2).ReadAsArray()
+    del ds_unw
+    ds_cor = gdal.Open(os.path.join(out_dir, 'filt_fine.cor.vrt'), gdal.GA_ReadOnly)
+    coherence = ds_cor.GetRasterBand(1).ReadAsArray()
+    del ds_cor
+    ds_conn = gdal.Open(os.path.join(out_dir, 'filt_fine.unw.conncomp.vrt'), gdal.GA_ReadOnly)
+    conn_comp = ds_conn.GetRasterBand(1).ReadAsArray()
+    del ds_conn
+
+    with h5py.File(stack_file, 'r+') as f:
+        f['unwrapPhase'][index, :, :] = unwrap_phase
+        f['coherence'][index, :, :] = coherence
+        f['connectComponent'][index, :, :] = conn_comp
+        f['dropIfgram'][index] = True
+        for key in ['unwrapPhase', 'coherence', 'connectComponent']:
+            f[key].attrs['MODIFICATION_TIME'] = str(time.time())
+    print('{} written to {}'.format(os.path.basename(out_dir), stack_file))
+    return
+
+
+def get_pair_span(pair):
+    """ Days between the dates of a reference_secondary pair name """
+    dates = [datetime.datetime.strptime(x, '%Y%m%d') for x in pair.split('_')]
+    return abs((dates[1] - dates[0]).days)
+
+
+def get_network_path(pair, done):
+    """ Two unwrapped pairs (name, sign) connecting the dates of pair: (a, b) + (b, c) = (a, c),
+    the shortest one is chosen, None if there is none """
+    ref, sec = pair.split('_')
+    signed = {}
+    for name in done:
+        d1, d2 = name.split('_')
+        signed[(d1, d2)] = (name, 1)
+        signed[(d2, d1)] = (name, -1)
+
+    path = None
+    for (d1, d2), first in signed.items():
+        if d1 == ref and d2 != sec and (d2, sec) in signed:
+            second = signed[(d2, sec)]
+            span = get_pair_span(first[0]) + get_pair_span(second[0])
+            if path is None or span < path[0]:
+                path = (span, [first, second])
+    return None if path is None else path[1]
+
+
+def write_initial_unwrapped(out_dir, path):
+    """ Writes <pair>/filt_fine.init.unw: the wrapped phase of the pair plus the integer cycles closest to the
+    sum of the unwrapped pairs of path, so snaphu reoptimizes from it with the data of the pair """
+    ds_ifg = gdal.Open(os.path.join(out_dir, 'filt_fine.int'), gdal.GA_ReadOnly)
+    ifg = ds_ifg.GetRasterBand(1).ReadAsArray()
+    del ds_ifg
+    predicted = np.zeros(ifg.shape, dtype=np.float32)
+    for name, sign in path:
+        ds_unw = gdal.Open(os.path.join(os.path.dirname(out_dir), name, 'filt_fine.unw.vrt'), gdal.GA_ReadOnly)
+        predicted += sign * ds_unw.GetRasterBand(2).ReadAsArray()
+        del ds_unw
+
+    phase = np.angle(ifg)
+    init_file = os.path.join(out_dir, 'filt_fine.init.unw')
+    out_unw = np.memmap(init_file, dtype=np.float32, mode='write', shape=(ifg.shape[0], 2, ifg.shape[1]))
+    out_unw[:, 0, :] = np.abs(ifg)
+    out_unw[:, 1, :] = phase + 2 * np.pi * np.round((predicted - phase) / (2 * np.pi))
+    out_unw.flush()
+    del out_unw
+    IML.renderISCEXML(init_file, bands=2, nyy=ifg.shape[0], nxx=ifg.shape[1], datatype='float32', scheme='BIL')
+    print('{} starts from {}'.format(os.path.basename(out_dir), ' + '.join([x[0] for x in path])))
+    return
+
+
 class Snaphu:
 
+    # snaphu process being waited for, killed by stop_snaphu
+    running = None
+
     def __init__(self, inps):
 
         self.config_file = os.path.join(inps.work_dir, 'config_all')
         LENGTH = inps.ref_length
         WIDTH = inps.ref_width
         self.num_tiles = inps.num_tiles
+        self.timeout = inps.timeout if inps.timeout > 0 else None
+        self.init_unwrapped = inps.init_unwrapped
         self.out_unwrapped = inps.unwrapped_ifg
         self.inp_wrapped = inps.input_ifg
         self.conncomp = inps.unwrapped_ifg + '.conncomp'
@@ -179,15 +470,35 @@ class Snaphu:
 
         return do_tiles, y_tile, x_tile
 
+    def communicate(self, p):
+        """ Waits for snaphu, kills it after self.timeout seconds so the caller falls back to the ISCE snaphu """
+        Snaphu.running = p
+        try:
+            return p.communicate(timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            # snaphu runs in its own session, the tiles forked by --nproc are killed with it
+            kill_process_group(p)
+            p.communicate()
+            raise RuntimeError('snaphu stopped after {} s'.format(self.timeout))
+        finally:
+            Snaphu.running = None
+
+    def get_input(self):
+        """ Wrapped interferogram, or the unwrapped initial solution that snaphu reoptimizes (-u) """
+        if self.init_unwrapped is not None and os.path.exists(self.init_unwrapped):
+            return '-u ' + self.init_unwrapped
+        return self.inp_wrapped
+
     def unwrap(self):
 
         cmd = 'snaphu -f {config_file} -d {wrapped_file} {line_length} -o ' \
-              '{unwrapped_file}'.format(config_file=self.config_file, wrapped_file=self.inp_wrapped,
+              '{unwrapped_file}'.format(config_file=self.config_file, wrapped_file=self.get_input(),
                                         line_length=self.width, unwrapped_file=self.out_unwrapped)
 
         print(cmd)
-        p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        output, error = p.communicate()
+        p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             start_new_session=True)
+        output, error = self.communicate(p)
         print(error)
         if 'ERROR' in error.decode('UTF-8') or 'Error' in error.decode('UTF-8'): # or len(error.decode('UTF-8'))>0:
             raise RuntimeError(error)
@@ -206,13 +517,14 @@ class Snaphu:
 
         cmd = 'snaphu -f {config_file} -d {wrapped_file} {line_length} -o ' \
               '{unwrapped_file} --tile {ytile} {xtile} 500 500 ' \
-              '--nproc {num_proc}'.format(config_file=self.config_file, wrapped_file=self.inp_wrapped,
+              '--nproc {num_proc}'.format(config_file=self.config_file, wrapped_file=self.get_input(),
                                           line_length=self.width, unwrapped_file=self.out_unwrapped, ytile=self.y_tile,
                                           xtile=self.x_tile, num_proc=self.num_tiles)
         print(cmd)
         
-        p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        output, error = p.communicate()
+        p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             start_new_session=True)
+        output, error = self.communicate(p)
         print(error)
 
         if 'ERROR' in error.decode('UTF-8') or 'Error' in error.decode('UTF-8'):  # or len(error.decode('UTF-8'))>0:
@@ -319,7 +631,9 @@ def unwrap_2stage(inpFile, ccFile, outFile, unwrapper_2stage_name=None, solver_2
     ds_conn = gdal.Open(ccFile + '.vrt', gdal.GA_ReadOnly)
     conn_comp = ds_conn.GetRasterBand(1).ReadAsArray()
 
-    if np.nanmax(conn_comp) > 1:
+    if np.nanmax(conn_comp) > 1 and unwrapper_2stage_name == 'MST':
+        unwrap_components_mst(inpFile, conn_comp, outFile)
+    elif np.nanmax(conn_comp) > 1:
         # Hand over to 2Stage unwrap
         unw = UnwrapComponents()
         unw.setInpFile(inpFile)
@@ -348,88 +662,274 @@ def unwrap_2stage(inpFile, ccFile, outFile, unwrapper_2stage_name=None, solver_2
 # update_connect_component_mask(inps.unwrapped_ifg, inps.input_cor)
 
 
-def update_connect_component_mask(unwrapped_file, temporal_coherence):
+def unwrap_coarse_to_fine(inps):
+    """ Unwraps the interferogram multilooked by inps.coarse_looks (coherence weighted) with snaphu, then adds to
+    each full resolution pixel the integer cycles that bring its wrapped phase closest to the bilinear upsampled
+    coarse solution (as remove_filter re-applies the integer jumps). Connected components are the ones of the
+    coarse pixel. The outputs replace the ones of the full resolution snaphu run. """
+    from scipy.ndimage import map_coordinates
+
+    looks = inps.coarse_looks
+    dg = gdal.Open(inps.input_ifg, gdal.GA_ReadOnly)
+    ifg = dg.GetRasterBand(1).ReadAsArray()
+    length, width = ifg.shape
+    del dg
+    dg = gdal.Open(inps.input_cor, gdal.GA_ReadOnly)
+    coh = dg.GetRasterBand(1).ReadAsArray().astype(np.float32)
+    del dg
+
+    # coarse wrapped interferogram, coherence and mask
+    coarse_inps = argparse.Namespace(**vars(inps))
+    coarse_inps.input_ifg = os.path.join(inps.work_dir, 'coarse_filt_fine.int')
+    coarse_inps.input_cor = os.path.join(inps.work_dir, 'coarse_filt_fine.cor')
+    coarse_inps.unwrapped_ifg = os.path.join(inps.work_dir, 'coarse_filt_fine.unw')
+    coarse_inps.unwrap_2stage = False
+    coarse_inps.init_unwrapped = None
+    coarse_inps.num_tiles = max(1, inps.num_tiles // looks ** 2)
+
+    coarse_ifg = multilook_array(ifg, looks, looks, np.where(coh > 0, coh, 0)).astype(np.complex64)
+    coarse_ifg[np.isnan(coarse_ifg)] = 0
+    coarse_length, coarse_width = coarse_ifg.shape
+    coarse_ifg.tofile(coarse_inps.input_ifg)
+    IML.renderISCEXML(coarse_inps.input_ifg, bands=1, nyy=coarse_length, nxx=coarse_width,
+                      datatype='complex64', scheme='BIL')
+    coarse_coh = multilook_array(coh, looks, looks).astype(np.float32)
+    coarse_coh[np.isnan(coarse_coh)] = 0
+    coarse_coh.tofile(coarse_inps.input_cor)
+    IML.renderISCEXML(coarse_inps.input_cor, bands=1, nyy=coarse_length, nxx=coarse_width,
+                      datatype='float32', scheme='BIL')
+    if not inps.unwrap_mask is None:
+        dg = gdal.Open(inps.unwrap_mask, gdal.GA_ReadOnly)
+        mask = dg.GetRasterBand(1).ReadAsArray().astype(np.float32)
+        del dg
+        coarse_inps.unwrap_mask = os.path.join(inps.work_dir, 'coarse_mask')
+        (multilook_array(mask, looks, looks) >= 0.5).astype(np.byte).tofile(coarse_inps.unwrap_mask)
+        IML.renderISCEXML(coarse_inps.unwrap_mask, bands=1, nyy=coarse_length, nxx=coarse_width,
+                          datatype='BYTE', scheme='BIL')
+
+    print('unwrap {} x {} coarse interferogram ({} looks)'.format(coarse_length, coarse_width, looks))
+    unwObj = Snaphu(coarse_inps)
+    do_tiles, metadata = unwObj.need_to_split_tiles()
+    try:
+        if do_tiles:
+            unwObj.unwrap_tile()
+        else:
+            unwObj.unwrap()
+    except:
+        runUnwrap(coarse_inps.input_ifg, coarse_inps.unwrapped_ifg, coarse_inps.input_cor, metadata)
+
+    coarse_unw = np.fromfile(coarse_inps.unwrapped_ifg, dtype=np.float32).reshape(coarse_length, 2,
+                                                                                   coarse_width)[:, 1, :]
+    coarse_conncomp = np.fromfile(coarse_inps.unwrapped_ifg + '.conncomp',
+                                  dtype=np.uint8).reshape(coarse_length, coarse_width)
+
+    # full resolution solution, coarse pixel k is centered at k * looks + (looks - 1) / 2
+    unwrapped_file = inps.unwrapped_ifg
+    if inps.unwrap_2stage:
+        unwrapped_file = os.path.dirname(inps.unwrapped_ifg) + '/temp_filt_fine.unw'
+    out_unw = np.memmap(unwrapped_file, dtype=np.float32, mode='write', shape=(length, 2, width))
+    out_conncomp = np.memmap(inps.unwrapped_ifg + '.conncomp', dtype=np.uint8, mode='write', shape=(length, width))
+    cols = (np.arange(width) - (looks - 1) / 2) / looks
+    num_rows = max(looks, 10000000 // width)
+    for row_1 in range(0, length, num_rows):
+        row_2 = min(row_1 + num_rows, length)
+        rows = (np.arange(row_1, row_2) - (looks - 1) / 2) / looks
+        grid_y, grid_x = np.meshgrid(rows, cols, indexing='ij')
+        estimate = map_coordinates(coarse_unw, [grid_y, grid_x], order=1, mode='nearest')
+        phase = np.angle(ifg[row_1:row_2, :])
+        out_unw[row_1:row_2, 0, :] = np.abs(ifg[row_1:row_2, :])
+        out_unw[row_1:row_2, 1, :] = phase + 2 * np.pi * np.round((estimate - phase) / (2 * np.pi))
+        out_conncomp[row_1:row_2, :] = coarse_conncomp[np.arange(row_1, row_2) // looks, :][:, np.arange(width) // looks]
+    out_unw.flush()
+    out_conncomp.flush()
+    del out_unw, out_conncomp
+
+    IML.renderISCEXML(unwrapped_file, bands=2, nyy=length, nxx=width, datatype='float32', scheme='BIL')
+    IML.renderISCEXML(inps.unwrapped_ifg + '.conncomp', bands=1, nyy=length, nxx=width, datatype='BYTE', scheme='BIL')
+
+    for name in glob.glob(os.path.join(inps.work_dir, 'coarse_*')):
+        os.remove(name)
+    return
+
+
+def get_component_edges(conn_comp, phase):
+    """ Pairs of neighbour pixels of different connected components, the unconnected pixels (0) take the
+    component and phase of their nearest connected pixel so components separated by gaps are also adjacent.
+    Returns:    comp_1, comp_2 : 1D arrays of the components of each pair (comp_1 < comp_2)
+                cycles : 1D array of the integer cycles to add to comp_2 to match comp_1 at each pair
+    """
+    from scipy.ndimage import distance_transform_edt
+
+    indices = distance_transform_edt(conn_comp == 0, return_distances=False, return_indices=True)
+    labels = conn_comp[indices[0], indices[1]]
+    nearest_phase = phase[indices[0], indices[1]]
+
+    comp_1, comp_2, cycles = [], [], []
+    for sl_1, sl_2 in [((slice(None), slice(None, -1)), (slice(None), slice(1, None))),
+                       ((slice(None, -1), slice(None)), (slice(1, None), slice(None)))]:
+        l1, l2 = labels[sl_1], labels[sl_2]
+        boundary = (l1 != l2) & (l1 > 0) & (l2 > 0)
+        l1, l2 = l1[boundary], l2[boundary]
+        k = np.round((nearest_phase[sl_1][boundary] - nearest_phase[sl_2][boundary]) / (2 * np.pi))
+        swap = l1 > l2
+        comp_1.append(np.where(swap, l2, l1))
+        comp_2.append(np.where(swap, l1, l2))
+        cycles.append(np.where(swap, -k, k))
+    return np.concatenate(comp_1), np.concatenate(comp_2), np.concatenate(cycles).astype(np.int64)
+
+
+def solve_component_offsets(conn_comp, phase):
+    """ Integer cycles of each connected component: the median cycles of the boundary pixel pairs of two
+    adjacent components is their relative offset and the offsets are propagated from the largest component
+    along the maximum spanning tree of the number of boundary pairs.
+    Returns:    offsets : 1D array, offsets[c] is the number of cycles to add to component c
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import minimum_spanning_tree, breadth_first_order
+
+    num_comp = int(conn_comp.max()) + 1
+    offsets = np.zeros(num_comp, dtype=np.int64)
+    comp_1, comp_2, cycles = get_component_edges(conn_comp, phase)
+    if comp_1.size == 0:
+        return offsets
+
+    # median cycles of each edge from the pairs sorted by edge and cycles
+    edge = comp_1.astype(np.int64) * num_comp + comp_2
+    order = np.lexsort((cycles, edge))
+    edge, cycles = edge[order], cycles[order]
+    edge_ids, first, counts = np.unique(edge, return_index=True, return_counts=True)
+    edge_cycles = cycles[first + counts // 2]
+    node_1, node_2 = edge_ids // num_comp, edge_ids % num_comp
+
+    # maximum spanning tree of the boundary lengths
+    graph = coo_matrix((1. / counts, (node_1, node_2)), shape=(num_comp, num_comp)).tocsr()
+    tree = minimum_spanning_tree(graph)
+    tree = tree + tree.T
+    edge_dict = dict(zip(zip(node_1, node_2), edge_cycles))
+
+    sizes = np.bincount(conn_comp.ravel(), minlength=num_comp)
+    sizes[0] = 0
+    reached = np.zeros(num_comp, dtype=bool)
+    for root in np.argsort(sizes)[::-1]:
+        if sizes[root] == 0 or reached[root]:
+            continue
+        nodes, predecessors = breadth_first_order(tree, root, directed=False, return_predecessors=True)
+        reached[nodes] = True
+        for node in nodes[1:]:
+            parent = predecessors[node]
+            if (parent, node) in edge_dict:
+                offsets[node] = offsets[parent] + edge_dict[(parent, node)]
+            else:
+                offsets[node] = offsets[parent] - edge_dict[(node, parent)]
+    return offsets
+
+
+def unwrap_components_mst(inpFile, conn_comp, outFile):
+    """ Second stage of the two stage unwrapping without ISCE: adds the integer cycles of each connected component
+    solved by solve_component_offsets and writes outFile """
+    ds_unw = gdal.Open(inpFile + '.vrt', gdal.GA_ReadOnly)
+    amplitude = ds_unw.GetRasterBand(1).ReadAsArray()
+    phase = ds_unw.GetRasterBand(2).ReadAsArray()
+    length, width = phase.shape
+    del ds_unw
+
+    conn_comp = conn_comp.astype(np.int64)
+    offsets = solve_component_offsets(conn_comp, phase)
+    print('solved the offsets of {} connected components'.format(len(np.unique(conn_comp[conn_comp > 0]))))
+
+    out_unw = np.memmap(outFile, dtype=np.float32, mode='write', shape=(length, 2, width))
+    out_unw[:, 0, :] = amplitude
+    out_unw[:, 1, :] = phase + 2 * np.pi * offsets[conn_comp]
+    out_unw.flush()
+    del out_unw
+    IML.renderISCEXML(outFile, bands=2, nyy=length, nxx=width, datatype='float32', scheme='BIL')
+    return
+
+
+def update_connect_component_mask(unwrapped_file, temporal_coherence, block_rows=2000):
+    """ Labels the connected components by their integer cycles (masked by temporal coherence > 0.5),
+    the conncomp file is updated in place in blocks of block_rows rows """
 
     ds_unw = gdal.Open(unwrapped_file + '.vrt', gdal.GA_ReadOnly)
-    phas = ds_unw.GetRasterBand(2).ReadAsArray()
+    band_phas = ds_unw.GetRasterBand(2)
+    width = ds_unw.RasterXSize
+    length = ds_unw.RasterYSize
 
     ds_conn = gdal.Open(unwrapped_file + '.conncomp.vrt', gdal.GA_ReadOnly)
-    conn_comp = ds_conn.GetRasterBand(1).ReadAsArray()
-
-    factor_2pi = np.round(phas / (2 * np.pi)).astype(np.int) + conn_comp
-    factor_2pi = factor_2pi - np.min(factor_2pi) + 1
-    mask = conn_comp > 0
+    band_conn = ds_conn.GetRasterBand(1)
 
+    band_tcoh = None
     if not temporal_coherence is None:
         ds_tcoh = gdal.Open(temporal_coherence.split('_msk')[0] + '.vrt', gdal.GA_ReadOnly)
-        tcoh = ds_tcoh.GetRasterBand(1).ReadAsArray()
-        mask2 = tcoh > 0.5
-        mask *= mask2
-
-    new_conn_comp = factor_2pi * mask
-    length = new_conn_comp.shape[0]
-    width = new_conn_comp.shape[1]
-    out_connComp = np.memmap(unwrapped_file + '.conncomp', dtype=np.byte, mode='write', shape=(length, width))
-    out_connComp[:, :] = new_conn_comp[:, :]
-
+        band_tcoh = ds_tcoh.GetRasterBand(1)
+
+    def read_factor_2pi(row_1, row_2):
+        phas = band_phas.ReadAsArray(0, row_1, width, row_2 - row_1)
+        conn_comp = band_conn.ReadAsArray(0, row_1, width, row_2 - row_1)
+        return np.round(phas / (2 * np.pi)).astype(np.int64) + conn_comp, conn_comp
+
+    # first pass for the minimum of the whole raster
+    min_factor = None
+    for row_1 in range(0, length, block_rows):
+        row_2 = min(row_1 + block_rows, length)
+        factor_min = np.min(read_factor_2pi(row_1, row_2)[0])
+        min_factor = factor_min if min_factor is None else min(min_factor, factor_min)
+
+    out_connComp = np.memmap(unwrapped_file + '.conncomp', dtype=np.byte, mode='r+', shape=(length, width))
+    for row_1 in range(0, length, block_rows):
+        row_2 = min(row_1 + block_rows, length)
+        factor_2pi, conn_comp = read_factor_2pi(row_1, row_2)
+        factor_2pi = factor_2pi - min_factor + 1
+        mask = conn_comp > 0
+        if not band_tcoh is None:
+            mask *= band_tcoh.ReadAsArray(0, row_1, width, row_2 - row_1) > 0.5
+        out_connComp[row_1:row_2, :] = factor_2pi * mask
+
+    out_connComp.flush()
     del out_connComp
 
     return
 
 
-def remove_filter(intfile, filtfile, unwfile):
+def remove_filter(intfile, filtfile, unwfile, block_rows=2000):
+    """ Replaces the filtered phase in the unwrapped interferogram by the unfiltered one, keeping the integer
+    jumps of the unwrapping. The original is saved as old_filt_fine.unw and unwfile is updated in place,
+    in blocks of block_rows rows so the memory does not depend on the size of the interferogram """
 
     ds_unw = gdal.Open(unwfile + ".vrt", gdal.GA_ReadOnly)
-    unwphas = ds_unw.GetRasterBand(2).ReadAsArray()
-    unwamp = ds_unw.GetRasterBand(1).ReadAsArray()
+    band_unwamp = ds_unw.GetRasterBand(1)
+    band_unwphas = ds_unw.GetRasterBand(2)
     width = ds_unw.RasterXSize
     length = ds_unw.RasterYSize
-    del ds_unw
 
     ds_ifg = gdal.Open(intfile + ".vrt", gdal.GA_ReadOnly)
-    ifgphas = np.angle(ds_ifg.GetRasterBand(1).ReadAsArray())
-    del ds_ifg
+    band_ifg = ds_ifg.GetRasterBand(1)
+    ds_fifg = gdal.Open(filtfile + ".vrt", gdal.GA_ReadOnly)
+    band_fifg = ds_fifg.GetRasterBand(1)
 
     oldunwf = unwfile.split('filt_fine.unw')[0] + 'old_filt_fine.unw'
-    unwImage_o = isceobj.Image.createUnwImage()
-    unwImage_o.setFilename(oldunwf)
-    unwImage_o.setAccessMode('write')
-    unwImage_o.setWidth(width)
-    unwImage_o.setLength(length)
-    unwImage_o.createImage()
-
-    out_unw = unwImage_o.asMemMap(oldunwf)
-    # print(out_unw.shape)
-    out_unw[:, 0, :] = unwamp
-    out_unw[:, 1, :] = unwphas
-    # del ifgphas, fifgphas
-    unwImage_o.renderHdr()
-    unwImage_o.finalizeImage()
-
-    ds_fifg = gdal.Open(filtfile + ".vrt", gdal.GA_ReadOnly)
-    fifgphas = np.angle(ds_fifg.GetRasterBand(1).ReadAsArray())
-    del ds_fifg
-
-    integer_jumps = unwphas - fifgphas
-    del fifgphas
-
-    #shutil.copy2(unwfile, unwfile + '.old')
-    #os.system('cp {} {}'.format(unwfile, unwfile+'.old'))
-
-    unwImage = isceobj.Image.createUnwImage()
-    unwImage.setFilename(unwfile)
-    unwImage.setAccessMode('write')
-    unwImage.setWidth(width)
-    unwImage.setLength(length)
-    unwImage.createImage()
-
-    out_unw = unwImage.asMemMap(unwfile)
-    #print(out_unw.shape)
-    out_unw[:, 0, :] = unwamp
-    out_unw[:, 1, :] = ifgphas + integer_jumps
-    #del ifgphas, fifgphas
-    unwImage.renderHdr()
-    unwImage.finalizeImage()
+    old_unw = np.memmap(oldunwf, dtype=np.float32, mode='write', shape=(length, 2, width))
+    out_unw = np.memmap(unwfile, dtype=np.float32, mode='r+', shape=(length, 2, width))
+
+    for row_1 in range(0, length, block_rows):
+        row_2 = min(row_1 + block_rows, length)
+        num_rows = row_2 - row_1
+        unwamp = band_unwamp.ReadAsArray(0, row_1, width, num_rows)
+        unwphas = band_unwphas.ReadAsArray(0, row_1, width, num_rows)
+        old_unw[row_1:row_2, 0, :] = unwamp
+        old_unw[row_1:row_2, 1, :] = unwphas
+
+        integer_jumps = unwphas - np.angle(band_fifg.ReadAsArray(0, row_1, width, num_rows))
+        out_unw[row_1:row_2, 0, :] = unwamp
+        out_unw[row_1:row_2, 1, :] = np.angle(band_ifg.ReadAsArray(0, row_1, width, num_rows)) + integer_jumps
+
+    old_unw.flush()
+    out_unw.flush()
+    del old_unw, out_unw
+    ds_unw = ds_ifg = ds_fifg = None
+
+    IML.renderISCEXML(oldunwf, bands=2, nyy=length, nxx=width, datatype='float32', scheme='BIL')
+    IML.renderISCEXML(unwfile, bands=2, nyy=length, nxx=width, datatype='float32', scheme='BIL')
 
     return
 